@@ -27,6 +27,7 @@ import scipy  # calculating specific frequencies
 from scipy.io import wavfile
 
 from pyoperant import analysis, utils  # Analysis creates the data summary tables
+from pyoperant.interfaces import pyaudio_  # soundcheck functionality, shares the PortAudio host
 import csv  # For exporting data summaries as csv files
 
 try:
@@ -856,22 +857,12 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
 
         boxNumber = boxindex + 1
         testFile = '/home/aperture/bird/stim/440 test tone.wav'
-        soundOut = pyaudio.PyAudio()
-        soundIn = pyaudio.PyAudio()
+        soundHost = pyaudio_.audio_host  # shared PortAudio host, which remembers devices it has already found
         tempRecording = 'Box {:02d} cal.wav'.format(boxNumber)
 
         # Get actual device indices
         deviceNameOut = 'Board{:02d}: USB Audio'.format(boxNumber)
-        deviceIndexOut = None
-        for index in range(soundOut.get_device_count()):
-            truncName = soundOut.get_device_info_by_index(index)['name']
-            if deviceNameOut[:18] == truncName[:18]:  # only check the first 7 characters
-                deviceIndexOut = index
-                break
-            else:
-                deviceIndexOut = None
-        if deviceIndexOut is None:
-            raise NameError('could not find pyaudio device %s' % deviceNameOut)
+        deviceIndexOut = soundHost.find(deviceNameOut, 'output')
 
         # get input device index
         # Complicated because ALSA number doesn't necessarily correspond with pyaudio's device index,
@@ -881,56 +872,25 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
         #   unique serial number)
         #   2. Find the card number of a particular named card
         #   3. Pyaudio can read card numbers, so get the pyaudio device with the matching card number
+        # AudioHost.find_card does steps 2 and 3
         deviceNameIn = 'sound%02i' % boxNumber
-        deviceIndexIn = None
-
-        # First get list of cards on computer
-        cardFile = '/proc/asound/cards'  # cards file contains list of all cards
-        f = open(cardFile, 'r')
-        fl = f.readlines()
-        f.close()
-        # cards file is formatted "number [deviceName     ] so pull values before the matching name to get card number
-        matchString = '^(.+?)\s\[' + deviceNameIn
-        deviceCardIn = []
-        for x in fl:
-            m = re.search(matchString, x)
-            if m is not None:
-                deviceCardIn = int(m.groups()[0])
-                # print("ALSA Card number: %d" % deviceCardIn)
-                break
-        if not deviceCardIn:
-            raise NameError('could not find input device %s' % deviceNameIn)
-
-        # now use ALSA card number to find pyaudio device index
-
-        for index in range(soundIn.get_device_count()):
-            pyaudioInputIndex = []
-            try:
-                pyaudioInputIndex = re.split('hw:', soundIn.get_device_info_by_index(index)['name'])[1]
-            except IndexError:
-                pass
-            if pyaudioInputIndex:
-                # if hw number returned, compare with ALSA card
-                pyaudioInputIndex = int(re.split(',', pyaudioInputIndex)[0])
-
-                if pyaudioInputIndex == deviceCardIn:
-                    deviceIndexIn = int(index)
-                    break
+        deviceIndexIn = soundHost.find_card(deviceNameIn, 'input')
 
-        if deviceIndexIn is None:
-            raise NameError('could not find pyaudio device %s' % self.device_name)
+        # only now, as looking devices up can restart PortAudio when the sound cards have changed
+        soundOut = soundHost.pa
+        soundIn = soundHost.pa
 
         # open wav file
         self.wf = wave.open(testFile)
 
         # create stream object for output
-        streamOut = soundOut.open(format=soundOut.get_format_from_width(self.wf.getsampwidth()),
-                                  channels=1,  # fixed to 1 for single-channel (mono) stimuli
-                                  rate=self.wf.getframerate(),
-                                  output=True,
-                                  output_device_index=deviceIndexOut,
-                                  start=False,
-                                  stream_callback=callback)
+        streamOut = soundHost.open(format=soundOut.get_format_from_width(self.wf.getsampwidth()),
+                                   channels=1,  # fixed to 1 for single-channel (mono) stimuli
+                                   rate=self.wf.getframerate(),
+                                   output=True,
+                                   output_device_index=deviceIndexOut,
+                                   start=False,
+                                   stream_callback=callback)
 
         # create stream object for input
         CHUNK = 4096  # recording chunk size
@@ -938,13 +898,13 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
         SECONDS = 2  # how long to record
         FORMAT = soundIn.get_format_from_width(self.wf.getsampwidth())
 
-        streamIn = soundIn.open(format=FORMAT,
-                                channels=1,
-                                rate=RATE,
-                                input=True,
-                                input_device_index=deviceIndexIn,
-                                frames_per_buffer=CHUNK
-                                )
+        streamIn = soundHost.open(format=FORMAT,
+                                  channels=1,
+                                  rate=RATE,
+                                  input=True,
+                                  input_device_index=deviceIndexIn,
+                                  frames_per_buffer=CHUNK
+                                  )
 
         recordingFrames = []  # Initialize it first just in case the record function fails
 
@@ -985,11 +945,11 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
 
         # stop recording
         try:
-            streamIn.close()
+            soundHost.close(streamIn)
         except AttributeError:
             streamIn = None
         try:
-            streamOut.close()
+            soundHost.close(streamOut)
         except AttributeError:
             streamOut = None
 
@@ -1004,8 +964,6 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
         # report peak level
         messageOut = "Box %s level: %f rms (raw) \ndBFS: %f" % (boxNumber, recordingRMS, recordingdB)
         self.display_message(boxindex, messageOut)
-        soundOut.terminate()
-        soundIn.terminate()
 
         with wait_cursor():  # set mouse cursor to 'waiting' while garbage collecting
             gc.collect()  # just in case sound recording doesn't clear vars properly
@@ -1077,6 +1035,37 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
                             time.sleep(10)
                             self.start_box(boxnumber)  # try again
 
+    def sound_health(self, birdName):
+        # Summarize the input levels that a box publishes when run with monitor_levels, without touching its audio
+        levels_file = os.path.join(self.experimentPath, birdName, "{0}{1}".format(birdName, '.levelsDAT'))
+        try:
+            with open(levels_file, 'r') as f:
+                levels = json.load(f)
+        except (IOError, ValueError):
+            return ''
+        if not levels.get('blocks') or time.time() - levels['time'] > 30:  # box stopped publishing
+            return 'Sound: no recent levels'
+        if levels['clipped_samples'] > 0:
+            state = 'CLIPPING'
+        elif levels['silent_fraction'] >= 0.99:
+            state = 'SILENT'
+        else:
+            state = 'ok'
+        return "Sound: {0}  rms {1} dBFS  peak {2} dBFS".format(state, levels['rms_dbfs'], levels['peak_dbfs'])
+
+    def box_resources(self, birdName):
+        # Summarize the open files, memory and CPU that a box's process publishes, without touching the process
+        resources_file = os.path.join(self.experimentPath, birdName, "{0}{1}".format(birdName, '.resourcesDAT'))
+        try:
+            with open(resources_file, 'r') as f:
+                resources = json.load(f)
+        except (IOError, ValueError):
+            return ''
+        if not resources or time.time() - resources['time'] > 60:  # box stopped publishing
+            return ''
+        return "Process: {0} files  {1:.0f} MB  {2:.0f}% CPU  {3} threads".format(
+            resources['fds'], resources['rss_mb'], resources.get('cpu_percent', 0.0), resources['threads'])
+
     def refreshfile(self, boxnumber):
 
         if self.debug:
@@ -1149,6 +1138,12 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
 
                     logTotalsMessage = "Training Trials: {trials}   Probe trials: {probe_trials}\n" \
                                        "Rf'd responses: {feeds}".format(**logData)
+                    soundMessage = self.sound_health(birdName)
+                    if soundMessage:
+                        logTotalsMessage += '\n' + soundMessage
+                    resourcesMessage = self.box_resources(birdName)
+                    if resourcesMessage:
+                        logTotalsMessage += '\n' + resourcesMessage
                     logTotalsMessage.encode('utf8')
                     self.display_message(boxnumber, logTotalsMessage, target='status')
 
@@ -1199,38 +1194,9 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
 
     # region Utility functions
     def check_time(self, schedule, fmt="%H:%M", **kwargs):
-        """ Determine whether current time is within $schedule
-        Primary use: determine whether trials should be done given the current time and light schedule or
-        session schedule
-
-        returns Boolean if current time meets schedule
-
-        schedule='sun' will change lights according to local sunrise and sunset
-
-        schedule=[('07:00','17:00')] will have lights on between 7am and 5pm
-        schedule=[('06:00','12:00'),('18:00','24:00')] will have lights on between
-
+        """ Determine whether current time is within $schedule (see utils.check_time, which parses each schedule once)
         """
-
-        if schedule == 'sun':
-            if utils.is_day(kwargs):
-                return True
-        else:
-            for epoch in schedule:
-                assert len(epoch) is 2
-                now = dt.datetime.time(dt.datetime.now())
-                start = dt.datetime.time(dt.datetime.strptime(epoch[0], fmt))
-                end = dt.datetime.time(dt.datetime.strptime(epoch[1], fmt))
-                if self.time_in_range(start, end, now):
-                    return True
-        return False
-
-    def time_in_range(self, start, end, x):
-        """Return true if x is in the range [start, end]"""
-        if start <= end:
-            return start <= x <= end
-        else:
-            return start <= x or x <= end
+        return utils.check_time(schedule, fmt, **kwargs)
 
     def use_nr_trials(self, boxnumber):
         # single box: invert selection of whether to use NR trials
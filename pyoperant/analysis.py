@@ -506,7 +506,8 @@ class Performance(object):
                         for row in csv_reader:
                             if currentLine == 0:
                                 # ignore first line (headers) because we're assuming the order is the same for all files
-                                pass
+                                # (only the tempo column, saved with synthesized stimuli, is looked up by name)
+                                tempo_column = row.index('tempo') if 'tempo' in row else None
                             else:
                                 data_dict['Index'].append(int(row[1]))
                                 data_dict['Class'].append(row[4])
@@ -533,12 +534,15 @@ class Performance(object):
                                     stim_tempo = 'Shaping'
                                     trialType = 'Shaping'
                                 else:
-                                    try:
-                                        stim_tempo = float(stim_name[5:9]) / 10
-                                    except ValueError:
-                                        # Old stim name format only had tempo as three-digit number, which is caught
-                                        # by ValueError (since ###_ can't be converted to float)
-                                        stim_tempo = float(stim_name[5:8])
+                                    if tempo_column is not None and len(row) > tempo_column and row[tempo_column]:
+                                        stim_tempo = float(row[tempo_column])
+                                    else:
+                                        try:
+                                            stim_tempo = float(stim_name[5:9]) / 10
+                                        except ValueError:
+                                            # Old stim name format only had tempo as three-digit number, which is
+                                            # caught by ValueError (since ###_ can't be converted to float)
+                                            stim_tempo = float(stim_name[5:8])
                                     if row[5] == 'probePlus' or row[5] == 'probeMinus':
                                         trialType = 'Probe'
                                     else:
@@ -64,9 +64,7 @@ class Adlib(object):
 
     def check_session_schedule(self):
         """returns True if the subject should be running sessions"""
-        if utils.check_day(self.parameters['session_days']):
-            return utils.check_time(self.parameters['session_schedule'])
-        return False
+        return utils.get_schedule(self.parameters['session_schedule'], days=self.parameters['session_days']).is_active()
 
     def _pre_reward_log(self, next_state):
         def temp():
@@ -134,15 +132,11 @@ class Adlib(object):
     def _poll_main(self, component, duration):
         def temp():
             elapsed_time = (dt.datetime.now() - self.polling_start).total_seconds()
-            if elapsed_time <= duration:
-                if component.status():
-                    self.responded_poll = True
-                    self.last_response = component.name
-                    return None
-                utils.wait(.015)
-                return 'main'
-            else:
-                return None
+            port, responded_at = self.panel.wait_any([component], timeout=max(duration - elapsed_time, 0))
+            if port is not None:
+                self.responded_poll = True
+                self.last_response = component.name
+            return None
 
         return temp
 
@@ -2,7 +2,7 @@ import logging, traceback
 import os, sys, socket
 import datetime as dt
 import atexit
-from pyoperant import utils, components, local, hwio
+from pyoperant import utils, components, local, hwio, resources
 from pyoperant import ComponentError, InterfaceError
 from pyoperant.behavior import shape
 
@@ -28,6 +28,8 @@ class BaseExp(object):
     light_schedule  -- the light schedule for the experiment. either 'sun' or
         a tuple of (starttime,endtime) tuples in (hhmm,hhmm) form defining
         time intervals for the lights to be on
+    idle_poll_interval -- while idle, the most seconds between panel resets,
+        however far off the next schedule change is (default 60.0)
     experiment_path -- path to the experiment
     stim_path -- path to stimuli (default = <experiment_path>/stims)
     subject -- identifier of the subject
@@ -35,6 +37,10 @@ class BaseExp(object):
 
     Methods:
     run() -- runs the experiment
+    compile_state_machines() -- builds the idle, sleep and session state machines that run() runs
+    idle_states() -- the states of the idle state machine by name, which subclasses can add to
+    wait_for_schedule(max_wait) -- waits until the light or session schedule
+        next changes, or at most max_wait seconds
 
     """
 
@@ -75,6 +81,12 @@ class BaseExp(object):
         self.parameters['log_handlers'] = log_handlers
         self.log_config()
 
+        # sample this process's open files, memory and CPU in the background, for the log and the GUI
+        self.resources = resources.ResourceMonitor(interval=self.parameters.get('resource_interval', 10.0),
+                                                   publish_to=os.path.join(experiment_path,
+                                                                           subject + '.resourcesDAT'))
+        self.resources.start()
+
         self.req_panel_attr = ['house_light',
                                'reset',
                                ]
@@ -83,6 +95,9 @@ class BaseExp(object):
 
         atexit.register(self.pyoperant_close)
 
+        if 'trace_states' not in self.parameters:
+            self.parameters['trace_states'] = False
+
         if 'shape' not in self.parameters:
             # or self.parameters['shape'] not in ['block1', 'block2', 'block3', 'block4', 'block5']:
             self.parameters['shape'] = None
@@ -137,13 +152,19 @@ class BaseExp(object):
 
     def check_light_schedule(self):
         """returns true if the lights should be on"""
-        return utils.check_time(self.parameters['light_schedule'])
+        return utils.get_schedule(self.parameters['light_schedule']).is_active()
 
     def check_session_schedule(self):
         """returns True if the subject should be running sessions"""
-        if utils.check_day(self.parameters['session_days']):
-            return utils.check_time(self.parameters['session_schedule'])
-        return False
+        return utils.get_schedule(self.parameters['session_schedule'], days=self.parameters['session_days']).is_active()
+
+    def wait_for_schedule(self, max_wait=3600.0):
+        """waits until the light or session schedule next changes, or at most max_wait seconds"""
+        schedules = [utils.get_schedule(self.parameters['light_schedule'])]
+        if 'session_schedule' in self.parameters:
+            schedules.append(utils.get_schedule(self.parameters['session_schedule'],
+                                                days=self.parameters.get('session_days', 'daily')))
+        utils.wait_for_transition(schedules, max_wait=max_wait)
 
     def check_day_schedule(self):
         """returns True if the subject should be running sessions"""
@@ -175,13 +196,38 @@ class BaseExp(object):
         if self.parameters['shape']:
             self.shaper.run_shape()
 
+        self.compile_state_machines()
         while True:  # is this while necessary?
-            utils.run_state_machine(start_in='idle',
-                                    error_state='idle',
-                                    error_callback=self.log_error_callback,
-                                    idle=self._run_idle,
-                                    sleep=self._run_sleep,
-                                    session=self._run_session)
+            self.idle_machine.run()
+
+    def compile_state_machines(self):
+        """checks and compiles the state machines run() runs, once, rather than each time they're entered"""
+        trace = self.parameters['trace_states']
+        self.idle_machine = utils.StateMachine(start_in='idle',
+                                               error_state='idle',
+                                               error_callback=self.log_error_callback,
+                                               trace=trace,
+                                               **self.idle_states())
+        self.sleep_machine = utils.StateMachine(start_in='pre',
+                                                error_state='post',
+                                                error_callback=self.log_error_callback,
+                                                trace=trace,
+                                                pre=self.sleep_pre,
+                                                main=self.sleep_main,
+                                                post=self.sleep_post)
+        self.session_machine = utils.StateMachine(start_in='pre',
+                                                  error_state='post',
+                                                  error_callback=self.log_error_callback,
+                                                  trace=trace,
+                                                  pre=self.session_pre,
+                                                  main=self.session_main,
+                                                  post=self.session_post)
+
+    def idle_states(self):
+        """the states of the idle state machine, by name"""
+        return dict(idle=self._run_idle,
+                    sleep=self._run_sleep,
+                    session=self._run_session)
 
     def _run_idle(self):
         if not self.check_light_schedule():  # If lights should be off
@@ -191,7 +237,7 @@ class BaseExp(object):
         else:
             self.panel_reset()
             self.log.debug('idling...')
-            utils.wait(self.parameters['idle_poll_interval'])
+            self.wait_for_schedule(self.parameters['idle_poll_interval'])
             return 'idle'
 
     # defining functions for sleep
@@ -203,7 +249,7 @@ class BaseExp(object):
         """ reset expal parameters for the next day """
         self.log.debug('sleeping...')
         self.panel.house_light.off()
-        utils.wait(self.parameters['idle_poll_interval'])
+        self.wait_for_schedule()
         if not self.check_light_schedule():
             return 'main'
         else:
@@ -216,12 +262,7 @@ class BaseExp(object):
         return None
 
     def _run_sleep(self):
-        utils.run_state_machine(start_in='pre',
-                                error_state='post',
-                                error_callback=self.log_error_callback,
-                                pre=self.sleep_pre,
-                                main=self.sleep_main,
-                                post=self.sleep_post)
+        self.sleep_machine.run()
         return 'idle'
 
     def pyoperant_close(self):
@@ -245,12 +286,10 @@ class BaseExp(object):
         return None
 
     def _run_session(self):
-        utils.run_state_machine(start_in='pre',
-                                error_state='post',
-                                error_callback=self.log_error_callback,
-                                pre=self.session_pre,
-                                main=self.session_main,
-                                post=self.session_post)
+        self.session_machine.run()
+        if self.session_machine.trace:
+            self.log.info('session states: %s' % self.session_machine.describe())
+            self.session_machine.reset_stats()
         return 'idle'
 
     def init_summary(self):
@@ -6,7 +6,7 @@ import copy
 import datetime as dt
 from pyoperant.behavior import base, shape, adlib
 from pyoperant.errors import EndSession, EndBlock, InterfaceError, ArduinoException
-from pyoperant import utils, reinf, queues, analysis
+from pyoperant import utils, reinf, queues, analysis, hwio, synthesis, timing
 
 # from collections import OrderedDict  # If we want to export json in some sort of ordered way
 
@@ -71,6 +71,21 @@ class GoNoGoInterruptExp(base.BaseExp):
             filename_full = os.path.join(self.parameters['stim_path'], filename)
             self.parameters['stims'][name] = filename_full
 
+        # index the stimuli once, so that trials don't open wav files to get their durations
+        self.stim_index = utils.get_stimulus_index(self.parameters['stim_path'])
+        self.stim_index.update(self.parameters['stims'].values())
+
+        # stimuli built from an element sound and a tempo when a trial needs them, rather than read from a file
+        # (see synthesis.py). Their tempo and pattern are saved with each trial
+        if 'tempo_stims' in self.parameters:
+            self.synthesizer = synthesis.TempoSynthesizer(self.parameters['stim_path'],
+                                                          self.parameters['tempo_stims'],
+                                                          cache_dir=self.parameters.get('tempo_cache_dir'),
+                                                          box=self.parameters['panel_name'],
+                                                          max_renders=self.parameters.get('tempo_max_renders', 256))
+        else:
+            self.synthesizer = None
+
         self.req_panel_attr += ['speaker',
                                 'trialSens',
                                 'respSens',
@@ -96,6 +111,8 @@ class GoNoGoInterruptExp(base.BaseExp):
 
         if 'add_fields_to_save' in self.parameters.keys():
             self.fields_to_save += self.parameters['add_fields_to_save']
+        if self.synthesizer is not None:
+            self.fields_to_save += [field for field in ('tempo', 'pattern') if field not in self.fields_to_save]
 
         self.trials = []
         self.session_id = 0
@@ -149,30 +166,18 @@ class GoNoGoInterruptExp(base.BaseExp):
         # Disconnected devices, at least on Linux, show the
         # behavior that they are always ready to read immediately
         # but reading returns nothing.
-        device_name = self.panel.interfaces['arduino'].device_name
-        # device = self.panel.interfaces['arduino'].device
-        self.log.info('Serial device %s not responding, reconnecting' % device_name)
-        self.panel.interfaces['arduino'].device.close()
+        # The interface stops its reader thread, reopens the device and configures the inputs and outputs again
+        interface = self.panel.interfaces['arduino']
         try:
-            self.panel.interfaces['arduino'].device.open()
+            interface.reconnect_panel()
         except (InterfaceError, ArduinoException):
             self.log.info('First attempt failed, retrying')
             try:
                 utils.wait(0.5)
-                self.panel.interfaces['arduino'].device.open()
+                interface.reconnect_panel()
             except (InterfaceError, ArduinoException):
-                raise InterfaceError('Could not open serial device %s' % device_name)
-
-        # self.log.debug("Waiting for device to open")
-        # device.readline()
-        # device.flushInput()
-        # self.log.info("Successfully reopened device %s" % device_name)
-
-        # Reinitiate the inputs and outputs
-        # for reInput in self.panel.inputs:
-        #     reInput.config()
-        # for reOutput in self.panel.outputs:
-        #     reOutput.config()
+                raise InterfaceError('Could not open serial device %s' % interface.device_name)
+
         # Reconnect sound
         # self.reconnect_audio()
         # audioDevice = self.panel.speaker.interface
@@ -245,14 +250,14 @@ class GoNoGoInterruptExp(base.BaseExp):
         if self.parameters['shape']:
             self.shaper.run_shape()
 
+        self.compile_state_machines()
         while True:  # is this while necessary?
-            utils.run_state_machine(start_in='idle',
-                                    error_state='idle',
-                                    error_callback=self.log_error_callback,
-                                    idle=self._run_idle,
-                                    sleep=self._run_sleep,
-                                    session=self._run_session,
-                                    dayoff=self._run_dayoff)
+            self.idle_machine.run()
+
+    def idle_states(self):  # Overwrite base method to add the ad lib water of days off
+        states = super(GoNoGoInterruptExp, self).idle_states()
+        states['dayoff'] = self._run_dayoff
+        return states
 
     def _run_idle(self):
         if not self.check_light_schedule():
@@ -268,7 +273,7 @@ class GoNoGoInterruptExp(base.BaseExp):
         else:
             self.panel_reset()
             self.log.debug('idling...')
-            utils.wait(self.parameters['idle_poll_interval'])
+            self.wait_for_schedule(self.parameters['idle_poll_interval'])
             return 'idle'
 
     def _run_dayoff(self):
@@ -334,6 +339,34 @@ class GoNoGoInterruptExp(base.BaseExp):
                 self.class_assoc[class_] = getattr(self.panel, class_params['component'])
             except KeyError:
                 pass
+        # wait on and light every response port together
+        self.response_classes = list(self.class_assoc.keys())
+        self.response_ports = [self.class_assoc[class_] for class_ in self.response_classes]
+        self.response_lights = hwio.BooleanOutputGroup([self.class_assoc[class_].LED
+                                                        for class_ in self.response_classes])
+
+        # convert the stimuli to the speaker's format (and level) once, if configured, so that nothing is converted
+        # during a trial. The stimuli keep their names; the speaker plays the converted copies
+        if 'preprocess' in self.parameters:
+            options = dict(self.parameters['preprocess'])
+            cache_dir = options.pop('cache_dir', os.path.join(self.parameters['stim_path'], 'processed'))
+            self.panel.speaker.preprocess(self.parameters['stims'].values(), cache_dir, **options)
+
+        # load every stimulus now so that queueing one for a trial doesn't wait on the disk
+        self.panel.speaker.warm(self.parameters['stims'].values())
+
+        # record continuously from the panel's microphone, if it has one, so that each trial can be saved as a clip,
+        # and/or publish its level next to the summaryDAT for the GUI
+        record = self.parameters.get('record_trials', False)
+        monitor = self.parameters.get('monitor_levels', False)
+        if (record or monitor) and not hasattr(self.panel, 'microphone'):
+            self.log.warning('record_trials and monitor_levels need a microphone, which panel %s does not have'
+                             % self.parameters['panel_name'])
+        elif record or monitor:
+            levels_file = os.path.join(self.parameters['experiment_path'], self.parameters['subject'] + '.levelsDAT')
+            self.try_panel_function(self.panel.microphone.record,
+                                    os.path.join(self.parameters['experiment_path'], 'recordings') if record else None,
+                                    levels_file if monitor else None)
 
         return 'main'
 
@@ -557,6 +590,10 @@ class GoNoGoInterruptExp(base.BaseExp):
 
         trial.session = self.session_id
         trial.annotate(**conditions)
+        if self.synthesizer is not None:
+            # blank for stimuli read from files
+            trial.annotate(tempo=trial.stimulus_event.annotations.get('tempo'),
+                           pattern=trial.stimulus_event.annotations.get('pattern'))
 
         trial.subject = self.parameters['subject']
         trial.block = self.parameters['block_design']['order'][trial.session - 1]
@@ -579,10 +616,15 @@ class GoNoGoInterruptExp(base.BaseExp):
         """
         # TODO: default stimulus selection
         stim_name = conditions['stim_name']
+        if self.synthesizer is not None and stim_name in self.synthesizer:
+            stim = self.synthesizer.stimulus(stim_name)
+            self.log.debug("%s rendered to %s" % (stim_name, stim.file_origin))
+            return stim, []
+
         stim_file = self.parameters['stims'][stim_name]
         self.log.debug(stim_file)
 
-        stim = utils.auditory_stim_from_wav(stim_file)
+        stim = self.stim_index.stimulus(stim_file)
         epochs = []
         return stim, epochs
 
@@ -655,7 +697,7 @@ class GoNoGoInterruptExp(base.BaseExp):
         # this is where we initialize a trial
         # make sure lights are on at the beginning of each trial, prep for trial
         self.log.debug('running trial')
-        self.log.debug("number of open file descriptors: %d" % (utils.get_num_open_fds()))
+        self.log.debug("resources: %s" % self.resources.describe())
 
         self.this_trial = self.trials[-1]
         min_wait = self.parameters['response_delay']  # delay before response allowed defined in json file
@@ -668,12 +710,21 @@ class GoNoGoInterruptExp(base.BaseExp):
 
     def trial_post(self):
         # things to do at the end of a trial
-        self.this_trial.duration = (dt.datetime.now() - self.this_trial.time).total_seconds()
+        self.this_trial.duration = self.trial_clock.elapsed()
+        trial_end = self.trial_clock.datetime(self.this_trial.duration)
+        if self.parameters.get('record_trials', False) and hasattr(self.panel, 'microphone'):
+            # saved in the background once the audio up to the end of the trial has been captured
+            clip_name = '%s_trial%04d_%s.wav' % (self.parameters['subject'], self.this_trial.index,
+                                                 self.this_trial.time.strftime(self.parameters['filetime_fmt']))
+            clip_start = self.trial_clock.datetime(-self.parameters.get('record_pre', 1.0))
+            self.this_trial.annotations['recording'] = self.try_panel_function(self.panel.microphone.save_clip,
+                                                                               clip_start, trial_end, clip_name)
         self.analyze_trial()
         self.save_trial(self.this_trial)
         self.write_summary()
 
-        utils.wait(self.parameters['intertrial_min'])
+        # the intertrial interval runs from the end of the trial, so saving it doesn't lengthen the interval
+        self.trial_clock.wait_until(self.this_trial.duration + self.parameters['intertrial_min'], spin=True)
 
         # # determine if next trial should be a correction trial
         # self.do_correction = True
@@ -732,6 +783,8 @@ class GoNoGoInterruptExp(base.BaseExp):
                 trial_time = self.try_panel_function(self.panel.trialSens.poll, timeout=15.0)
 
         self.this_trial.time = trial_time
+        # every time within the trial is measured from the peck on this clock
+        self.trial_clock = timing.TimeBase(trial_time)
 
         self.try_panel_function(self.panel.trialSens.off)
         # try:
@@ -753,68 +806,71 @@ class GoNoGoInterruptExp(base.BaseExp):
         self.log.info("trial started at %s" % self.this_trial.time.ctime())
 
     def stimulus_main(self):
-        stim_start = dt.datetime.now()
-        self.this_trial.stimulus_event.time = (stim_start - self.this_trial.time).total_seconds()
+        self.this_trial.stimulus_event.time = self.trial_clock.elapsed()
         self.try_panel_function(self.panel.speaker.play)  # already queued in stimulus_pre()
 
     def stimulus_post(self):
         self.log.debug('waiting %s secs...' % self.this_trial.annotations['min_wait'])
-        utils.wait(self.this_trial.annotations['min_wait'])
+        self.trial_clock.wait_until(self.this_trial.stimulus_event.time + self.this_trial.annotations['min_wait'],
+                                    spin=True)
+        # stimulus_event.time is when play() was called; the sound came out onset_latency seconds later
+        onset_latency = self.panel.speaker.onset_latency()
+        if onset_latency is not None:
+            self.this_trial.stimulus_event.annotate(onset_latency=onset_latency)
+            self.log.debug('stimulus onset latency %.4f s' % onset_latency)
 
     # response flow
     def response_pre(self):
-        for class_, port in self.class_assoc.items():
-            self.try_panel_function(port.on)
-            # port.on()
+        self.try_panel_function(self.response_lights.write, True)
         self.log.debug('waiting for response')
 
     def response_main(self):
-        response_start = dt.datetime.now()
-        while True:
-            elapsed_time = (dt.datetime.now() - self.this_trial.time).total_seconds()
-            response_time = elapsed_time - self.this_trial.stimulus_event.time
-            if response_time > self.this_trial.annotations['max_wait']:
-                self.try_panel_function(self.panel.speaker.stop)
-                # self.panel.speaker.stop()
-                self.this_trial.response = 'none'
-                self.log.info('no response')
-                return
-            for class_, port in self.class_assoc.items():
-                try:  # Check that Teensy is still connected, and reconnect if necessary
-                    trial_response = port.status()
-                except (ArduinoException, InterfaceError):  # Trial interrupted by Teensy disconnect, discard trial
-                    self.reconnect_panel()
-                    self.this_trial.rt = (dt.datetime.now() - response_start).total_seconds()
-                    self.try_panel_function(self.panel.speaker.stop)
-                    self.this_trial.response = 'ERR'
-
-                    response_event = utils.Event(name=self.parameters['classes'][class_]['component'],
-                                                 label='error',
-                                                 event_time=elapsed_time,
-                                                 )
-                    self.this_trial.events.append(response_event)
-                    self.log.info('response: %s' % self.this_trial.response)
-                    return
-                else:
-                    if trial_response:
-                        self.this_trial.rt = (dt.datetime.now() - response_start).total_seconds()
-                        self.try_panel_function(self.panel.speaker.stop)
-                        # self.panel.speaker.stop()
-                        self.this_trial.response = class_
-                        self.summary['responses'] += 1
-                        response_event = utils.Event(name=self.parameters['classes'][class_]['component'],
-                                                     label='peck',
-                                                     event_time=elapsed_time,
-                                                     )
-                        self.this_trial.events.append(response_event)
-                        self.log.info('response: %s' % self.this_trial.response)
-                        return
-            utils.wait(.010)
+        # every time is on the trial clock, edge timestamps included, like the stimulus and the peck that started it
+        response_start = self.trial_clock.elapsed()
+        response_time = response_start - self.this_trial.stimulus_event.time
+        try:  # Check that Teensy is still connected, and reconnect if necessary
+            port, responded_at = self.panel.wait_any(self.response_ports,
+                                                     timeout=max(self.this_trial.annotations['max_wait'] -
+                                                                 response_time, 0))
+        except (ArduinoException, InterfaceError):  # Trial interrupted by Teensy disconnect, discard trial
+            self.reconnect_panel()
+            error_time = self.trial_clock.elapsed()
+            self.this_trial.rt = error_time - response_start
+            self.try_panel_function(self.panel.speaker.stop)
+            self.this_trial.response = 'ERR'
+
+            response_event = utils.Event(name=', '.join(self.parameters['classes'][class_]['component']
+                                                        for class_ in self.response_classes),
+                                         label='error',
+                                         event_time=error_time,
+                                         )
+            self.this_trial.events.append(response_event)
+            self.log.info('response: %s' % self.this_trial.response)
+            return
+
+        if port is None:
+            self.try_panel_function(self.panel.speaker.stop)
+            # self.panel.speaker.stop()
+            self.this_trial.response = 'none'
+            self.log.info('no response')
+            return
+
+        class_ = self.response_classes[self.response_ports.index(port)]
+        response_time = self.trial_clock.offset(responded_at)
+        self.this_trial.rt = response_time - response_start
+        self.try_panel_function(self.panel.speaker.stop)
+        # self.panel.speaker.stop()
+        self.this_trial.response = class_
+        self.summary['responses'] += 1
+        response_event = utils.Event(name=self.parameters['classes'][class_]['component'],
+                                     label='peck',
+                                     event_time=response_time,
+                                     )
+        self.this_trial.events.append(response_event)
+        self.log.info('response: %s' % self.this_trial.response)
 
     def response_post(self):
-        for class_, port in self.class_assoc.items():
-            self.try_panel_function(port.off)
-            # port.off()
+        self.try_panel_function(self.response_lights.write, False)
 
     ## consequence flow
     def consequence_pre(self):
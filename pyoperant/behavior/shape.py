@@ -4,6 +4,7 @@ import datetime as dt
 import copy
 from pyoperant import panels
 from pyoperant import utils
+from pyoperant import hwio
 from pyoperant import queues
 
 
@@ -37,6 +38,7 @@ class Shaper(object):
         self.error_callback = error_callback
         self.recent_state = 0
         self.last_response = None
+        self.sleep_machine = None
         self.block1 = self._null_block(1)
         self.block2 = self._null_block(2)
         self.block3 = self._null_block(3)
@@ -228,11 +230,13 @@ class Shaper(object):
         if poll_state is None:
             # If no specific poll function specified, run poll without turning component on/off (like if no light)
             poll_state = self._poll_main
+        # compiled once here, not each time a trial polls
+        machine = utils.StateMachine(start_in='init',
+                                     init=self._polling_init('main'),
+                                     main=poll_state(component, duration))  # loops poll_state until response or timeout
 
         def temp():
-            utils.run_state_machine(start_in='init',
-                                    init=self._polling_init('main'),
-                                    main=poll_state(component, duration))  # loops poll_state until response or timeout
+            machine.run()
             if self.responded_poll:
                 return reward_state
             else:
@@ -248,12 +252,13 @@ class Shaper(object):
         if poll_state is None:
             # If no specific poll function specified, run poll without turning component on/off (like if no light)
             poll_state = self._poll_main
+        machine = utils.StateMachine(start_in='init',
+                                     init=self._polling_init('main'),
+                                     main=poll_state(component1, component2,
+                                                     duration))  # loops poll_state until response or timeout
 
         def temp():
-            utils.run_state_machine(start_in='init',
-                                    init=self._polling_init('main'),
-                                    main=poll_state(component1, component2,
-                                                    duration))  # loops poll_state until response or timeout
+            machine.run()
             if self.responded_poll == 1:
                 return resp_state
             elif self.responded_poll == 2:
@@ -314,19 +319,14 @@ class Shaper(object):
 
         return temp
 
-    # TODO: remake to not hog CPU
     def _poll_main(self, component, duration):
         def temp():
             elapsed_time = (dt.datetime.now() - self.polling_start).total_seconds()
-            if elapsed_time <= duration:
-                if component.status():
-                    self.responded_poll = True
-                    self.last_response = component.name
-                    return None
-                utils.wait(.015)
-                return 'main'
-            else:
-                return None
+            port, responded_at = self.panel.wait_any([component], timeout=max(duration - elapsed_time, 0))
+            if port is not None:
+                self.responded_poll = True
+                self.last_response = component.name
+            return None
 
         return temp
 
@@ -334,16 +334,21 @@ class Shaper(object):
         def temp():
             elapsed_time = (dt.datetime.now() - self.polling_start).total_seconds()
             if elapsed_time <= duration:
-                if ((elapsed_time % period) - (period / 2.0)) < 0:
+                phase = elapsed_time % period
+                if phase < period / 2.0:
                     component.on()
+                    next_toggle = period / 2.0 - phase
                 else:
                     component.off()
-                if component.status():
+                    next_toggle = period - phase
+                # wait until the light is due to toggle, then come back to toggle it
+                port, responded_at = self.panel.wait_any([component],
+                                                         timeout=min(next_toggle, max(duration - elapsed_time, 0)))
+                if port is not None:
                     component.off()
                     self.responded_poll = True
                     self.last_response = component.name
                     return None
-                utils.wait(.015)
                 return 'main'
             else:
                 component.off()
@@ -354,43 +359,35 @@ class Shaper(object):
     def _light_main(self, component, duration):
         def temp():
             elapsed_time = (dt.datetime.now() - self.polling_start).total_seconds()
-            if elapsed_time <= duration:
-                component.on()
-                if component.status():
-                    component.off()
-                    self.responded_poll = True
-                    self.last_response = component.name
-                    return None
-                utils.wait(.015)
-                return 'main'
-            else:
-                component.off()
-                return None
+            component.on()
+            port, responded_at = self.panel.wait_any([component], timeout=max(duration - elapsed_time, 0))
+            component.off()
+            if port is not None:
+                self.responded_poll = True
+                self.last_response = component.name
+            return None
 
         return temp
 
     def _light_dual(self, component1, component2, duration):
+        lights = hwio.BooleanOutputGroup([component1.LED, component2.LED])
+
         def temp():
             elapsed_time = (dt.datetime.now() - self.polling_start).total_seconds()
-            if elapsed_time <= duration:
-                component1.on()
-                component2.on()
-                if component1.status():
-                    component1.off()
-                    self.responded_poll = 1
-                    self.last_response = component1.name
-                    return None
-                if component2.status():
-                    component2.off()
-                    self.responded_poll = 2
-                    self.last_response = component2.name
-                    return None
-                utils.wait(.015)
-                return 'main'
-            else:
+            lights.write(True)
+            port, responded_at = self.panel.wait_any([component1, component2],
+                                                     timeout=max(duration - elapsed_time, 0))
+            if port is component1:
                 component1.off()
+                self.responded_poll = 1
+                self.last_response = component1.name
+            elif port is component2:
                 component2.off()
-                return None
+                self.responded_poll = 2
+                self.last_response = component2.name
+            else:
+                lights.write(False)
+            return None
 
         return temp
 
@@ -426,7 +423,7 @@ class Shaper(object):
         """ reset expal parameters for the next day """
         self.log.debug('sleeping...')
         self.panel.house_light.off()
-        utils.wait(self.parameters['idle_poll_interval'])
+        utils.wait_for_transition([utils.get_schedule(self.parameters['light_schedule'])])
         if not utils.check_time(self.parameters['light_schedule']):
             return 'main'
         else:
@@ -439,12 +436,14 @@ class Shaper(object):
         return None
 
     def _run_sleep(self):
-        utils.run_state_machine(start_in='pre',
-                                error_state='post',
-                                error_callback=self.error_callback,
-                                pre=self.sleep_pre,
-                                main=self.sleep_main,
-                                post=self.sleep_post)
+        if self.sleep_machine is None:
+            self.sleep_machine = utils.StateMachine(start_in='pre',
+                                                    error_state='post',
+                                                    error_callback=self.error_callback,
+                                                    pre=self.sleep_pre,
+                                                    main=self.sleep_main,
+                                                    post=self.sleep_post)
+        self.sleep_machine.run()
         return self.block_name(self.recent_state)
 
     def block_name(self, block_num):
@@ -1335,7 +1334,7 @@ class ShaperGoNogoInterruptMisc(Shaper):
         stim_file = self.parameters['stims'][stim_name]
         self.log.debug(stim_file)
 
-        stim = utils.auditory_stim_from_wav(stim_file)
+        stim = utils.get_stimulus_index(self.parameters['stim_path']).stimulus(stim_file)
         epochs = []
         return stim, epochs
 
@@ -17,6 +17,13 @@ class ThreeACMatchingExp(two_alt_choice.TwoAltChoiceExp):
 
         self.shaper = shape.Shaper3ACMatching(self.panel, self.log, self.parameters, self.get_stimuli, self.log_error_callback)
         self.num_stims = len(self.parameters['stims'].items())
+        # stimulus name of each motif file, to name the epochs returned by concat_wav
+        self.stim_names = dict((f_name, stim_name) for stim_name, f_name in self.parameters['stims'].items())
+        # concat_wav needs every motif in the same format, so check that now rather than during a trial
+        formats = set((info['nchannels'], info['sampwidth'], info['framerate'])
+                      for info in (self.stim_index.info(f_name) for f_name in self.stim_names))
+        if len(formats) > 1:
+            raise ValueError('motifs must have the same channels, sample width and rate, found %s' % sorted(formats))
 
     def get_stimuli(self, trial_class):
         """ take trial class and return a tuple containing the stimulus event to play and a list of additional events
@@ -39,12 +46,12 @@ class ThreeACMatchingExp(two_alt_choice.TwoAltChoiceExp):
 
         input_files = zip(motif_files, motif_isi)
         filename = os.path.join(self.parameters['stim_path'], ''.join(motif_names) + '.wav')
-        stim, epochs = utils.concat_wav(input_files, filename)
+        # isi_resolution (s) rounds the gaps so that sequences repeat and concat_wav can reuse them
+        stim, epochs = utils.concat_wav(input_files, filename,
+                                        isi_resolution=self.parameters.get('isi_resolution', None))
 
         for ep in epochs:
-            for stim_name, f_name in self.parameters['stims'].items():
-                if ep.name in f_name:
-                    ep.name = stim_name
+            ep.name = self.stim_names.get(ep.name, ep.name)
 
         return stim, epochs
 
@@ -1,10 +1,9 @@
 import os
 import csv
 import copy
-import datetime as dt
 from pyoperant.behavior import base, shape
 from pyoperant.errors import EndSession, EndBlock
-from pyoperant import components, utils, reinf, queues
+from pyoperant import components, utils, reinf, queues, timing
 
 
 class TwoAltChoiceExp(base.BaseExp):
@@ -44,6 +43,10 @@ class TwoAltChoiceExp(base.BaseExp):
             filename_full = os.path.join(self.parameters['stim_path'], filename)
             self.parameters['stims'][name] = filename_full
 
+        # index the stimuli once, so that trials don't open wav files to get their durations
+        self.stim_index = utils.get_stimulus_index(self.parameters['stim_path'])
+        self.stim_index.update(self.parameters['stims'].values())
+
         self.req_panel_attr += ['speaker',
                                 'left',
                                 'center',
@@ -148,6 +151,16 @@ class TwoAltChoiceExp(base.BaseExp):
             except KeyError:
                 pass
 
+        # convert the stimuli to the speaker's format (and level) once, if configured, so that nothing is converted
+        # during a trial. The stimuli keep their names; the speaker plays the converted copies
+        if 'preprocess' in self.parameters:
+            options = dict(self.parameters['preprocess'])
+            cache_dir = options.pop('cache_dir', os.path.join(self.parameters['stim_path'], 'processed'))
+            self.panel.speaker.preprocess(self.parameters['stims'].values(), cache_dir, **options)
+
+        # load every stimulus now so that queueing one for a trial doesn't wait on the disk
+        self.panel.speaker.warm(self.parameters['stims'].values())
+
         return 'main'
 
     def session_main(self):
@@ -288,7 +301,7 @@ class TwoAltChoiceExp(base.BaseExp):
         stim_file = self.parameters['stims'][stim_name]
         self.log.debug(stim_file)
 
-        stim = utils.auditory_stim_from_wav(stim_file)
+        stim = self.stim_index.stimulus(stim_file)
         epochs = []
         return stim, epochs
 
@@ -331,7 +344,7 @@ class TwoAltChoiceExp(base.BaseExp):
         """ this is where we initialize a trial"""
         # make sure lights are on at the beginning of each trial, prep for trial
         self.log.debug('running trial')
-        self.log.debug("number of open file descriptors: %d" % (utils.get_num_open_fds()))
+        self.log.debug("resources: %s" % self.resources.describe())
 
         self.this_trial = self.trials[-1]
         min_wait = self.this_trial.stimulus_event.duration
@@ -343,11 +356,12 @@ class TwoAltChoiceExp(base.BaseExp):
 
     def trial_post(self):
         '''things to do at the end of a trial'''
-        self.this_trial.duration = (dt.datetime.now() - self.this_trial.time).total_seconds()
+        self.this_trial.duration = self.trial_clock.elapsed()
         self.analyze_trial()
         self.save_trial(self.this_trial)
         self.write_summary()
-        utils.wait(self.parameters['intertrial_min'])
+        # the intertrial interval runs from the end of the trial, so saving it doesn't lengthen the interval
+        self.trial_clock.wait_until(self.this_trial.duration + self.parameters['intertrial_min'], spin=True)
 
         # determine if next trial should be a correction trial
         self.do_correction = True
@@ -384,6 +398,8 @@ class TwoAltChoiceExp(base.BaseExp):
                 trial_time = self.panel.center.poll(timeout=60.0)
 
         self.this_trial.time = trial_time
+        # every time within the trial is measured from the peck on this clock
+        self.trial_clock = timing.TimeBase(trial_time)
 
         self.panel.center.off()
         self.this_trial.events.append(utils.Event(name='center',
@@ -402,33 +418,37 @@ class TwoAltChoiceExp(base.BaseExp):
         if 'cue' in self.this_trial.annotations:
             cue = self.this_trial.annotations["cue"]
             self.log.debug("cue light turning on")
-            cue_start = dt.datetime.now()
+            cue_time = self.trial_clock.elapsed()
             if cue == "red":
                 self.panel.cue.red()
             elif cue == "green":
                 self.panel.cue.green()
             elif cue == "blue":
                 self.panel.cue.blue()
-            utils.wait(self.parameters["cue_duration"])
+            self.trial_clock.wait_until(cue_time + self.parameters["cue_duration"], spin=True)
             self.panel.cue.off()
-            cue_dur = (dt.datetime.now() - cue_start).total_seconds()
-            cue_time = (cue_start - self.this_trial.time).total_seconds()
+            cue_dur = self.trial_clock.elapsed() - cue_time
             cue_event = utils.Event(event_time=cue_time,
                                     duration=cue_dur,
                                     label='cue',
                                     name=cue,
                                     )
             self.this_trial.events.append(cue_event)
-            utils.wait(self.parameters["cuetostim_wait"])
+            self.trial_clock.wait_until(cue_time + cue_dur + self.parameters["cuetostim_wait"], spin=True)
 
         ## 2. play stimulus
-        stim_start = dt.datetime.now()
-        self.this_trial.stimulus_event.time = (stim_start - self.this_trial.time).total_seconds()
+        self.this_trial.stimulus_event.time = self.trial_clock.elapsed()
         self.panel.speaker.play()  # already queued in stimulus_pre()
 
     def stimulus_post(self):
         self.log.debug('waiting %s secs...' % self.this_trial.annotations['min_wait'])
-        utils.wait(self.this_trial.annotations['min_wait'])
+        self.trial_clock.wait_until(self.this_trial.stimulus_event.time + self.this_trial.annotations['min_wait'],
+                                    spin=True)
+        # stimulus_event.time is when play() was called; the sound came out onset_latency seconds later
+        onset_latency = self.panel.speaker.onset_latency()
+        if onset_latency is not None:
+            self.this_trial.stimulus_event.annotate(onset_latency=onset_latency)
+            self.log.debug('stimulus onset latency %.4f s' % onset_latency)
 
     # response flow
     def response_pre(self):
@@ -437,29 +457,31 @@ class TwoAltChoiceExp(base.BaseExp):
         self.log.debug('waiting for response')
 
     def response_main(self):
-        response_start = dt.datetime.now()
-        while True:
-            elapsed_time = (dt.datetime.now() - self.this_trial.time).total_seconds()
-            response_time = elapsed_time - self.this_trial.stimulus_event.time
-            if response_time > self.this_trial.annotations['max_wait']:
-                self.panel.speaker.stop()
-                self.this_trial.response = 'none'
-                self.log.info('no response')
-                return
-            for class_, port in self.class_assoc.items():
-                if port.status():
-                    self.this_trial.rt = (dt.datetime.now() - response_start).total_seconds()
-                    self.panel.speaker.stop()
-                    self.this_trial.response = class_
-                    self.summary['responses'] += 1
-                    response_event = utils.Event(name=self.parameters['classes'][class_]['component'],
-                                                 label='peck',
-                                                 event_time=elapsed_time,
-                                                 )
-                    self.this_trial.events.append(response_event)
-                    self.log.info('response: %s' % self.this_trial.response)
-                    return
-            utils.wait(.015)
+        # every time is on the trial clock, edge timestamps included, like the stimulus and the peck that started it
+        response_start = self.trial_clock.elapsed()
+        response_time = response_start - self.this_trial.stimulus_event.time
+        classes = list(self.class_assoc.keys())
+        ports = [self.class_assoc[class_] for class_ in classes]
+        port, responded_at = self.panel.wait_any(ports, timeout=max(self.this_trial.annotations['max_wait'] -
+                                                                    response_time, 0))
+        if port is None:
+            self.panel.speaker.stop()
+            self.this_trial.response = 'none'
+            self.log.info('no response')
+            return
+
+        class_ = classes[ports.index(port)]
+        response_time = self.trial_clock.offset(responded_at)
+        self.this_trial.rt = response_time - response_start
+        self.panel.speaker.stop()
+        self.this_trial.response = class_
+        self.summary['responses'] += 1
+        response_event = utils.Event(name=self.parameters['classes'][class_]['component'],
+                                     label='peck',
+                                     event_time=response_time,
+                                     )
+        self.this_trial.events.append(response_event)
+        self.log.info('response: %s' % self.this_trial.response)
 
     def response_post(self):
         for class_, port in self.class_assoc.items():
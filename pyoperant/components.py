@@ -1,7 +1,7 @@
 ## Last Modified: 1/17/18 (AR) Added LED indicator, water reinforcement classes
 
 import datetime
-from pyoperant import hwio, utils, ComponentError, InterfaceError, ArduinoException
+from pyoperant import hwio, timing, ComponentError, InterfaceError, ArduinoException
 
 
 class BaseComponent(object):
@@ -73,6 +73,7 @@ class Hopper(BaseComponent):
             self.solenoid = solenoid
         else:
             raise ValueError('%s is not an output channel' % solenoid)
+        self._status = hwio.BooleanInputGroup([self.IR, self.solenoid])
 
     def check(self):
         """reads the status of solenoid & IR beam, then throws an error if they don't match
@@ -90,8 +91,7 @@ class Hopper(BaseComponent):
             The Hopper is down and it shouldn't be. (The IR beam is not tripped, but the solenoid is active.)
 
         """
-        IR_status = self.IR.read()
-        solenoid_status = self.solenoid.read()
+        IR_status, solenoid_status = self._status.read()
         if IR_status != solenoid_status:
             if IR_status:
                 raise HopperActiveError
@@ -102,9 +102,15 @@ class Hopper(BaseComponent):
         else:
             return IR_status
 
-    def up(self):
+    def up(self, dur=None):
         """Raises the hopper up.
 
+        Parameters
+        ----------
+        dur : float, optional
+            If given, the solenoid is pulsed for *dur* seconds, timed by the device when the interface supports it,
+            so the hopper drops on its own. Otherwise it stays up until `down()`.
+
         Returns
         -------
         bool
@@ -116,7 +122,10 @@ class Hopper(BaseComponent):
             The Hopper did not raise.
         """
 
-        self.solenoid.write(True)
+        if dur is None:
+            self.solenoid.write(True)
+        else:
+            self.solenoid.pulse(dur, wait=False)
         time_up = self.IR.poll(timeout=self.max_lag)
 
         if time_up is None:  # poll timed out
@@ -140,7 +149,7 @@ class Hopper(BaseComponent):
         """
         self.solenoid.write(False)
         time_down = datetime.datetime.now()
-        utils.wait(self.max_lag)
+        timing.wait(self.max_lag)
         try:
             self.check()
         except HopperActiveError as e:
@@ -180,10 +189,12 @@ class Hopper(BaseComponent):
         except HopperActiveError as e:
             self.solenoid.write(False)
             raise HopperAlreadyUpError(e)
-        feed_time = self.up()
-        utils.wait(dur)
-        feed_over = self.down()
-        feed_duration = feed_over - feed_time
+        # the feed lasts dur from when the solenoid opened, not from when the IR beam saw the hopper come up
+        clock = timing.TimeBase()
+        feed_time = self.up(dur=dur)
+        clock.wait_until(dur)
+        feed_duration = datetime.timedelta(seconds=clock.elapsed())
+        self.down()
         return feed_time, feed_duration
 
     def reward(self, value=2.0):
@@ -260,6 +271,7 @@ class PeckPort(BaseComponent):
 
     def flash(self, dur=1.0, isi=0.1):
         """Flashes the LED on and off with *isi* seconds high and low for *dur* seconds, then revert LED to prior state.
+        The flash is timed by the device when the interface supports it.
 
         Parameters
         ----------
@@ -273,15 +285,10 @@ class PeckPort(BaseComponent):
         (datetime, float)
             Timestamp of the flash and the flash duration
         """
-        LED_state = self.LED.read()
-        flash_time = datetime.datetime.now()
-        flash_duration = datetime.datetime.now() - flash_time
-        while flash_duration < datetime.timedelta(seconds=dur):
-            self.LED.toggle()
-            utils.wait(isi)
-            flash_duration = datetime.datetime.now() - flash_time
-        self.LED.write(LED_state)
-        return flash_time, flash_duration
+        clock = timing.TimeBase()
+        self.LED.blink(period=2 * isi, dur=dur)
+        flash_duration = datetime.timedelta(seconds=clock.elapsed())
+        return clock.start_datetime, flash_duration
 
     def poll(self, timeout=None):
         """ Polls the peck port until there is a peck
@@ -369,13 +376,14 @@ class HouseLight(BaseComponent):
             Timestamp of the timeout and the timeout duration
 
         """
-        timeout_time = datetime.datetime.now()
+        clock = timing.TimeBase()
+        timeout_time = clock.start_datetime
         if self.inverted:
             self.light.write(True)
         else:
             self.light.write(False)
-        utils.wait(dur)
-        timeout_duration = datetime.datetime.now() - timeout_time
+        clock.wait_until(dur)
+        timeout_duration = datetime.timedelta(seconds=clock.elapsed())
         if self.inverted:
             self.light.write(False)
         else:
@@ -417,6 +425,7 @@ class RGBLight(BaseComponent):
             self._blue = blue
         else:
             raise ValueError('%s is not an output channel' % blue)
+        self._leds = hwio.BooleanOutputGroup([self._red, self._green, self._blue])
 
     def red(self):
         """Turns the cue light to red
@@ -426,9 +435,7 @@ class RGBLight(BaseComponent):
         bool
             `True` if successful.
         """
-        self._green.write(False)
-        self._blue.write(False)
-        return self._red.write(True)
+        return self._leds.write([True, False, False])[0]
 
     def green(self):
         """Turns the cue light to green
@@ -438,9 +445,7 @@ class RGBLight(BaseComponent):
         bool
             `True` if successful.
         """
-        self._red.write(False)
-        self._blue.write(False)
-        return self._green.write(True)
+        return self._leds.write([False, True, False])[1]
 
     def blue(self):
         """Turns the cue light to blue
@@ -450,9 +455,7 @@ class RGBLight(BaseComponent):
         bool
             `True` if successful.
         """
-        self._red.write(False)
-        self._green.write(False)
-        return self._blue.write(True)
+        return self._leds.write([False, False, True])[2]
 
     def off(self):
         """Turns the cue light off
@@ -462,9 +465,7 @@ class RGBLight(BaseComponent):
         bool
             `True` if successful.
         """
-        self._red.write(False)
-        self._green.write(False)
-        self._blue.write(False)
+        self._leds.write(False)
         return True
 
 
@@ -535,13 +536,17 @@ class WaterValve(BaseComponent):
 
         return time_down
 
-    def feed(self, dur=0.2):
+    def feed(self, dur=0.2, wait=True):
         """Performs a feed
 
+        The valve is pulsed for *dur* seconds, timed by the device when the interface supports it.
+
         Parameters
         ---------
         dur : float, optional
             duration of feed in seconds
+        wait : bool, optional
+            return once the feed is over. If False, return as soon as the valve opens
 
         Returns
         -------
@@ -552,10 +557,13 @@ class WaterValve(BaseComponent):
 
         """
 
-        feed_time = self.on()
-        utils.wait(dur)
-        feed_over = self.off()
-        feed_duration = feed_over - feed_time
+        clock = timing.TimeBase()
+        feed_time = clock.start_datetime
+        self.solenoid.pulse(dur, wait=wait)
+        if wait:
+            feed_duration = datetime.timedelta(seconds=clock.elapsed())
+        else:
+            feed_duration = datetime.timedelta(seconds=dur)
         return feed_time, feed_duration
 
     def reward(self, value=0.2):
@@ -1,5 +1,51 @@
 
 # Classes of operant components
+import datetime
+import threading
+import collections
+from pyoperant import utils, timing
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+def _batch_by_interface(ios, method):
+    """groups ios whose interface has `method` by interface and by any params other than 'channel'
+
+    returns a list of (interface, shared_params, indices, channels) tuples, where indices are the positions of the
+    grouped ios in `ios`
+    """
+    batches = {}
+    order = []
+    for index, io in enumerate(ios):
+        if not hasattr(io.interface, method) or 'channel' not in io.params:
+            continue
+        shared = tuple(sorted((k, v) for k, v in io.params.items() if k != 'channel'))
+        key = (id(io.interface), shared)
+        if key not in batches:
+            batches[key] = (io.interface, dict(shared), [], [])
+            order.append(key)
+        batches[key][2].append(index)
+        batches[key][3].append(io.params['channel'])
+    return [batches[key] for key in order]
+
+
+def _wait_for(waiter, timeout=None):
+    """get the next item from the queue waiter, or None after timeout seconds"""
+    # Queue.get(timeout=...) sleeps in short steps on python 2 while it waits, so block without a timeout and have a
+    # timer wake us up instead
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, waiter.put, [None])
+        timer.daemon = True
+        timer.start()
+    try:
+        return waiter.get()
+    finally:
+        if timer is not None:
+            timer.cancel()
 
 
 class BaseIO(object):
@@ -13,19 +59,49 @@ class BooleanInput(BaseIO):
     """Class which holds information about inputs and abstracts the methods of
     querying their values
 
+    Every value read from the input goes through feed(), which keeps the
+    recent rising and falling edges of the input in a ring buffer. Interfaces
+    that push edges as they happen (those with a '_subscribe_edges' method
+    that accepts the input) feed it directly, otherwise edges are found by
+    reading the input.
+
     Keyword arguments:
     interface -- Interface() instance. Must have '_read_bool' method.
     params -- dictionary of keyword:value pairs needed by the interface
+    debounce -- changes within this many seconds of the last edge are held
+        back until the window is over, and dropped if the input changes back
+        before then
+    edge_buffer -- the number of edges to keep
+    poll_interval -- the time, in seconds, between reads while waiting for an
+        edge on an input whose edges aren't pushed
 
     Methods:
     read() -- reads value of the input. Returns a boolean
     poll() -- polls the input until value is True. Returns the time of the change
+    feed(value, timestamp) -- records a value of the input. Returns True if it
+        is an edge
+    edges_since(t) -- returns the edges after datetime t as a list of
+        (timestamp, value) tuples, oldest first
+    wait_edge(timeout, value) -- waits for the next edge, or the next edge to
+        value if given. Returns (timestamp, value) or None if it times out
     """
-    def __init__(self, interface=None, params={}, *args, **kwargs):
+    def __init__(self, interface=None, params={}, debounce=0.0, edge_buffer=256, poll_interval=0.01, *args,
+                 **kwargs):
         super(BooleanInput, self).__init__(interface=interface, params=params, *args, **kwargs)
 
         assert hasattr(self.interface, '_read_bool')
+        self.debounce = datetime.timedelta(seconds=debounce)
+        self.poll_interval = poll_interval
+        self.edges = collections.deque(maxlen=edge_buffer)
+        self.value = None
+        self._pending = None  # (value, timestamp) of a change held back by the debounce window
+        self._settle_timer = None
+        self._edge_lock = threading.Lock()
+        self._edge_waiters = []
         self.config()
+        self.pushed = False
+        if hasattr(self.interface, '_subscribe_edges'):
+            self.pushed = self.interface._subscribe_edges(self.feed, **self.params)
 
     def config(self):
         try:
@@ -35,11 +111,146 @@ class BooleanInput(BaseIO):
 
     def read(self):
         """read status"""
-        return self.interface._read_bool(**self.params)
+        value = self.interface._read_bool(**self.params)
+        self.feed(value)
+        return value
 
     def poll(self, timeout=None):
         """ runs a loop, querying for pecks. returns peck time or "GoodNite" exception """
-        return self.interface._poll(timeout=timeout, **self.params)
+        timestamp = self.interface._poll(timeout=timeout, **self.params)
+        if timestamp is not None:
+            self.feed(True, timestamp)
+        return timestamp
+
+    def feed(self, value, timestamp=None):
+        """record a value of the input, taken at timestamp (defaults to now)
+
+        A change of value is an edge unless it comes within the debounce
+        window of the last edge. Then it is held back until the window is
+        over, and becomes an edge at its own timestamp if the input hasn't
+        changed back by then. The first value recorded isn't an edge, since the
+        value before it is unknown.
+        """
+        if value is None:
+            return False
+        if timestamp is None:
+            timestamp = datetime.datetime.now()
+        value = bool(value)
+        with self._edge_lock:
+            if self.value is None:
+                self.value = value
+                return False
+            if value == self.value:
+                self._pending = None  # bounced back before the window was over
+                return False
+            if len(self.edges) > 0 and timestamp - self.edges[-1][0] < self.debounce:
+                self._pending = (value, timestamp)
+                if self._settle_timer is None:
+                    remaining = self.edges[-1][0] + self.debounce - datetime.datetime.now()
+                    self._settle_timer = threading.Timer(max(remaining.total_seconds(), 0.0), self._settle)
+                    self._settle_timer.daemon = True
+                    self._settle_timer.start()
+                return False
+            waiters = self._record_edge(value, timestamp)
+        self._notify(waiters, (timestamp, value))
+        return True
+
+    def _settle(self):
+        """at the end of the debounce window, make the change held back during it an edge, if it still stands"""
+        with self._edge_lock:
+            self._settle_timer = None
+            if self._pending is None:
+                return
+            value, timestamp = self._pending
+            waiters = self._record_edge(value, timestamp)
+        self._notify(waiters, (timestamp, value))
+
+    def _record_edge(self, value, timestamp):
+        """record an edge and return the waiters it wakes. Call with _edge_lock held"""
+        self._pending = None
+        self.value = value
+        self.edges.append((timestamp, value))
+        waiters = self._edge_waiters
+        self._edge_waiters = [(waiter, wanted) for waiter, wanted in waiters
+                              if wanted is not None and wanted != value]
+        return [waiter for waiter, wanted in waiters if wanted is None or wanted == value]
+
+    def _notify(self, waiters, edge):
+        for waiter in waiters:
+            waiter.put((self, edge))
+
+    def _add_edge_waiter(self, waiter, value=None):
+        """have the next edge, or the next edge to value, put on the queue
+        waiter as (input, (timestamp, value)). Several inputs can share a
+        queue
+        """
+        with self._edge_lock:
+            self._edge_waiters.append((waiter, value))
+
+    def _remove_edge_waiter(self, waiter):
+        with self._edge_lock:
+            self._edge_waiters = [item for item in self._edge_waiters if item[0] is not waiter]
+
+    def edges_since(self, t):
+        """the edges after datetime t, oldest first"""
+        with self._edge_lock:
+            return [edge for edge in self.edges if edge[0] > t]
+
+    def wait_edge(self, timeout=None, value=None):
+        """wait for the next edge of the input
+
+        value -- if True or False, wait for the next edge to that value
+        """
+        waiter = queue.Queue()
+        self._add_edge_waiter(waiter, value)
+        try:
+            if self.pushed:
+                item = _wait_for(waiter, timeout)
+                return None if item is None else item[1]
+
+            start = timing.monotonic()
+            while True:
+                self.read()
+                if not waiter.empty():
+                    return waiter.get_nowait()[1]
+                if timeout is not None and timing.monotonic() - start >= timeout:
+                    return None
+                utils.wait(self.poll_interval)
+        finally:
+            self._remove_edge_waiter(waiter)
+
+
+class BooleanInputGroup(object):
+    """Class which holds several inputs so that they can be sampled together
+
+    Inputs that share an interface with a '_read_many' method are read with a
+    single request to that interface. All other inputs are read one at a time.
+
+    Keyword arguments:
+    inputs -- list of BooleanInput() instances. BooleanOutput() instances may
+        also be included to read back the state of an output
+
+    Methods:
+    read() -- reads the value of every input. Returns a list of booleans in the
+        same order as inputs
+    """
+    def __init__(self, inputs=(), *args, **kwargs):
+        super(BooleanInputGroup, self).__init__()
+        self.inputs = list(inputs)
+        self._batches = _batch_by_interface(self.inputs, '_read_many')
+
+    def read(self):
+        """read status of every input"""
+        values = [None] * len(self.inputs)
+        for interface, shared, indices, channels in self._batches:
+            for index, value in zip(indices, interface._read_many(channels=channels, **shared)):
+                values[index] = value
+                if hasattr(self.inputs[index], 'feed'):
+                    self.inputs[index].feed(value)
+        for index, io in enumerate(self.inputs):
+            if values[index] is None:
+                values[index] = io.read()
+        return values
 
 
 class BooleanOutput(BaseIO):
@@ -56,12 +267,18 @@ class BooleanOutput(BaseIO):
         the current value of the output from the interface. Otherwise this
         returns the last passed by write(value)
     toggle() -- flips the value from the current value
+    pulse(dur) -- turns the output on for dur seconds. Timed by the device if
+        the interface has a '_pulse_bool' method, otherwise timed here
+    blink(period, dur) -- toggles the output every half period for dur
+        seconds, then restores it. Timed by the device if the interface has a
+        '_blink_bool' method, otherwise timed here
     """
     def __init__(self, interface=None, params={}, *args, **kwargs):
         super(BooleanOutput, self).__init__(interface=interface, params=params, *args, **kwargs)
 
         assert hasattr(self.interface, '_write_bool')
         self.last_value = None
+        self._pulse = None  # token of the device timed pulse in progress
         self.config()
 
     def config(self):
@@ -79,6 +296,7 @@ class BooleanOutput(BaseIO):
 
     def write(self, value=False):
         """write status"""
+        self._pulse = None
         self.last_value = self.interface._write_bool(value=value, **self.params)
         return self.last_value
 
@@ -86,6 +304,113 @@ class BooleanOutput(BaseIO):
         value = not self.read()
         return self.write(value=value)
 
+    def pulse(self, dur, wait=True):
+        """turn the output on for dur seconds, then off
+
+        wait -- if True, return once the pulse is over. Otherwise return as
+            soon as it has started
+        """
+        if hasattr(self.interface, '_pulse_bool'):
+            self.interface._pulse_bool(duration=dur, **self.params)
+            # the device turns the output off by itself, so last_value follows it once the pulse is over, unless the
+            # output has been written since
+            self.last_value = True
+            self._pulse = pulse = object()
+
+            def pulse_over():
+                if self._pulse is pulse:
+                    self.last_value = False
+                    self._pulse = None
+
+            if wait:
+                utils.wait(dur)
+                pulse_over()
+            else:
+                timer = threading.Timer(dur, pulse_over)
+                timer.daemon = True
+                timer.start()
+        elif wait:
+            self.write(True)
+            utils.wait(dur)
+            self.write(False)
+        else:
+            self.write(True)
+            timer = threading.Timer(dur, self.write, kwargs={'value': False})
+            timer.daemon = True
+            timer.start()
+        return True
+
+    def blink(self, period, dur, wait=True):
+        """toggle the output every half period for dur seconds, then return it
+        to the value it had before
+
+        wait -- if True, return once the blink is over. Otherwise return as
+            soon as it has started
+        """
+        if hasattr(self.interface, '_blink_bool'):
+            self.interface._blink_bool(period=period, duration=dur, **self.params)
+            if wait:
+                utils.wait(dur)
+        elif wait:
+            self._blink(period, dur)
+        else:
+            thread = threading.Thread(target=self._blink, args=(period, dur))
+            thread.daemon = True
+            thread.start()
+        return True
+
+    def _blink(self, period, dur):
+        """blink timed by the host, toggling on a fixed grid of deadlines so that the time toggling takes doesn't add up
+        """
+        state = self.read()
+        start = timing.monotonic()
+        toggles = 0
+        while toggles * period / 2.0 < dur:
+            self.toggle()
+            toggles += 1
+            timing.wait_until(start + min(toggles * period / 2.0, dur))
+        self.write(state)
+
+
+class BooleanOutputGroup(object):
+    """Class which holds several outputs so that they can be written together
+
+    Outputs that share an interface with a '_write_many' method are written
+    with a single message to that interface, so they all switch at the same
+    time. All other outputs are written one at a time.
+
+    Keyword arguments:
+    outputs -- list of BooleanOutput() instances
+
+    Methods:
+    write(values) -- writes a value to each output. values is either a list
+        with one value per output or a single value for all of them. Returns
+        the list of values written
+    """
+    def __init__(self, outputs=(), *args, **kwargs):
+        super(BooleanOutputGroup, self).__init__()
+        self.outputs = list(outputs)
+        self._batches = _batch_by_interface(self.outputs, '_write_many')
+
+    def write(self, values=False):
+        """write status of every output"""
+        if isinstance(values, (list, tuple)):
+            assert len(values) == len(self.outputs)
+            values = list(values)
+        else:
+            values = [values] * len(self.outputs)
+
+        written = [False] * len(self.outputs)
+        for interface, shared, indices, channels in self._batches:
+            results = interface._write_many(channels=channels, values=[values[i] for i in indices], **shared)
+            for index, result in zip(indices, results):
+                self.outputs[index].last_value = result
+                written[index] = True
+        for index, output in enumerate(self.outputs):
+            if not written[index]:
+                output.write(value=values[index])
+        return [output.last_value for output in self.outputs]
+
 
 class AudioOutput(BaseIO):
     """Class which holds information about audio outputs and abstracts the
@@ -98,6 +423,14 @@ class AudioOutput(BaseIO):
 
     Methods:
     queue(wav_filename) -- queues
+    warm(wav_filenames) -- if the interface supports '_warm_wavs', has it
+        load the files ahead of time so that queueing them is quicker
+    preprocess(wav_filenames, cache_dir, **kwargs) -- if the interface
+        supports '_preprocess_wavs', has it convert the files to the format
+        of the device ahead of time, then play the converted files
+    onset_latency() -- if the interface supports '_onset_latency', returns
+        the seconds from play() to the sound reaching the device output.
+        Otherwise returns None
     read() -- if the interface supports '_read_bool' for this output, returns
         the current value of the output from the interface. Otherwise this
         returns the last passed by write(value)
@@ -113,42 +446,70 @@ class AudioOutput(BaseIO):
     def queue(self, wav_filename):
         return self.interface._queue_wav(wav_filename)
 
+    def warm(self, wav_filenames):
+        if hasattr(self.interface, '_warm_wavs'):
+            return self.interface._warm_wavs(wav_filenames)
+        return False
+
+    def preprocess(self, wav_filenames, cache_dir, **kwargs):
+        if hasattr(self.interface, '_preprocess_wavs'):
+            return self.interface._preprocess_wavs(wav_filenames, cache_dir, **kwargs)
+        return False
+
     def play(self):
         return self.interface._play_wav()
 
+    def onset_latency(self):
+        if hasattr(self.interface, '_onset_latency'):
+            return self.interface._onset_latency()
+        return None
+
     def stop(self):
         return self.interface._stop_wav()
 
 
 class AudioInput(BaseIO):
     """Class which holds information about audio inputs and abstracts the
-    methods of writing to them
+    methods of recording from them
 
     Keyword arguments:
-    interface -- Interface() instance. Must have the methods '_queue_wav',
-        '_play_wav', '_stop_wav'
+    interface -- Interface() instance. Must have the methods
+        '_start_recording', '_stop_recording', '_record_clip'
     params -- dictionary of keyword:value pairs needed by the interface
 
     Methods:
-    queue(wav_filename) -- queues
-    read() -- if the interface supports '_read_bool' for this output, returns
-        the current value of the output from the interface. Otherwise this
-        returns the last passed by write(value)
-    toggle() -- flips the value from the current value
+    record(directory, levels_file, **kwargs) -- starts recording
+        continuously, writing the audio to files in directory in the
+        background (unless directory is None). With a levels_file, the
+        level of the input is measured and published there. kwargs go to
+        the interface, e.g. chunk_seconds
+    levels(seconds) -- summary of the level of the last seconds of input
+    clip(start, end) -- returns the audio recorded between two times
+        (datetimes, like trial times, or time.time() values)
+    save_clip(start, end, filename) -- saves the audio between two times to
+        a wav file in the background, once it has been recorded, and returns
+        the path of the file
+    stop() -- stops recording
     """
 
     def __init__(self, interface=None, params={}, *args, **kwargs):
         super(AudioInput, self).__init__(interface=interface, params=params, *args, **kwargs)
 
-        assert hasattr(self.interface, '_queue_wav')
-        assert hasattr(self.interface, '_play_wav')
-        assert hasattr(self.interface, '_stop_wav')
+        assert hasattr(self.interface, '_start_recording')
+        assert hasattr(self.interface, '_stop_recording')
+        assert hasattr(self.interface, '_record_clip')
 
-    def queue(self, wav_filename):
-        return self.interface._queue_wav(wav_filename)
+    def record(self, directory=None, levels_file=None, **kwargs):
+        return self.interface._start_recording(directory, levels_file=levels_file, **kwargs)
 
-    def record(self):
-        return self.interface._play_wav()
+    def levels(self, seconds=60.0):
+        return self.interface._levels(seconds)
+
+    def clip(self, start, end):
+        return self.interface._record_clip(start, end)
+
+    def save_clip(self, start, end, filename):
+        return self.interface._record_clip(start, end, filename)
 
     def stop(self):
-        return self.interface._stop_wav()
+        return self.interface._stop_recording()
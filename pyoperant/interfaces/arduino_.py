@@ -1,17 +1,59 @@
 import time
 import datetime
+import struct
+import threading
 import serial
 import logging
 from pyoperant.interfaces import base_
 from pyoperant import utils, InterfaceError, ArduinoException
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
 logger = logging.getLogger(__name__)
 
+# Framed protocol. Every frame is FRAME_SYNC, a length byte counting the bytes from the sequence number to the end of the
+# payload, a sequence number, the action, the payload and a CRC-8 of everything from the length byte to the end of the
+# payload. Requests always start their payload with the channel. Replies carry the sequence number and action of their
+# request, and edge events are sent with sequence number 0.
+FRAME_SYNC = 0xA5
+MAX_FRAME = 32
+LEGACY_VERSION = 1
+FRAMED_VERSION = 2
+HELLO = 12
+EVENT = 13
+NAK = 14
+FRAME_TICK = 0.05  # seconds between checks for unanswered requests in the reader thread
+
+# Put on the queue of a request that the device didn't answer in time
+_EXPIRED = object()
+
+
+def _make_crc8_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return table
+
+_CRC8_TABLE = _make_crc8_table()
+
+
+def _crc8(data):
+    """CRC-8 with polynomial 0x07 of a byte string"""
+    crc = 0
+    for byte in data:
+        crc = _CRC8_TABLE[crc ^ ord(byte)]
+    return crc
+
 
 ## TODO: Attempt to reconnect device if it can't be reached
 # TODO: Allow device to be connected to through multiple python instances.
 #       This kind of works but needs to be tested thoroughly.
-# TODO: Polling pins
 
 class ArduinoInterface(base_.BaseInterface):
     """Creates a pyserial interface to communicate with an Arduino via the serial connection.
@@ -24,28 +66,73 @@ class ArduinoInterface(base_.BaseInterface):
     3. Sets channel as an output
     4. Sets channel as an input
     5. Sets channel as an input with a pullup resistor (basically inverts the input values)
+    6. Read all configured channels at once. The channel byte is ignored and the device replies with 'M' followed by
+       an 8 byte bitmask of the channel values
+    7. Subscribe to edge events from the channel
+    8. Unsubscribe from edge events from the channel
+    9. Write several outputs at once. The channel byte is ignored and the message continues with an 8 byte bitmask of
+       the channels to write and an 8 byte bitmask of their values
+    10. Pulse an output. The message continues with the length of the pulse in ms as 4 bytes
+    11. Blink an output. The message continues with the period and the length of the blink in ms, as 4 bytes each
+    12. Switch protocol. The channel byte is the protocol version to use and the device replies with the version in use
+
+    While any channel is subscribed the device sends an 'E' message each time the value of that channel changes, made of
+    the channel, the new value and the device clock in microseconds. In streaming mode a background thread reads
+    everything the device sends, hands replies back to the request that is waiting for them and queues edge events for
+    the channel, so that polling blocks without any serial traffic until the edge arrives.
+
+    In framed mode the same actions are sent as frames with a sequence number and a checksum (see FRAME_SYNC). Every
+    request is answered, writes included, and the reader thread hands each reply to the request with the same sequence
+    number, so several requests can be in flight at once and nothing has to be flushed before a request. Frames that
+    fail the checksum are dropped and their requests are sent again rather than raising. Firmware that doesn't answer
+    the request for framed mode is driven with two byte messages as before.
     :param device_name: The address of the device on the local system (e.g. /dev/tty.usbserial)
     :param baud_rate: The baud (bits/second) rate for serial communication. If this is changed, then it also needs to be
             changed in the arduino project code.
+    :param stream: subscribe inputs to edge events and poll them from a background reader thread
+    :param framed: talk to the device with the framed protocol if its firmware supports it
     """
 
     _default_state = dict(invert=False,
                           held=False,
+                          value=None,
+                          events=None,
+                          listeners=None,
+                          waiting=False,
                           )
 
-    def __init__(self, device_name, baud_rate=115200, inputs=None, outputs=None, *args, **kwargs):
+    def __init__(self, device_name, baud_rate=115200, inputs=None, outputs=None, stream=False, framed=False, *args,
+                 **kwargs):
 
         super(ArduinoInterface, self).__init__(*args, **kwargs)
 
         self.device_name = device_name
         self.baud_rate = baud_rate
         self.device = None
+        self.stream = stream
+        self.framed = framed
+        self.reply_timeout = 0.5
+        self.retries = 2
+        self.frame_errors = 0
 
         self.read_params = ('channel', 'pullup')
         self._state = dict()
         self.inputs = []
         self.outputs = []
 
+        self._reader = None
+        self._reader_done = False
+        self._stop_reader = threading.Event()
+        self._request_lock = threading.Lock()
+        self._replies = queue.Queue()
+        self._pending = dict()
+        self._seq = 0
+        self._last_micros = None
+        self._last_received = None
+        self._device_seconds = 0.0
+        self._clock_offset = None
+        self._clock_anchored = None
+
         self.open()
         if inputs is not None:
             for input_ in inputs:
@@ -84,6 +171,10 @@ class ArduinoInterface(base_.BaseInterface):
         self.device.readline()
         self.device.flushInput()
         logger.info("Successfully opened device %s" % self)
+        if self.framed:
+            self._hello()
+        if self.stream:
+            self._start_reader()
 
     def close(self):
         """Close a serial connection for the device
@@ -91,8 +182,368 @@ class ArduinoInterface(base_.BaseInterface):
         """
 
         logger.debug("Closing %s" % self)
+        if self.framed:
+            # Leave the device expecting two byte messages, as it is after a reset
+            try:
+                self._request(HELLO, LEGACY_VERSION)
+            except ArduinoException:
+                pass
+        self._stop_reader_thread()
         self.device.close()
 
+    def _hello(self):
+        """Ask the device for the framed protocol. If it doesn't answer, which is the case for firmware that predates
+        framing, fall back to two byte messages
+        :return: None
+        """
+
+        self.device.timeout = FRAME_TICK
+        # Old firmware reads the request as two byte messages and the last of them has the checksum as its action. Pick
+        # a sequence number whose checksum isn't an action so that it is ignored
+        seq = 1
+        while _crc8(struct.pack('BBBB', 3, seq, HELLO, FRAMED_VERSION)) <= NAK:
+            seq += 1
+        for attempt in range(self.retries + 1):
+            reply = self._submit(HELLO, FRAMED_VERSION, seq=seq).get()
+            if reply is None:
+                raise ArduinoException("Serial connection interrupted")
+            if reply == (HELLO, chr(FRAMED_VERSION)):
+                logger.info("Using framed protocol version %d with device %s" % (FRAMED_VERSION, self.device_name))
+                return
+
+        logger.warning("Device %s did not switch to the framed protocol, using two byte messages" % self.device_name)
+        self._stop_reader_thread()
+        self.framed = False
+        self.device.timeout = 1
+        self.device.flushInput()
+
+    def _start_reader(self):
+        """Start the background thread that reads replies and edge events from the device
+        :return: None
+        """
+
+        if self._reader is not None and self._reader.is_alive():
+            return
+        self._stop_reader.clear()
+        self._reader_done = False
+        self._reader = threading.Thread(target=self._read_stream, name="%s reader" % self.device_name)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _stop_reader_thread(self):
+        """Stop the background reader thread, if it is running
+        :return: None
+        """
+
+        if self._reader is None:
+            return
+        self._stop_reader.set()
+        if self._reader is not threading.current_thread():
+            self._reader.join()
+        self._reader = None
+
+    def _read_stream(self):
+        """Body of the reader thread. Everything the device sends goes through here while streaming. Edge events are
+        queued for their channel and anything else is a reply to the request currently in flight.
+        """
+
+        if self.framed:
+            return self._read_frames()
+
+        logger.debug("Starting reader thread for %s" % self.device_name)
+        try:
+            self._read_messages()
+        finally:
+            self._reader_finished()
+        logger.debug("Stopping reader thread for %s" % self.device_name)
+
+    def _read_messages(self):
+        """Read two byte protocol messages for _read_stream until the reader is stopped or the connection fails"""
+
+        while not self._stop_reader.is_set():
+            try:
+                header = self.device.read(1)
+                if len(header) == 0:  # read timed out
+                    continue
+                if header == 'E':
+                    body = self.device.read(6)
+                    received = time.time()
+                    if len(body) != 6:
+                        logger.error("Device %s sent an incomplete edge event %r" % (self, header + body))
+                        continue
+                    channel, value, micros = struct.unpack('<BBI', body)
+                    self._dispatch_edge(channel, value, self._device_time(micros, received))
+                elif header == 'M':
+                    self._replies.put(header + self.device.read(8))
+                else:
+                    self._replies.put(header)
+            except (serial.SerialException, OSError, TypeError, AttributeError) as e:
+                # The port was closed or the device disconnected. _read_stream wakes anything that is waiting on the
+                # device so that it can raise and reconnect
+                if not self._stop_reader.is_set():
+                    logger.info('Serial connection issue in reader thread: %s' % e)
+                break
+
+    def _read_frames(self):
+        """Body of the reader thread in framed mode. Replies are handed to the request with the same sequence number and
+        edge events are queued for their channel. Bytes outside a frame and frames that fail the checksum are dropped.
+        """
+
+        logger.debug("Starting frame reader thread for %s" % self.device_name)
+        try:
+            self._read_frame_messages()
+        finally:
+            self._reader_finished()
+        logger.debug("Stopping frame reader thread for %s" % self.device_name)
+
+    def _read_frame_messages(self):
+        """Read frames for _read_frames until the reader is stopped or the connection fails"""
+
+        sync = chr(FRAME_SYNC)
+        while not self._stop_reader.is_set():
+            try:
+                self._expire_requests()
+                if self.device.read(1) != sync:  # read timed out or the byte is not the start of a frame
+                    continue
+                length = self.device.read(1)
+                if len(length) == 0 or not 2 <= ord(length) <= MAX_FRAME:
+                    self._frame_error("bad length %r" % length)
+                    continue
+                body = self.device.read(ord(length) + 1)
+                received = time.time()
+                if len(body) != ord(length) + 1:
+                    self._frame_error("incomplete frame %r" % (length + body))
+                    continue
+                if _crc8(length + body[:-1]) != ord(body[-1]):
+                    self._frame_error("bad checksum in %r" % (length + body))
+                    continue
+
+                seq, action = struct.unpack('BB', body[:2])
+                payload = body[2:-1]
+                if seq == 0 and action == EVENT and len(payload) == 6:
+                    channel, value, micros = struct.unpack('<BBI', payload)
+                    self._dispatch_edge(channel, value, self._device_time(micros, received))
+                    continue
+                with self._request_lock:
+                    pending = self._pending.pop(seq, None)
+                if pending is None:
+                    logger.debug("Dropping reply to request %d on %s, which is no longer waiting" % (seq, self.device_name))
+                else:
+                    pending[0].put((action, payload))
+            except (serial.SerialException, OSError, TypeError, AttributeError) as e:
+                if not self._stop_reader.is_set():
+                    logger.info('Serial connection issue in reader thread: %s' % e)
+                break
+
+    def _frame_error(self, message):
+        """Count and log a frame that had to be dropped"""
+
+        self.frame_errors += 1
+        logger.debug("Dropping frame from %s: %s" % (self.device_name, message))
+
+    def _reader_finished(self):
+        """Called by the reader thread as it exits, however it exits. Nothing else answers or expires framed requests,
+        so stop taking them until a new reader starts and wake the ones that are waiting, so that they raise rather than
+        wait forever
+        """
+
+        with self._request_lock:
+            self._reader_done = True
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        """Wake everything that is waiting on the reader thread so that it can raise and reconnect"""
+
+        self._replies.put(None)
+        with self._request_lock:
+            pending, self._pending = self._pending, dict()
+        for replies, deadline in pending.values():
+            replies.put(None)
+        for state in self._state.values():
+            if state["events"] is not None:
+                state["events"].put(None)
+
+    def _expire_requests(self):
+        """Tell framed requests that have waited longer than reply_timeout that no reply is coming"""
+
+        now = time.time()
+        with self._request_lock:
+            expired = [seq for seq, (replies, deadline) in self._pending.items() if deadline < now]
+            for seq in expired:
+                self._pending.pop(seq)[0].put(_EXPIRED)
+
+    def _dispatch_edge(self, channel, value, timestamp):
+        """Track the value of the channel from an edge event reported by the device, and queue the event for a poll
+        that is waiting on the channel. Edges are only queued while a poll waits, so that channels that are watched
+        through listeners alone don't build up events that nothing reads
+        :param channel: the channel that changed
+        :param value: the raw value of the channel after the change
+        :param timestamp: datetime of the change on the device
+        """
+
+        state = self._state.get(channel)
+        if state is None or state["events"] is None:
+            logger.debug("Ignoring edge on unsubscribed channel %d of %s" % (channel, self.device_name))
+            return
+        if state["invert"]:
+            value = 1 - value
+        state["value"] = value == 1
+        if not state["value"]:
+            state["held"] = False
+        if state["waiting"]:
+            state["events"].put((value == 1, timestamp))
+        for listener in state["listeners"] or []:
+            listener(value == 1, timestamp)
+
+    def _device_time(self, micros, received):
+        """Convert the device clock to a datetime on the host clock
+        The device clock counts microseconds and wraps every 2 ** 32 us (about 71 minutes). The time the message was
+        received is used to count any wraps since the last message and to find the offset between the two clocks. The
+        offset with the least transmission delay is kept and refreshed every minute so that clock drift doesn't build up.
+        :param micros: device clock in microseconds
+        :param received: time.time() when the message was received
+        :return: datetime
+        """
+
+        if self._last_micros is None:
+            self._device_seconds = micros / 1e6
+        else:
+            elapsed = (micros - self._last_micros) % 2 ** 32
+            wraps = round(((received - self._last_received) * 1e6 - elapsed) / 2 ** 32)
+            self._device_seconds += (elapsed + max(wraps, 0) * 2 ** 32) / 1e6
+        self._last_micros = micros
+        self._last_received = received
+
+        offset = received - self._device_seconds
+        if self._clock_offset is None or offset < self._clock_offset or received - self._clock_anchored > 60.0:
+            self._clock_offset = offset
+            self._clock_anchored = received
+        return datetime.datetime.fromtimestamp(self._device_seconds + self._clock_offset)
+
+    def _query(self, message, size):
+        """Send a request to the device and return its reply
+        :param message: the request to send
+        :param size: the number of bytes in the reply
+        :return: the reply, which is shorter than size if the device didn't answer in time
+
+        Raises
+        ------
+        ArduinoException
+            The serial connection failed.
+        """
+
+        if not self.stream:
+            if self.device.inWaiting() > 0:  # There is currently data in the input buffer
+                self.device.flushInput()
+            self.device.write(message)
+            try:
+                return self.device.read(size)
+            except serial.SerialException:
+                logger.info('Serial connection issue - serialException')
+                raise ArduinoException("Serial connection interrupted")
+
+        self._start_reader()
+        with self._request_lock:
+            while not self._replies.empty():  # discard replies to requests that already timed out
+                self._replies.get_nowait()
+            self.device.write(message)
+            try:
+                reply = self._replies.get(timeout=self.device.timeout)
+            except queue.Empty:
+                return ''
+        if reply is None:
+            raise ArduinoException("Serial connection interrupted")
+        return reply
+
+    def _submit(self, action, channel=0, extra='', seq=None):
+        """Send a framed request without waiting for its reply
+        :param action: the action to take
+        :param channel: the channel to act on, or any value that takes its place in the request
+        :param extra: bytes that follow the channel
+        :param seq: sequence number to use, instead of the next free one
+        :return: queue that gets (action, payload) once the device replies, _EXPIRED if it doesn't reply within
+        reply_timeout or None if the serial connection fails
+
+        Raises
+        ------
+        ArduinoException
+            The serial connection failed.
+        """
+
+        self._start_reader()
+        replies = queue.Queue()
+        payload = chr(channel) + extra
+        with self._request_lock:
+            if self._reader_done:  # the reader is on its way out and won't answer or expire the request
+                raise ArduinoException("Reader thread for %s has stopped" % self.device_name)
+            if seq is None:
+                for i in range(255):
+                    self._seq = self._seq % 255 + 1  # 0 is kept for events
+                    if self._seq not in self._pending:
+                        break
+                else:
+                    raise ArduinoException("Too many requests in flight to device %s" % self.device_name)
+                seq = self._seq
+            header = struct.pack('BBB', len(payload) + 2, seq, action)
+            self._pending[seq] = (replies, time.time() + self.reply_timeout)
+            try:
+                self.device.write(chr(FRAME_SYNC) + header + payload + chr(_crc8(header + payload)))
+            except (serial.SerialException, OSError, TypeError, AttributeError):
+                del self._pending[seq]
+                logger.info('Serial connection issue - serialException')
+                raise ArduinoException("Serial connection interrupted")
+        return replies
+
+    def _request_many(self, requests):
+        """Send several framed requests and wait for their replies. All of the requests are in flight at once. Requests
+        that are rejected by the device or not answered in time are sent again, up to self.retries times, so that a
+        corrupted frame costs a retry rather than a reconnect
+        :param requests: list of (action, channel, extra) tuples
+        :return: list of reply payloads, in the same order as requests
+
+        Raises
+        ------
+        ArduinoException
+            The serial connection failed or a request went unanswered.
+        """
+
+        payloads = [None] * len(requests)
+        todo = range(len(requests))
+        for attempt in range(self.retries + 1):
+            waiting = [(index, self._submit(*requests[index])) for index in todo]
+            todo = []
+            for index, replies in waiting:
+                reply = replies.get()
+                if reply is None:
+                    raise ArduinoException("Serial connection interrupted")
+                if reply is _EXPIRED or reply[0] != requests[index][0]:
+                    todo.append(index)
+                else:
+                    payloads[index] = reply[1]
+            if len(todo) == 0:
+                return payloads
+            logger.info("Device %s did not answer %d of %d requests, retrying" % (self.device_name, len(todo),
+                                                                                  len(requests)))
+        raise ArduinoException("Device %s did not answer %d requests" % (self.device_name, len(todo)))
+
+    def _request(self, action, channel=0, extra=''):
+        """Send a framed request and wait for its reply
+        :return: the payload of the reply
+        """
+
+        return self._request_many([(action, channel, extra)])[0]
+
+    def _send(self, channel, action, extra=''):
+        """Send a request that has nothing to reply with. Framed requests are still acknowledged by the device, so
+        this waits until the request has been carried out
+        :return: True if succeeded
+        """
+
+        if self.framed:
+            self._request(action, channel, extra)
+            return True
+        return self.device.write(self._make_arg(channel, action) + extra)
+
     def _config_read(self, channel, pullup=False, **kwargs):
         """ Configure the channel to act as an input
         :param channel: the channel number to configure
@@ -103,9 +554,9 @@ class ArduinoInterface(base_.BaseInterface):
 
         logger.debug("Configuring %s, channel %d as input" % (self.device_name, channel))
         if pullup is False:
-            self.device.write(self._make_arg(channel, 4))
+            self._send(channel, 4)
         else:
-            self.device.write(self._make_arg(channel, 5))
+            self._send(channel, 5)
 
         if channel in self.outputs:
             self.outputs.remove(channel)
@@ -115,6 +566,26 @@ class ArduinoInterface(base_.BaseInterface):
         self._state.setdefault(channel, self._default_state.copy())
         self._state[channel]["invert"] = pullup
 
+        if self.stream:
+            self._state[channel]["events"] = queue.Queue()
+            self._start_reader()
+            self._send(channel, 7)
+
+    def _subscribe_edges(self, callback, channel, **kwargs):
+        """ Have the reader thread call callback(value, timestamp) for every edge of a streamed channel
+        :param callback: function to call with the value of the channel after the edge and the device time of the edge
+        :param channel: the channel to listen to
+        :return: True if the channel is streamed, False if its edges have to be found by reading it
+        """
+
+        state = self._state.get(channel)
+        if state is None or state["events"] is None:
+            return False
+        if state["listeners"] is None:
+            state["listeners"] = []
+        state["listeners"].append(callback)
+        return True
+
     def _config_write(self, channel, **kwargs):
         """ Configure the channel to act as an output
         :param channel: the channel number to configure
@@ -122,7 +593,10 @@ class ArduinoInterface(base_.BaseInterface):
         """
 
         logger.debug("Configuring %s, channel %d as output" % (self.device_name, channel))
-        self.device.write(self._make_arg(channel, 3))
+        if self._state.get(channel, self._default_state)["events"] is not None:
+            self._send(channel, 8)
+            self._state[channel]["events"] = None
+        self._send(channel, 3)
         if channel in self.inputs:
             self.inputs.remove(channel)
         if channel not in self.outputs:
@@ -143,13 +617,13 @@ class ArduinoInterface(base_.BaseInterface):
         if channel not in self._state:
             raise InterfaceError("Channel %d is not configured on device %s" % (channel, self.device_name))
 
-        if self.device.inWaiting() > 0:  # There is currently data in the input buffer
-            self.device.flushInput()
-        self.device.write(self._make_arg(channel, 0))
         # Also need to make sure self.device.read() returns something that ord can work with. Possibly except TypeError
         while True:  # is this While loop necessary? can it just call the try statement once?
             try:
-                t = self.device.read()
+                if self.framed:
+                    t = self._request(0, channel)
+                else:
+                    t = self._query(self._make_arg(channel, 0), 1)
                 # logger.debug("Read value of %s from channel %d on %s" % (t, channel, self))
             except serial.SerialException:
                 # This is to make it robust in case it accidentally disconnects or you try to access the arduino in
@@ -178,6 +652,40 @@ class ArduinoInterface(base_.BaseInterface):
             logger.error("Device %s returned unexpected value of %d on reading channel %d" % (self, v, channel))
             # raise InterfaceError('Could not read from serial device "%s", channel %d' % (self.device, channel))
 
+    def _read_many(self, channels, **kwargs):
+        """ Read the values of several channels with a single request to the device
+        :param channels: list of the channels from which to read
+        :return: list of values, in the same order as channels
+
+        Raises
+        ------
+        ArduinoException
+            Reading from the device failed.
+        """
+
+        for channel in channels:
+            if channel not in self._state:
+                raise InterfaceError("Channel %d is not configured on device %s" % (channel, self.device_name))
+
+        if self.framed:
+            reply = 'M' + self._request(6)
+        else:
+            reply = self._query(self._make_arg(0, 6), 9)
+        if len(reply) != 9 or reply[0] != 'M':
+            logger.error("Device %s returned unexpected value of %r on reading channels %s" % (self, reply, channels))
+            raise ArduinoException("returned unexpected value of %r on reading channels %s" % (reply, channels))
+
+        mask = struct.unpack('<Q', reply[1:])[0]
+        values = []
+        for channel in channels:
+            v = (mask >> channel) & 1
+            if self._state[channel]["invert"]:
+                v = 1 - v
+            values.append(v == 1)
+
+        logger.debug("Read values of %s from channels %s on %s" % (values, channels, self))
+        return values
+
     def _poll(self, channel, timeout=None, wait=None, suppress_longpress=True, **kwargs):
         """ runs a loop, querying for pecks. returns peck time or None if polling times out
         :param channel: the channel from which to read
@@ -189,6 +697,9 @@ class ArduinoInterface(base_.BaseInterface):
         :return: timestamp of True read
         """
 
+        if self._state.get(channel, self._default_state)["events"] is not None:
+            return self._poll_stream(channel, timeout=timeout, suppress_longpress=suppress_longpress)
+
         if timeout is not None:
             start = time.time()
         else:
@@ -228,6 +739,76 @@ class ArduinoInterface(base_.BaseInterface):
         logger.debug("Input detected. Returning")
         return datetime.datetime.now()
 
+    def _poll_stream(self, channel, timeout=None, suppress_longpress=True):
+        """ waits for an edge event from a subscribed channel. returns the device time of the edge or None if polling
+        times out. Edges that arrived before polling started have only updated the value and "held" flag of the channel,
+        in the same way as the reads of a polling loop would have.
+        :param channel: the channel to wait on
+        :param timeout: the time, in seconds, until polling times out. Defaults to no timeout.
+        :param suppress_longpress: only return on a rising edge, or if the channel was released since the last poll
+
+        :return: timestamp of the edge
+        """
+
+        state = self._state[channel]
+        events = state["events"]
+        # Have the reader thread queue edges from here on, then discard whatever is left over from an earlier poll or
+        # from a reader thread that has since stopped. Edges among them have already updated the value of the channel
+        state["waiting"] = True
+        try:
+            while True:
+                try:
+                    events.get_nowait()
+                except queue.Empty:
+                    break
+            self._start_reader()
+
+            if state["value"] and ((not state["held"]) or (not suppress_longpress)):
+                state["held"] = True
+                logger.debug("Input already active. Returning")
+                return datetime.datetime.now()
+            return self._wait_stream(channel, timeout, suppress_longpress)
+        finally:
+            state["waiting"] = False
+
+    def _wait_stream(self, channel, timeout, suppress_longpress):
+        """ waits on the queued edges of a channel for _poll_stream
+        :return: timestamp of the edge, or None if polling times out
+        """
+
+        state = self._state[channel]
+        events = state["events"]
+
+        # Queue.get(timeout=...) sleeps in short steps on python 2 while it waits, so block without a timeout and have
+        # a timer wake us up instead
+        logger.debug("Waiting for edge from device %s, channel %d" % (self.device_name, channel))
+        token = object()
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, events.put, [token])
+            timer.daemon = True
+            timer.start()
+        try:
+            while True:
+                event = events.get()
+                if event is token:
+                    logger.debug("Polling timed out. Returning")
+                    return None
+                elif event is None:
+                    logger.info('Reader thread stopped during polling')
+                    raise ArduinoException('Serial connection interrupted during polling')
+                elif not isinstance(event, tuple):  # timeout from an earlier poll
+                    continue
+
+                value, timestamp = event
+                if value and ((not state["held"]) or (not suppress_longpress)):
+                    state["held"] = True
+                    logger.debug("Edge detected. Returning")
+                    return timestamp
+        finally:
+            if timer is not None:
+                timer.cancel()
+
     def _write_bool(self, channel, value, **kwargs):
         """Write a value to the specified channel
         :param channel: the channel to write to
@@ -240,15 +821,73 @@ class ArduinoInterface(base_.BaseInterface):
 
         logger.debug("Writing %s to device %s, channel %d" % (value, self, channel))
         if value:
-            s = self.device.write(self._make_arg(channel, 1))
+            s = self._send(channel, 1)
         else:
-            s = self.device.write(self._make_arg(channel, 2))
+            s = self._send(channel, 2)
         if s:
             return value
         else:
             # self.reconnect_panel()
             raise ArduinoException('Could not write to serial device %s, channel %d' % (self.device, channel))
 
+    def _write_many(self, channels, values, **kwargs):
+        """Write values to several channels with a single message, so that they all change at the same time
+        :param channels: list of the channels to write to
+        :param values: list of the values to write, in the same order as channels
+        :return: list of values written if succeeded
+        """
+
+        mask = 0
+        bits = 0
+        for channel, value in zip(channels, values):
+            if channel not in self._state:
+                raise InterfaceError("Channel %d is not configured on device %s" % (channel, self))
+            mask |= 1 << channel
+            if value:
+                bits |= 1 << channel
+
+        logger.debug("Writing %s to device %s, channels %s" % (values, self, channels))
+        s = self._send(0, 9, struct.pack('<QQ', mask, bits))
+        if s:
+            return [bool(value) for value in values]
+        else:
+            raise ArduinoException('Could not write to serial device %s, channels %s' % (self.device, channels))
+
+    def _pulse_bool(self, channel, duration, **kwargs):
+        """Turn the channel on and have the device turn it off again once the pulse is over
+        :param channel: the channel to pulse
+        :param duration: the length of the pulse, in seconds
+        :return: True if succeeded
+        """
+
+        if channel not in self._state:
+            raise InterfaceError("Channel %d is not configured on device %s" % (channel, self))
+
+        logger.debug("Pulsing device %s, channel %d for %ss" % (self, channel, duration))
+        s = self._send(channel, 10, struct.pack('<I', int(round(duration * 1000))))
+        if s:
+            return True
+        else:
+            raise ArduinoException('Could not write to serial device %s, channel %d' % (self.device, channel))
+
+    def _blink_bool(self, channel, period, duration, **kwargs):
+        """Have the device toggle the channel every half period and then restore its value once the blink is over
+        :param channel: the channel to blink
+        :param period: the time, in seconds, between the channel turning on and turning on again
+        :param duration: the length of the blink, in seconds
+        :return: True if succeeded
+        """
+
+        if channel not in self._state:
+            raise InterfaceError("Channel %d is not configured on device %s" % (channel, self))
+
+        logger.debug("Blinking device %s, channel %d every %ss for %ss" % (self, channel, period, duration))
+        s = self._send(channel, 11, struct.pack('<II', int(round(period * 1000)), int(round(duration * 1000))))
+        if s:
+            return True
+        else:
+            raise ArduinoException('Could not write to serial device %s, channel %d' % (self.device, channel))
+
     # # ENABLE IF USING TEENSY WAV PLAYBACK
     # def _play_wav(self, value, **kwargs):
     #     channel = 99
@@ -298,6 +937,9 @@ class ArduinoInterface(base_.BaseInterface):
         """:return: None
         """
         logger.info('Serial device %s not responding, reconnecting' % self.device_name)
+        # The reader thread is blocked on the old port or on its way out. Stop it so that the requests below start a
+        # new one instead of racing with it
+        self._stop_reader_thread()
         self.device.close()
         try:
             self.device.open()
@@ -308,12 +950,16 @@ class ArduinoInterface(base_.BaseInterface):
         self.device.readline()
         self.device.flushInput()
         logger.info("Successfully reopened device %s" % self.device_name)
+        if self.framed:
+            self._hello()
 
         # Reinitiate the inputs and outputs
-        for channelIn in self.inputs:
-            self._config_read(channelIn)
-        for channelOut in self.outputs:
+        for channelIn in list(self.inputs):
+            self._config_read(channelIn, pullup=self._state[channelIn]["invert"])
+        for channelOut in list(self.outputs):
             self._config_write(channelOut)
+        if self.stream:
+            self._start_reader()
         # Reconnect sound
         # audioDevice = self.panel.interfaces['pyaudio'].device
         # audioDevice.close()
@@ -0,0 +1,425 @@
+"""Emulates a Teensy running src/operant_serial/operant_serial.ino behind a pseudo-terminal, so that ArduinoInterface can
+be run and measured without the hardware. Both the two byte messages and the framed protocol are supported, the same way
+the firmware handles them.
+
+    emulator = TeensyEmulator(latency=0.001, jitter=0.0005)
+    emulator.start()
+    interface = ArduinoInterface(emulator.device_name)
+    emulator.schedule_input(3, True, delay=0.5)
+
+It can also be run on its own, in which case it prints the name of its pty and the time it started, then runs until it
+is killed:
+
+    python -m pyoperant.interfaces.arduino_emulator --latency 0.001 --edge 3:1.0:0.1
+"""
+import os
+import sys
+import pty
+import tty
+import time
+import heapq
+import random
+import select
+import struct
+import argparse
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+FRAME_SYNC = 0xA5
+MAX_FRAME = 32
+LEGACY_VERSION = 1
+FRAMED_VERSION = 2
+EVENT = 13
+NAK = 14
+BAD_CHECKSUM = 1
+BAD_LENGTH = 2
+BAD_ACTION = 3
+EXTRA_LENGTH = {9: 16, 10: 4, 11: 8}
+
+
+def _crc8(data):
+    """CRC-8 with polynomial 0x07 of a bytearray"""
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+
+class TeensyEmulator(object):
+    """A Teensy running the operant_serial firmware, behind a pseudo-terminal
+
+    Keyword arguments:
+    latency -- time, in seconds, that bytes take to cross the serial link in each direction
+    jitter -- extra time, in seconds, added to the latency of each message. Drawn uniformly from 0 to jitter
+    corruption -- probability that a message sent to the host has one of its bytes flipped
+    legacy_only -- behave like firmware that predates the framed protocol
+
+    Methods:
+    start() -- open the pseudo-terminal and start the device thread. device_name is the pty to open
+    stop() -- stop the device thread and close the pseudo-terminal
+    set_input(pin, value) -- drive a pin HIGH (True) or LOW (False) straight away
+    schedule_input(pin, value, delay) -- drive a pin after delay seconds
+    schedule_pulses(pin, period, width) -- drive a pin HIGH for width seconds every period seconds
+    value(pin) -- the current level of a pin
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, corruption=0.0, legacy_only=False):
+        self.latency = latency
+        self.jitter = jitter
+        self.corruption = corruption
+        self.legacy_only = legacy_only
+
+        self.device_name = None
+        self.started = None
+        self.requests = 0
+        self.input_log = []
+
+        self._master = None
+        self._slave = None
+        self._wake_read = None  # pipe written to whenever an input changes or is scheduled, to wake the device thread
+        self._wake_write = None
+        self._thread = None
+        self._running = False
+        self._lock = threading.Lock()
+        self._incoming = []  # (time the bytes reach the device, bytes)
+        self._outgoing = []  # (time the bytes reach the host, bytes)
+        self._buffer = bytearray()
+        self._scheduled = []  # heap of (time, order, pin, value, repeat)
+        self._order = 0
+
+        # Firmware state
+        self._levels = dict()
+        self._modes = dict()
+        self._configured = set()
+        self._subscribed = set()
+        self._last_values = dict()
+        self._pulsing = dict()  # pin: time the pulse ends
+        self._blinking = dict()  # pin: [time the blink ends, half period, time of the last toggle, value to restore]
+        self._framed = False
+        self._frame_request = None  # (seq, action) of the framed request being handled
+
+    def start(self):
+        """Open the pseudo-terminal and start the device thread
+        :return: the name of the pty to open
+        """
+
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self._wake_read, self._wake_write = os.pipe()
+        self.device_name = os.ttyname(self._slave)
+        self.started = time.time()
+        self._running = True
+        self._send(bytearray(b"Initialized!\r\n"))
+        self._thread = threading.Thread(target=self._run, name="Teensy emulator on %s" % self.device_name)
+        self._thread.daemon = True
+        self._thread.start()
+        return self.device_name
+
+    def stop(self):
+        """Stop the device thread and close the pseudo-terminal
+        :return: None
+        """
+
+        self._running = False
+        self._wake()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave, self._wake_read, self._wake_write):
+            os.close(fd)
+
+    def set_input(self, pin, value):
+        """Drive a pin HIGH (True) or LOW (False)"""
+
+        with self._lock:
+            self._levels[pin] = bool(value)
+            self.input_log.append((time.time(), pin, bool(value)))
+        self._wake()
+
+    def schedule_input(self, pin, value, delay=0.0):
+        """Drive a pin HIGH (True) or LOW (False) after delay seconds"""
+
+        self._schedule(time.time() + delay, pin, value)
+
+    def schedule_pulses(self, pin, period, width, start=None):
+        """Drive a pin HIGH for width seconds every period seconds, until the emulator stops
+        :param start: time.time() of the first rising edge. Defaults to one period from now
+        """
+
+        if start is None:
+            start = time.time() + period
+        self._schedule(start, pin, True, repeat=period)
+        self._schedule(start + width, pin, False, repeat=period)
+
+    def value(self, pin):
+        """The current level of a pin"""
+
+        with self._lock:
+            return self._levels.get(pin, False)
+
+    def _schedule(self, at, pin, value, repeat=None):
+        with self._lock:
+            self._order += 1
+            heapq.heappush(self._scheduled, (at, self._order, pin, bool(value), repeat))
+        self._wake()
+
+    def _wake(self):
+        if self._wake_write is not None:
+            os.write(self._wake_write, b'x')
+
+    def _micros(self, now):
+        return int((now - self.started) * 1e6) & 0xFFFFFFFF
+
+    def _delay(self):
+        return self.latency + random.uniform(0, self.jitter)
+
+    def _send(self, data):
+        """Queue bytes to reach the host after the link latency. Bytes never overtake the ones sent before them"""
+
+        if self.corruption and random.random() < self.corruption:
+            data = bytearray(data)
+            data[random.randrange(len(data))] ^= 0x10
+        due = time.time() + self._delay()
+        if self._outgoing:
+            due = max(due, self._outgoing[-1][0])
+        self._outgoing.append((due, bytes(data)))
+
+    def _run(self):
+        """Body of the device thread: the equivalent of the firmware loop()"""
+
+        while self._running:
+            now = time.time()
+            wake = [now + 0.1]
+            if self._incoming:
+                wake.append(self._incoming[0][0])
+            if self._outgoing:
+                wake.append(self._outgoing[0][0])
+            if self._scheduled:
+                wake.append(self._scheduled[0][0])
+            wake.extend(self._pulsing.values())
+            wake.extend(min(blink[0], blink[2] + blink[1]) for blink in self._blinking.values())
+            try:
+                readable = select.select([self._master, self._wake_read], [], [], max(min(wake) - now, 0))[0]
+                if self._wake_read in readable:
+                    os.read(self._wake_read, 4096)
+                if self._master in readable:
+                    data = os.read(self._master, 4096)
+                    due = time.time() + self._delay()
+                    if self._incoming:
+                        due = max(due, self._incoming[-1][0])
+                    self._incoming.append((due, data))
+            except (OSError, select.error):
+                break
+
+            now = time.time()
+            with self._lock:
+                while self._incoming and self._incoming[0][0] <= now:
+                    self._buffer.extend(bytearray(self._incoming.pop(0)[1]))
+                self._handle_buffer()
+                while self._scheduled and self._scheduled[0][0] <= now:
+                    at, order, pin, value, repeat = heapq.heappop(self._scheduled)
+                    self._levels[pin] = value
+                    self.input_log.append((at, pin, value))
+                    if repeat is not None:
+                        self._order += 1
+                        heapq.heappush(self._scheduled, (at + repeat, self._order, pin, value, repeat))
+                self._check_timers(now)
+                self._check_edges(now)
+
+            now = time.time()
+            while self._outgoing and self._outgoing[0][0] <= now:
+                try:
+                    os.write(self._master, self._outgoing.pop(0)[1])
+                except OSError:
+                    self._running = False
+                    break
+
+    def _handle_buffer(self):
+        """Handle every complete request in the buffer, the way the firmware loop() does"""
+
+        while self._buffer:
+            if self._buffer[0] == FRAME_SYNC and not self.legacy_only:
+                if len(self._buffer) < 2:
+                    return
+                length = self._buffer[1]
+                if length < 3 or length > MAX_FRAME:
+                    del self._buffer[:2]
+                    continue
+                if len(self._buffer) < length + 3:
+                    return
+                frame = self._buffer[1:length + 3]
+                del self._buffer[:length + 3]
+                seq, action, port = frame[1], frame[2], frame[3]
+                self._frame_request = (seq, action)
+                if _crc8(frame[:-1]) != frame[-1]:
+                    if self._framed:
+                        self._nak(BAD_CHECKSUM)
+                elif length - 3 != EXTRA_LENGTH.get(action, 0):
+                    self._nak(BAD_LENGTH)
+                else:
+                    self._handle_request(action, port, frame[4:-1])
+                self._frame_request = None
+            elif self._framed:
+                del self._buffer[0]
+            else:
+                if len(self._buffer) < 2:
+                    return
+                port, action = self._buffer[0], self._buffer[1]
+                extra = EXTRA_LENGTH.get(action, 0)
+                if len(self._buffer) < extra + 2:
+                    return
+                data = self._buffer[2:extra + 2]
+                del self._buffer[:extra + 2]
+                self._handle_request(action, port, data)
+
+    def _write_frame(self, seq, action, payload=bytearray()):
+        frame = bytearray([len(payload) + 2, seq, action]) + bytearray(payload)
+        self._send(bytearray([FRAME_SYNC]) + frame + bytearray([_crc8(frame)]))
+
+    def _reply(self, header, data):
+        if self._frame_request is not None:
+            self._write_frame(self._frame_request[0], self._frame_request[1], data)
+        else:
+            self._send(bytearray(header) + bytearray(data))
+
+    def _ack(self):
+        if self._frame_request is not None:
+            self._write_frame(self._frame_request[0], self._frame_request[1])
+
+    def _nak(self, reason):
+        self._write_frame(self._frame_request[0], NAK, bytearray([reason]))
+
+    def _write_event(self, pin, value, now):
+        payload = bytearray(struct.pack('<BBI', pin, value, self._micros(now)))
+        if self._framed:
+            self._write_frame(0, EVENT, payload)
+        else:
+            self._send(bytearray(b'E') + payload)
+
+    def _read(self, pin):
+        if pin not in self._levels and self._modes.get(pin) == 'INPUT_PULLUP':
+            return 1
+        return int(self._levels.get(pin, False))
+
+    def _write(self, pin, value):
+        self._levels[pin] = bool(value)
+
+    def _cancel_timers(self, pins):
+        for pin in pins:
+            self._pulsing.pop(pin, None)
+            self._blinking.pop(pin, None)
+
+    def _handle_request(self, action, port, extra):
+        """Carry out a request. See handleRequest() in the firmware for the actions"""
+
+        self.requests += 1
+        now = time.time()
+        if action == 0:
+            self._reply(b'', [self._read(port)])
+        elif action in (1, 2):
+            self._cancel_timers([port])
+            self._write(port, action == 1)
+            self._ack()
+        elif action in (3, 4, 5):
+            self._modes[port] = {3: 'OUTPUT', 4: 'INPUT', 5: 'INPUT_PULLUP'}[action]
+            if action == 3:
+                self._write(port, False)
+            self._configured.add(port)
+            self._ack()
+        elif action == 6:
+            mask = 0
+            for pin in self._configured:
+                if self._read(pin):
+                    mask |= 1 << pin
+            self._reply(b'M', bytearray(struct.pack('<Q', mask)))
+        elif action == 7:
+            self._subscribed.add(port)
+            self._last_values[port] = self._read(port)
+            self._write_event(port, self._last_values[port], now)
+            self._ack()
+        elif action == 8:
+            self._subscribed.discard(port)
+            self._ack()
+        elif action == 9:
+            mask, values = struct.unpack('<QQ', bytes(extra))
+            pins = [pin for pin in range(64) if (mask >> pin) & 1]
+            self._cancel_timers(pins)
+            for pin in pins:
+                self._write(pin, (values >> pin) & 1)
+            self._ack()
+        elif action == 10:
+            self._cancel_timers([port])
+            self._pulsing[port] = now + struct.unpack('<I', bytes(extra))[0] / 1000.0
+            self._write(port, True)
+            self._ack()
+        elif action == 11:
+            period, length = struct.unpack('<II', bytes(extra))
+            self._cancel_timers([port])
+            self._blinking[port] = [now + length / 1000.0, max(period // 2, 1) / 1000.0, now, self._read(port)]
+            self._write(port, not self._read(port))
+            self._ack()
+        elif action == 12 and not self.legacy_only:
+            if port in (LEGACY_VERSION, FRAMED_VERSION):
+                self._reply(b'', [port])
+                self._framed = (port == FRAMED_VERSION)
+            else:
+                self._reply(b'', [FRAMED_VERSION if self._framed else LEGACY_VERSION])
+        elif self._frame_request is not None:
+            self._nak(BAD_ACTION)
+
+    def _check_timers(self, now):
+        for pin, end in list(self._pulsing.items()):
+            if now >= end:
+                self._write(pin, False)
+                del self._pulsing[pin]
+        for pin, blink in list(self._blinking.items()):
+            end, half_period, last_toggle, restore = blink
+            if now >= end:
+                self._write(pin, restore)
+                del self._blinking[pin]
+            elif now - last_toggle >= half_period:
+                self._write(pin, not self._read(pin))
+                blink[2] += half_period
+
+    def _check_edges(self, now):
+        for pin in self._subscribed:
+            value = self._read(pin)
+            if value != self._last_values.get(pin):
+                self._last_values[pin] = value
+                self._write_event(pin, value, now)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulate a Teensy running operant_serial behind a pseudo-terminal')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='time in seconds that bytes take to cross the serial link in each direction')
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra latency in seconds, drawn from 0 to jitter')
+    parser.add_argument('--corruption', type=float, default=0.0,
+                        help='probability that a message to the host is corrupted')
+    parser.add_argument('--legacy-only', action='store_true', help='do not support the framed protocol')
+    parser.add_argument('--edge', action='append', default=[], metavar='PIN:PERIOD:WIDTH',
+                        help='drive PIN high for WIDTH seconds every PERIOD seconds, starting one period after startup')
+    args = parser.parse_args()
+
+    emulator = TeensyEmulator(latency=args.latency, jitter=args.jitter, corruption=args.corruption,
+                              legacy_only=args.legacy_only)
+    emulator.start()
+    for edge in args.edge:
+        pin, period, width = edge.split(':')
+        emulator.schedule_pulses(int(pin), float(period), float(width), start=emulator.started + float(period))
+    sys.stdout.write("%s %f\n" % (emulator.device_name, emulator.started))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    emulator.stop()
+
+
+if __name__ == '__main__':
+    main()
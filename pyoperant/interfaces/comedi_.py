@@ -1,18 +1,50 @@
 import comedi
-import subprocess, datetime
+import time
+import datetime
+import threading
+import logging
 from pyoperant.interfaces import base_
-from pyoperant import utils, InterfaceError
+from pyoperant import InterfaceError
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+logger = logging.getLogger(__name__)
+
+BANK_SIZE = 32  # channels read by one comedi_dio_bitfield2 call
 
 
 class ComediInterface(base_.BaseInterface):
-    """docstring for ComediInterface"""
+    """Interface to the digital IO subdevices of a comedi device
+
+    While any call to _poll is waiting, a background thread reads every input channel of the interface every
+    poll_interval seconds, with one comedi_dio_bitfield2 call per bank of 32 channels, and hands each rising edge to the
+    calls waiting on that channel. The thread sleeps while nothing is waiting.
 
-    def __init__(self, device_name, *args, **kwargs):
+    _read_many and _write_many act on several channels of a subdevice with one comedi_dio_bitfield2 call per bank. The
+    last value written to each output is kept in a shadow register, and _write_many skips outputs that are already at the
+    value being written, so resetting a panel that is already off costs no calls at all.
+    :param device_name: the comedi device file (e.g. /dev/comedi0)
+    :param poll_interval: the time, in seconds, between reads of the inputs while polling
+    """
+
+    def __init__(self, device_name, poll_interval=0.0005, *args, **kwargs):
         super(ComediInterface, self).__init__(*args, **kwargs)
         self.device_name = device_name
+        self.poll_interval = poll_interval
         self.read_params = ('subdevice',
                             'channel',
                             )
+        self._banks = dict()  # (subdevice, base channel): list of the input channels in the bank
+        self._values = dict()  # (subdevice, channel): value of the input when it was last read
+        self._waiters = dict()  # (subdevice, channel): list of queues of the calls to _poll waiting on the input
+        self._shadow = dict()  # (subdevice, channel): last value written to the output
+        self._poll_lock = threading.Lock()
+        self._polling = threading.Event()
+        self._poller = None
+        self._stop_poller = False
         self.open()
 
     def open(self):
@@ -21,6 +53,7 @@ class ComediInterface(base_.BaseInterface):
             raise InterfaceError('could not open comedi device %s' % self.device_name)
 
     def close(self):
+        self._stop_poller_thread()
         s = comedi.comedi_close(self.device)
         if s < 0:
             raise InterfaceError('could not close comedi device %s(%s)' % (self.device_name, self.device))
@@ -31,6 +64,8 @@ class ComediInterface(base_.BaseInterface):
             raise InterfaceError(
                 'could not configure comedi device "%s", subdevice %s, channel %s' % (self.device, subdevice, channel))
         else:
+            with self._poll_lock:
+                self._watch(subdevice, channel)
             return True
 
     def _config_write(self, subdevice, channel):
@@ -39,6 +74,7 @@ class ComediInterface(base_.BaseInterface):
             raise InterfaceError(
                 'could not configure comedi device "%s", subdevice %s, channel %s' % (self.device, subdevice, channel))
         else:
+            self._shadow.pop((subdevice, channel), None)
             return True
 
     def _read_bool(self, subdevice, channel):
@@ -51,17 +87,130 @@ class ComediInterface(base_.BaseInterface):
             raise InterfaceError(
                 'could not read from comedi device "%s", subdevice %s, channel %s' % (self.device, subdevice, channel))
 
+    def _read_many(self, subdevice, channels, **kwargs):
+        """ read from several channels of a subdevice, with one bitfield read per bank of channels
+        """
+        banks = dict()
+        values = []
+        for channel in channels:
+            base_channel = channel - channel % BANK_SIZE
+            if base_channel not in banks:
+                banks[base_channel] = self._read_bitfield(subdevice, base_channel)
+            values.append(((banks[base_channel] >> (channel - base_channel)) & 1) == 0)  # invert the values from comedi
+        return values
+
+    def _read_bitfield(self, subdevice, base_channel):
+        """ read the raw values of the bank of channels starting at base_channel. bit n is channel base_channel + n
+        """
+        (s, bits) = comedi.comedi_dio_bitfield2(self.device, subdevice, 0, 0, base_channel)
+        if s < 0:
+            raise InterfaceError('could not read from comedi device "%s", subdevice %s, channels %s-%s' % (
+                self.device, subdevice, base_channel, base_channel + BANK_SIZE - 1))
+        return bits
+
+    def _watch(self, subdevice, channel):
+        """ add an input to the channels read by the poller. Call with _poll_lock held
+        """
+        bank = self._banks.setdefault((subdevice, channel - channel % BANK_SIZE), [])
+        if channel not in bank:
+            bank.append(channel)
+
     def _poll(self, subdevice, channel, timeout=None):
-        """ runs a loop, querying for pecks. returns peck time or "GoodNite" exception """
-        date_fmt = '%Y-%m-%d %H:%M:%S.%f'
-        cmd = ['comedi_poll', self.device_name, '-s', str(subdevice), '-c', str(channel)]
-        poll_command = utils.Command(cmd)
-        status, output, error = poll_command.run(timeout=timeout)
-        if status < 0:
+        """ waits for the channel to become active. returns the time it did, or None if polling times out
+        """
+        key = (subdevice, channel)
+        waiter = queue.Queue()
+        with self._poll_lock:
+            self._watch(subdevice, channel)
+            self._values[key] = self._read_bool(subdevice, channel)
+            if self._values[key]:
+                return datetime.datetime.now()
+            self._waiters.setdefault(key, []).append(waiter)
+            self._start_poller()
+
+        # Queue.get(timeout=...) sleeps in short steps on python 2 while it waits, so block without a timeout and have
+        # a timer wake us up instead
+        token = object()
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, waiter.put, [token])
+            timer.daemon = True
+            timer.start()
+        try:
+            result = waiter.get()
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        if result is token:
+            with self._poll_lock:
+                waiters = self._waiters.get(key, [])
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                if len(waiters) == 0:
+                    self._waiters.pop(key, None)
             return None
-        else:
-            timestamp = output
-            return datetime.datetime.strptime(timestamp.strip(), date_fmt)
+        elif result is None:
+            raise InterfaceError(
+                'could not poll comedi device "%s", subdevice %s, channel %s' % (self.device, subdevice, channel))
+        return result
+
+    def _start_poller(self):
+        """ start the poller thread if it isn't running and wake it up. Call with _poll_lock held
+        """
+        if self._poller is None or not self._poller.is_alive():
+            self._stop_poller = False
+            self._poller = threading.Thread(target=self._run_poller, name="%s poller" % self.device_name)
+            self._poller.daemon = True
+            self._poller.start()
+        self._polling.set()
+
+    def _stop_poller_thread(self):
+        if self._poller is None:
+            return
+        # under the lock, so that the poller can't clear the event between seeing that it should keep going and going
+        # back to sleep
+        with self._poll_lock:
+            self._stop_poller = True
+            self._polling.set()
+        self._poller.join()
+        self._poller = None
+
+    def _run_poller(self):
+        """ body of the poller thread. reads the inputs while there are calls to _poll waiting on them
+        """
+        logger.debug("Starting poller thread for %s" % self.device_name)
+        while True:
+            self._polling.wait()
+            if self._stop_poller:
+                break
+            with self._poll_lock:
+                try:
+                    self._check_inputs()
+                except InterfaceError as e:
+                    logger.error("Poller thread for %s could not read inputs: %s" % (self.device_name, e))
+                    for waiters in self._waiters.values():
+                        for waiter in waiters:
+                            waiter.put(None)
+                    self._waiters = dict()
+                if len(self._waiters) == 0 and not self._stop_poller:
+                    self._polling.clear()
+            time.sleep(self.poll_interval)
+        logger.debug("Stopping poller thread for %s" % self.device_name)
+
+    def _check_inputs(self):
+        """ read every bank of inputs once and hand rising edges to the calls waiting on them. Call with _poll_lock held
+        """
+        for (subdevice, base_channel), channels in self._banks.items():
+            bits = self._read_bitfield(subdevice, base_channel)
+            now = datetime.datetime.now()
+            for channel in channels:
+                key = (subdevice, channel)
+                value = ((bits >> (channel - base_channel)) & 1) == 0  # inputs are active low
+                if value and not self._values.get(key):
+                    for waiter in self._waiters.pop(key, []):
+                        waiter.put(now)
+                self._values[key] = value
 
     def _write_bool(self, subdevice, channel, value):
         """Write to comedi port
@@ -70,7 +219,32 @@ class ComediInterface(base_.BaseInterface):
 
         s = comedi.comedi_dio_write(self.device, subdevice, channel, value)
         if s:
+            self._shadow[(subdevice, channel)] = not value
             return True
         else:
             raise InterfaceError(
                 'could not write to comedi device "%s", subdevice %s, channel %s' % (self.device, subdevice, channel))
+
+    def _write_many(self, subdevice, channels, values, **kwargs):
+        """Write to several channels of a subdevice, with at most one bitfield write per bank of channels. Channels that
+        the shadow register says are already at their value are left alone
+        """
+        banks = dict()  # base channel: [write mask, bits]
+        for channel, value in zip(channels, values):
+            if self._shadow.get((subdevice, channel)) == bool(value):
+                continue
+            base_channel = channel - channel % BANK_SIZE
+            bank = banks.setdefault(base_channel, [0, 0])
+            bank[0] |= 1 << (channel - base_channel)
+            if not value:  # invert the value for comedi
+                bank[1] |= 1 << (channel - base_channel)
+
+        for base_channel, (mask, bits) in banks.items():
+            (s, _) = comedi.comedi_dio_bitfield2(self.device, subdevice, mask, bits, base_channel)
+            if s < 0:
+                raise InterfaceError('could not write to comedi device "%s", subdevice %s, channels %s-%s' % (
+                    self.device, subdevice, base_channel, base_channel + BANK_SIZE - 1))
+            for offset in range(BANK_SIZE):
+                if (mask >> offset) & 1:
+                    self._shadow[(subdevice, base_channel + offset)] = not (bits >> offset) & 1
+        return [bool(value) for value in values]
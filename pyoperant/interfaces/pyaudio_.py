@@ -1,7 +1,606 @@
-import pyaudio
+import os
+import re
+import time
 import wave
+import logging
+import threading
+import collections
+import datetime as dt
+from contextlib import closing
+import numpy as np
+import pyaudio
 from pyoperant.interfaces import base_
-from pyoperant import InterfaceError
+from pyoperant import InterfaceError, preprocess
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+logger = logging.getLogger(__name__)
+
+
+class CachedWave(object):
+    """Reads frames from a decoded wav file held in memory. Has the same methods as the object returned by wave.open(),
+    so that it can stand in for it. Each CachedWave has its own read position, so several can read the same data.
+    """
+
+    def __init__(self, params, frames):
+        self.params = params  # (nchannels, sampwidth, framerate, nframes, comptype, compname)
+        self.frames = frames
+        self.position = 0
+        self._frame_size = params[0] * params[1]
+
+    def getnchannels(self):
+        return self.params[0]
+
+    def getsampwidth(self):
+        return self.params[1]
+
+    def getframerate(self):
+        return self.params[2]
+
+    def getnframes(self):
+        return self.params[3]
+
+    def getparams(self):
+        return self.params
+
+    def readframes(self, n):
+        start = self.position * self._frame_size
+        data = self.frames[start:start + n * self._frame_size]
+        self.position += len(data) // self._frame_size
+        return data
+
+    def tell(self):
+        return self.position
+
+    def setpos(self, pos):
+        self.position = pos
+
+    def rewind(self):
+        self.position = 0
+
+    def close(self):
+        pass
+
+
+class StimulusCache(object):
+    """Keeps the decoded frames of recently played wav files in memory, so that queueing a stimulus doesn't touch the
+    disk. Files are keyed by path and modification time, so a file that changes on disk is read again. Once the frames
+    held add up to more than max_bytes, the least recently used files are dropped.
+
+    Methods:
+    open(wav_file) -- returns a CachedWave for the file, reading it if it isn't cached
+    warm(wav_files) -- reads files into the cache ahead of time
+    clear() -- empties the cache
+    """
+
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()  # (path, mtime): (params, frames), least recently used first
+        self._lock = threading.Lock()
+
+    def open(self, wav_file):
+        path = os.path.abspath(wav_file)
+        key = (path, os.path.getmtime(path))
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self.hits += 1
+                return CachedWave(*entry)
+
+        wf = wave.open(path)
+        try:
+            entry = (wf.getparams(), wf.readframes(wf.getnframes()))
+        finally:
+            wf.close()
+
+        with self._lock:
+            self.misses += 1
+            if key not in self._entries:
+                self._entries[key] = entry
+                self.size += len(entry[1])
+            # the file just read is kept even if it is larger than max_bytes on its own
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                old_key, (old_params, old_frames) = self._entries.popitem(last=False)
+                self.size -= len(old_frames)
+                logger.debug("Dropped %s from the stimulus cache" % old_key[0])
+        return CachedWave(*entry)
+
+    def warm(self, wav_files):
+        for wav_file in wav_files:
+            try:
+                self.open(wav_file)
+            except (IOError, OSError, EOFError, wave.Error) as e:
+                logger.warning("Could not cache stimulus %s: %s" % (wav_file, e))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+# Shared by every PyAudioInterface in the process unless one is given its own
+stimulus_cache = StimulusCache()
+
+
+def _timestamp(when):
+    """seconds since the epoch of a datetime (as used for trial times) or of a time.time() value"""
+    if isinstance(when, dt.datetime):
+        return time.mktime(when.timetuple()) + when.microsecond / 1e6
+    return when
+
+
+class AudioRecorder(object):
+    """Keeps the audio captured by an input stream, both in memory and on disk
+
+    callback() is the stream callback. It stamps each block of frames with the time it was captured and its position in
+    the recording, adds it to a ring buffer of the last buffer_seconds of audio and hands it to a writer thread, without
+    ever waiting. The writer appends the blocks to wav files in directory, starting a new file every chunk_seconds, and
+    writes the clips asked for by save_clip once their audio has been captured. If the writer falls more than
+    buffer_seconds behind, blocks are dropped from the files (and counted in dropped) rather than held in memory.
+    If a LevelMeter is given, the writer also measures each block with it.
+
+    A clip starts at the frame captured at its start time, judged from the block (or file) captured closest to it, and
+    has (end - start) * rate frames, so clips don't gain or lose frames to jitter in the capture times.
+
+    Keyword arguments:
+    directory -- where the chunk files and, by default, clips are written. If None, only the ring buffer is kept
+    rate -- sampling rate of the stream, in Hz
+    sampwidth -- bytes per sample of the stream (mono)
+    frames_per_buffer -- frames in each block the stream delivers
+    buffer_seconds -- seconds of audio kept in memory
+    chunk_seconds -- seconds of audio in each chunk file
+    max_chunks -- chunk files kept, the oldest is deleted when a new one is started (None keeps every file)
+    keep_chunks -- if True, chunk files past max_chunks are only forgotten by clip() and save_clip(), not deleted
+    prefix -- start of the chunk file names, which end with the time the chunk starts
+    meter -- LevelMeter that measures each block
+
+    Methods:
+    start() -- starts the writer thread
+    stop() -- writes everything captured and waits for the writer to finish
+    clip(start, end) -- returns the frames captured between two times, datetimes or time.time() values
+    save_clip(start, end, filename) -- has the writer save the frames between two times to a wav file
+    """
+
+    def __init__(self, directory, rate=44100, sampwidth=2, frames_per_buffer=4096, buffer_seconds=30.0,
+                 chunk_seconds=60.0, max_chunks=1440, keep_chunks=False, prefix='recording', meter=None):
+        self.directory = directory
+        self.keep_chunks = keep_chunks
+        self.meter = meter
+        self.rate = rate
+        self.sampwidth = sampwidth
+        self.frames_per_buffer = frames_per_buffer
+        self.chunk_seconds = chunk_seconds
+        self.prefix = prefix
+        n_blocks = int(buffer_seconds * rate / frames_per_buffer) + 1
+        self.blocks = collections.deque(maxlen=n_blocks)  # (capture time, first frame, frames), oldest first
+        self.chunks = collections.deque(maxlen=max_chunks)  # [capture time, first frame, path, nframes], oldest first
+        self.frames = 0  # frames captured
+        self.written = 0  # frames handled by the writer
+        self.dropped = 0
+        self.overflows = 0
+        self._spill = queue.Queue(maxsize=n_blocks)
+        self._clips = []  # (first frame, last frame, filename) waiting for their audio
+        self._lock = threading.Lock()
+        self._chunk = None
+        self._chunk_file = None
+        self._writer = None
+
+    def callback(self, in_data, frame_count, time_info, status):
+        now = time.time()
+        if time_info.get('input_buffer_adc_time') and time_info.get('current_time'):
+            captured = now - (time_info['current_time'] - time_info['input_buffer_adc_time'])
+        else:  # some host APIs leave the stream times at 0
+            captured = now - float(frame_count) / self.rate
+        if status & pyaudio.paInputOverflow:
+            self.overflows += 1
+        with self._lock:
+            block = (captured, self.frames, in_data)
+            self.blocks.append(block)
+            self.frames += len(in_data) // self.sampwidth
+        try:
+            self._spill.put_nowait(block)
+        except queue.Full:
+            self.dropped += 1
+        return None, pyaudio.paContinue
+
+    def start(self):
+        if self._writer is not None:
+            return
+        if self.directory is not None and not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._writer = threading.Thread(target=self._run)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def stop(self):
+        if self._writer is None:
+            return
+        self._spill.put(None)
+        self._writer.join()
+        self._writer = None
+
+    def _run(self):
+        while True:
+            block = self._spill.get()
+            if block is None:
+                break
+            if self.directory is not None:
+                self._write_block(*block)
+            else:
+                self.written = block[1] + len(block[2]) // self.sampwidth
+            if self.meter is not None:
+                self.meter.measure(block[0], block[2])
+            self._save_clips()
+        self._close_chunk()
+        self._save_clips(everything=True)
+
+    def _write_block(self, captured, first_frame, frames):
+        n_frames = len(frames) // self.sampwidth
+        chunk = self.chunks[-1] if self.chunks else None
+        if self._chunk is None or chunk[1] + chunk[3] != first_frame or chunk[3] >= self.chunk_seconds * self.rate:
+            # a file holds consecutive frames, so one is also started after dropped blocks
+            self._close_chunk()
+            path = os.path.join(self.directory, '%s_%s.wav' % (self.prefix, dt.datetime.fromtimestamp(captured)
+                                                               .strftime('%Y%m%d%H%M%S%f')))
+            try:
+                self._chunk_file = open(path, 'wb')
+                self._chunk = wave.open(self._chunk_file, 'wb')
+                self._chunk.setnchannels(1)
+                self._chunk.setsampwidth(self.sampwidth)
+                self._chunk.setframerate(self.rate)
+            except (IOError, OSError) as e:
+                self._chunk = None
+                self.dropped += 1
+                logger.error("Could not open %s: %s" % (path, e))
+                return
+            with self._lock:
+                expired = self.chunks[0] if len(self.chunks) == self.chunks.maxlen else None
+                self.chunks.append([captured, first_frame, path, 0])
+            if expired is not None and not self.keep_chunks:
+                # continuous recording fills the disk otherwise (about 7.6 GB a day at 44.1 kHz)
+                try:
+                    os.remove(expired[2])
+                except OSError as e:
+                    logger.error("Could not delete %s: %s" % (expired[2], e))
+        try:
+            self._chunk.writeframes(frames)
+            self._chunk_file.flush()  # so that clip() can read it
+        except (IOError, OSError) as e:
+            self.dropped += 1
+            logger.error("Could not write to %s: %s" % (self.chunks[-1][2], e))
+            return
+        with self._lock:
+            self.chunks[-1][3] += n_frames
+            self.written = first_frame + n_frames
+
+    def _close_chunk(self):
+        if self._chunk is not None:
+            self._chunk.close()
+            self._chunk_file.close()
+            self._chunk = None
+            self._chunk_file = None
+
+    def _save_clips(self, everything=False):
+        with self._lock:
+            ready = [clip for clip in self._clips if everything or clip[1] <= self.written]
+            self._clips = [clip for clip in self._clips if clip not in ready]
+        for first, last, filename in ready:
+            try:
+                with open(filename, 'wb') as f:
+                    wf = wave.open(f, 'wb')
+                    wf.setnchannels(1)
+                    wf.setsampwidth(self.sampwidth)
+                    wf.setframerate(self.rate)
+                    wf.writeframes(self._frames(first, last))
+                    wf.close()
+            except (IOError, OSError, EOFError, wave.Error) as e:
+                logger.error("Could not save recording %s: %s" % (filename, e))
+
+    def _frame_range(self, start, end):
+        """first and last frame captured between two times"""
+        start, end = _timestamp(start), _timestamp(end)
+        with self._lock:
+            references = [block[:2] for block in self.blocks] + [chunk[:2] for chunk in self.chunks]
+        if not references:
+            raise InterfaceError('nothing has been recorded')
+        captured, first_frame = min(references, key=lambda reference: abs(reference[0] - start))
+        first = max(first_frame + int(round((start - captured) * self.rate)), 0)
+        return first, first + max(int(round((end - start) * self.rate)), 0)
+
+    def _frames(self, first, last):
+        """frames from first up to last that are still in memory or in the chunk files"""
+        with self._lock:
+            blocks = list(self.blocks)
+            chunks = [list(chunk) for chunk in self.chunks]
+        in_memory = blocks[0][1] if blocks else last
+        parts = []
+        if first < in_memory:
+            for captured, chunk_first, path, n_frames in chunks:
+                start = max(first, chunk_first)
+                stop = min(last, in_memory, chunk_first + n_frames)
+                if stop > start:
+                    with closing(wave.open(path, 'rb')) as wf:
+                        wf.setpos(start - chunk_first)
+                        parts.append(wf.readframes(stop - start))
+        for captured, block_first, frames in blocks:
+            start = max(first, block_first)
+            stop = min(last, block_first + len(frames) // self.sampwidth)
+            if stop > start:
+                parts.append(frames[(start - block_first) * self.sampwidth:(stop - block_first) * self.sampwidth])
+        return ''.join(parts)
+
+    def clip(self, start, end):
+        return self._frames(*self._frame_range(start, end))
+
+    def save_clip(self, start, end, filename):
+        first, last = self._frame_range(start, end)
+        if not os.path.isabs(filename) and self.directory is not None:
+            filename = os.path.join(self.directory, filename)
+        with self._lock:
+            self._clips.append((first, last, filename))
+        return filename
+
+
+class LevelMeter(object):
+    """Measures the level of each block of recorded audio and keeps a short history of it
+
+    For each block, measure() finds the RMS and peak (as fractions of full scale), the number of clipped samples
+    (at or above clip_level) and whether the block is silent (RMS below silence_level), with numpy over the whole
+    block. The last history blocks are kept in a numpy record array. If publish_to is given, a summary of the last
+    publish_seconds is written to that json file every publish_interval seconds, for the GUI to show.
+
+    Keyword arguments:
+    sampwidth -- bytes per sample of the (mono) audio
+    history -- number of blocks kept
+    clip_level -- fraction of full scale counted as clipping
+    silence_level -- RMS, as a fraction of full scale, below which a block is silent (default -60 dBFS)
+    publish_to -- json file the summary is written to
+    publish_interval -- seconds between writes of the summary
+    publish_seconds -- seconds of history summarized
+
+    Methods:
+    measure(captured, frames) -- measures a block of frames captured at time.time() captured
+    history(seconds) -- the measurements of the last seconds, oldest first
+    summary(seconds) -- dictionary of the level over the last seconds
+    publish() -- writes the summary to publish_to
+    """
+
+    DTYPE = [('time', 'f8'), ('rms', 'f4'), ('peak', 'f4'), ('clipped', 'u4'), ('silent', '?')]
+
+    def __init__(self, sampwidth=2, history=1200, clip_level=0.999, silence_level=0.001, publish_to=None,
+                 publish_interval=5.0, publish_seconds=60.0):
+        if sampwidth not in (1, 2, 4):
+            raise ValueError('cannot measure %d byte samples' % sampwidth)
+        self.sampwidth = sampwidth
+        self.clip_level = clip_level
+        self.silence_level = silence_level
+        self.publish_to = publish_to
+        self.publish_interval = publish_interval
+        self.publish_seconds = publish_seconds
+        self.levels = np.zeros(history, dtype=self.DTYPE)
+        self.count = 0  # blocks measured
+        self._published = 0.0
+        self._lock = threading.Lock()
+
+    def measure(self, captured, frames):
+        if self.sampwidth == 1:
+            samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 2 ** 7
+        else:
+            samples = np.frombuffer(frames, dtype='<i%d' % self.sampwidth) / float(2 ** (8 * self.sampwidth - 1))
+        if len(samples) == 0:
+            return
+        magnitude = np.abs(samples)
+        rms = np.sqrt(np.mean(np.square(samples)))
+        with self._lock:
+            self.levels[self.count % len(self.levels)] = (captured, rms, magnitude.max(),
+                                                          np.count_nonzero(magnitude >= self.clip_level),
+                                                          rms < self.silence_level)
+            self.count += 1
+        if self.publish_to is not None and captured - self._published >= self.publish_interval:
+            self._published = captured
+            self.publish()
+
+    def history(self, seconds=None):
+        with self._lock:
+            if self.count < len(self.levels):
+                levels = self.levels[:self.count].copy()
+            else:
+                levels = np.roll(self.levels, -(self.count % len(self.levels)))
+        if seconds is not None and len(levels):
+            levels = levels[levels['time'] >= levels['time'][-1] - seconds]
+        return levels
+
+    def summary(self, seconds=60.0):
+        levels = self.history(seconds)
+        if not len(levels):
+            return {'time': None, 'blocks': 0}
+
+        def dbfs(level):
+            return round(20 * np.log10(max(float(level), 1e-10)), 1)
+
+        return {'time': float(levels['time'][-1]),
+                'blocks': len(levels),
+                'rms_dbfs': dbfs(np.sqrt(np.mean(np.square(levels['rms'].astype(np.float64))))),
+                'peak_dbfs': dbfs(levels['peak'].max()),
+                'last_rms_dbfs': dbfs(levels['rms'][-1]),
+                'clipped_samples': int(levels['clipped'].sum()),
+                'silent_fraction': round(float(np.mean(levels['silent'])), 3),
+                }
+
+    def publish(self):
+        temp_file = self.publish_to + '.tmp'
+        try:
+            with open(temp_file, 'w') as f:
+                json.dump(self.summary(self.publish_seconds), f)
+            os.rename(temp_file, self.publish_to)  # so that the GUI never reads half a file
+        except (IOError, OSError) as e:
+            logger.warning("Could not publish audio levels to %s: %s" % (self.publish_to, e))
+
+
+ALSA_CARDS = '/proc/asound/cards'
+_CARD_LINE = re.compile(r'^\s*(\d+)\s+\[(\S+)\s*\]')
+_HW_NAME = re.compile(r'\(hw:(\d+),')
+
+
+class AudioHost(object):
+    """Holds the one PortAudio host of the process and resolves device names to device indices
+
+    PortAudio lists the devices once, when it is initialized, so looking a name up scans that list and the result is
+    remembered. The devices are looked up again when the sound cards in /proc/asound/cards change (a card was plugged
+    or unplugged) or when refresh() is called after a device failed to open. Only restarting PortAudio lists new cards,
+    but that would stop every stream open on the host, such as a persistent output or a recording, so streams are
+    opened and closed through the host and it is only restarted once none is open.
+
+    Keyword arguments:
+    backend -- called to make the PyAudio object (default pyaudio.PyAudio), e.g. pyaudio_emulator.NullPyAudio
+
+    Methods:
+    find(device_name, io_type) -- index of the first device with input or output channels whose name starts with the
+        same 18 characters as device_name
+    find_card(card_name, io_type) -- index of the device on the ALSA card with id card_name
+    device_info(index) -- PortAudio's info for the device
+    open(**kwargs) -- opens a stream, taking the keyword arguments of pyaudio.PyAudio.open
+    close(stream) -- closes a stream opened by open()
+    refresh() -- forgets the devices found, and restarts PortAudio now or, if streams are open, once they're closed
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else pyaudio.PyAudio
+        self._pa = None
+        self._devices = []
+        self._found = {}
+        self._cards = None
+        self._streams = set()
+        self._stale = False  # restart PortAudio once no stream is open
+        self._lock = threading.RLock()
+
+    @property
+    def pa(self):
+        with self._lock:
+            if self._pa is not None and self._stale and not self._streams:
+                self._terminate()
+            if self._pa is None:
+                self._pa = self.backend()
+                self._list_devices()
+            return self._pa
+
+    def _list_devices(self):
+        self._devices = [self._pa.get_device_info_by_index(index) for index in range(self._pa.get_device_count())]
+        self._cards = self._read_cards()
+        logger.debug("Found %d audio devices" % len(self._devices))
+
+    def _read_cards(self):
+        try:
+            with open(ALSA_CARDS) as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _check_hotplug(self):
+        if self._pa is not None and self._read_cards() != self._cards:
+            logger.info("Sound cards changed, listing audio devices again")
+            self.refresh()
+
+    def _terminate(self):
+        self._pa.terminate()
+        self._pa = None
+        self._devices = []
+        self._stale = False
+
+    def refresh(self):
+        with self._lock:
+            self._found = {}
+            if self._pa is None:
+                return
+            if self._streams:
+                logger.info("%d audio streams are open, PortAudio will list new devices once they're closed"
+                            % len(self._streams))
+                self._stale = True
+                self._list_devices()
+            else:
+                self._terminate()
+
+    def open(self, **kwargs):
+        with self._lock:
+            stream = self.pa.open(**kwargs)
+            self._streams.add(stream)
+            return stream
+
+    def close(self, stream):
+        with self._lock:
+            self._streams.discard(stream)
+        stream.close()
+
+    def device_info(self, index):
+        with self._lock:
+            self.pa
+            return self._devices[index]
+
+    def _channels_key(self, io_type):
+        if io_type == 'output':
+            return 'maxOutputChannels'
+        elif io_type == 'input':
+            return 'maxInputChannels'
+        raise ValueError("io_type must be 'input' or 'output', not %s" % io_type)
+
+    def find(self, device_name, io_type='output'):
+        channels = self._channels_key(io_type)
+        with self._lock:
+            self._check_hotplug()
+            key = ('name', device_name, io_type)
+            if key not in self._found:
+                self.pa
+                for index, info in enumerate(self._devices):
+                    # Device names are customized in Linux implementations (e.g., 'board01'), only compare the start
+                    if info.get(channels) > 0 and device_name[:18] == info['name'][:18]:
+                        self._found[key] = index
+                        break
+                else:
+                    raise InterfaceError('could not find pyaudio device %s' % device_name)
+            return self._found[key]
+
+    def find_card(self, card_name, io_type='input'):
+        """ALSA card numbers don't match PortAudio's device indices, and identical USB cards can't be told apart by
+        name, so cards are named by udev (by USB port) and found through the hw:N in PortAudio's device names
+        """
+        channels = self._channels_key(io_type)
+        with self._lock:
+            self._check_hotplug()
+            key = ('card', card_name, io_type)
+            if key not in self._found:
+                self.pa
+                card = None
+                for line in (self._cards or '').splitlines():
+                    match = _CARD_LINE.match(line)
+                    if match is not None and match.group(2) == card_name:
+                        card = int(match.group(1))
+                        break
+                if card is None:
+                    raise InterfaceError('could not find sound card %s' % card_name)
+                for index, info in enumerate(self._devices):
+                    match = _HW_NAME.search(info['name'])
+                    if info.get(channels) > 0 and match is not None and int(match.group(1)) == card:
+                        self._found[key] = index
+                        break
+                else:
+                    raise InterfaceError('could not find pyaudio device for sound card %s' % card_name)
+            return self._found[key]
+
+
+# Shared by every PyAudioInterface in the process unless one is given its own
+audio_host = AudioHost()
 
 
 class PyAudioInterface(base_.BaseInterface):
@@ -16,57 +615,102 @@ class PyAudioInterface(base_.BaseInterface):
     Before assigning any callback function, please read the following:
     https://www.assembla.com/spaces/portaudio/wiki/Tips_Callbacks
 
+    Wav files are read through a StimulusCache, so self.wf is a CachedWave
+    over frames held in memory and the callback reads slices of them.
+
+    With persistent=True, one output stream is opened with the interface
+    and kept running, writing silence between stimuli. Queueing, playing
+    and stopping then only change which frames the callback reads, so a
+    stimulus starts on the next buffer without opening the device. The
+    stream runs at rate (the device's default rate if None) with 16 bit
+    samples; a stimulus in another format reopens it in that format.
+
+    When a stimulus is played, onset_time is set to the time (as
+    time.time()) that PortAudio expects its first buffer to reach the DAC,
+    and onset_latency to the seconds from _play_wav to then. underflows
+    counts the buffers that PortAudio flagged as late.
+
+    After _preprocess_wavs, stimuli are played from copies converted to
+    mono at the stream's rate by a preprocess.StimulusPreprocessor.
+
+    Devices are opened through an AudioHost, by default the one shared by
+    the process, so opening an interface doesn't start PortAudio and list
+    the devices again. If PortAudio can't open a stream, the host is
+    refreshed and the stream opened once more.
+
+    With by_card=True, device_name is the id of an ALSA card (e.g. the
+    'sound01' that udev names a box's microphone card) rather than the
+    start of a PortAudio device name, and the device is found with
+    AudioHost.find_card.
+
     """
 
-    def __init__(self, device_name='default', io_type='output', *args, **kwargs):
+    def __init__(self, device_name='default', io_type='output', cache=None, persistent=False, rate=None,
+                 host=None, by_card=False, *args, **kwargs):
         super(PyAudioInterface, self).__init__(*args, **kwargs)
         self.device_name = device_name
         self.device_index = None
+        self.by_card = by_card
         self.stream = None
         self.wf = None
         self.io_type = io_type
+        self.cache = cache if cache is not None else stimulus_cache
+        self.persistent = persistent and io_type == 'output'
+        self.rate = rate
+        self.stream_format = None  # (sampwidth, rate) of the persistent stream
+        self.playing = False
+        self._playback_lock = threading.Lock()
+        self.host = host if host is not None else audio_host
+        self.onset_time = None
+        self.onset_latency = None
+        self.underflows = 0
+        self._play_time = None
+        self._onset_pending = False
+        self.recorder = None
+        self.record_stream = None
+        self.preprocessor = None
         self.open()
 
-    def open(self):
-        self.pa = pyaudio.PyAudio()
-        # Get device index based on device name, which is customized in Linux implementations (e.g., 'board01')
-        if self.io_type == 'output':
-            for index in range(self.pa.get_device_count()):
-                deviceInfo = self.pa.get_device_info_by_index(index)
-                truncName = deviceInfo['name']
-                # if self.device_name == self.pa.get_device_info_by_index(index)['name']:
-                if deviceInfo.get('maxOutputChannels') > 0 and self.device_name[:18] == truncName[:18]:  # only check
-                    # the first 7 characters
-                    self.device_index = index
-                    break
-                else:
-                    self.device_index = None
-        elif self.io_type == 'input':
-            for index in range(self.pa.get_device_count()):
-                deviceInfo = self.pa.get_device_info_by_index(index)
-                truncName = deviceInfo['name']
-                # if self.device_name == self.pa.get_device_info_by_index(index)['name']:
-                if deviceInfo.get('maxInputChannels') > 0 and self.device_name[:18] == truncName[:18]:  # only check
-                    # the first 7 characters
-                    self.device_index = index
-                    break
-                else:
-                    self.device_index = None
-        if self.device_index is None:
-            raise InterfaceError('could not find pyaudio device %s' % self.device_name)
+    def _find_device(self):
+        if self.by_card:
+            self.device_index = self.host.find_card(self.device_name, self.io_type)
+        else:
+            self.device_index = self.host.find(self.device_name, self.io_type)
+        self.device_info = self.host.device_info(self.device_index)
+        self.pa = self.host.pa
+
+    def _open_stream(self, **kwargs):
+        """opens a PortAudio stream on the device. If that fails, e.g. because the card was replugged and PortAudio's
+        device list is stale, the host is refreshed and the stream opened once more
+        """
+        index_key = 'input_device_index' if kwargs.get('input') else 'output_device_index'
+        try:
+            return self.host.open(**kwargs)
+        except IOError as e:
+            logger.warning("Could not open a stream on %s (%s), listing audio devices again" % (self.device_name, e))
+            self.host.refresh()
+            self._find_device()
+            kwargs[index_key] = self.device_index
+            return self.host.open(**kwargs)
 
-        self.device_info = self.pa.get_device_info_by_index(self.device_index)
+    def open(self):
+        self._find_device()
+        if self.persistent:
+            self._open_persistent(2, self.rate or int(self.device_info['defaultSampleRate']))
 
     def close(self):
+        self._stop_recording()
+        self.playing = False
+        self.stream_format = None
         try:
-            self.stream.close()
+            self.host.close(self.stream)
         except AttributeError:
             self.stream = None
         try:
             self.wf.close()
         except AttributeError:
             self.wf = None
-        self.pa.terminate()
+        # the PortAudio host is shared, so it is left running
 
     def validate(self):
         if self.wf is not None:
@@ -77,6 +721,18 @@ class PyAudioInterface(base_.BaseInterface):
         else:
             raise InterfaceError('there is something wrong with this wav file')
 
+    def _mark_onset(self, time_info):
+        """called from the stream callback; if a stimulus was just played, records when its first buffer is output"""
+        if not self._onset_pending:
+            return
+        self._onset_pending = False
+        now = time.time()
+        if time_info.get('output_buffer_dac_time') and time_info.get('current_time'):
+            self.onset_time = now + time_info['output_buffer_dac_time'] - time_info['current_time']
+        else:  # some host APIs leave the stream times at 0
+            self.onset_time = now + self.stream.get_output_latency()
+        self.onset_latency = self.onset_time - self._play_time
+
     def _get_stream(self, start=False, callback=None):
         """
         """
@@ -85,15 +741,23 @@ class PyAudioInterface(base_.BaseInterface):
                 data = self.wf.readframes(frame_count)
                 return data, pyaudio.paContinue
 
-        self.stream = self.pa.open(format=self.pa.get_format_from_width(self.wf.getsampwidth()),
-                                   # channels=self.wf.getnchannels(),
-                                   channels=1,  # fixed to 1 for single-channel (mono) stimuli
-                                   rate=self.wf.getframerate(),
-                                   # input=True,
-                                   output=True,
-                                   output_device_index=self.device_index,
-                                   start=start,
-                                   stream_callback=callback)
+        stimulus_callback = callback
+
+        def callback(in_data, frame_count, time_info, status):
+            if status & pyaudio.paOutputUnderflow:
+                self.underflows += 1
+            self._mark_onset(time_info)
+            return stimulus_callback(in_data, frame_count, time_info, status)
+
+        self.stream = self._open_stream(format=self.pa.get_format_from_width(self.wf.getsampwidth()),
+                                        # channels=self.wf.getnchannels(),
+                                        channels=1,  # fixed to 1 for single-channel (mono) stimuli
+                                        rate=self.wf.getframerate(),
+                                        # input=True,
+                                        output=True,
+                                        output_device_index=self.device_index,
+                                        start=start,
+                                        stream_callback=callback)
 
     def _get_input_stream(self, start=False, callback=None):
         """
@@ -106,27 +770,107 @@ class PyAudioInterface(base_.BaseInterface):
         CHUNK = 4096  # recording chunk size
         RATE = 44100  # recording sampling rate
 
-        self.stream = self.pa.open(format=self.pa.get_format_from_width(self.wf.getsampwidth()),
-                                   # channels=self.wf.getnchannels(),
-                                   channels=1,  # fixed to 1 for single-channel (mono) stimuli
-                                   rate=RATE,
-                                   input=True,
-                                   input_device_index=self.device_index,
-                                   start=start,
-                                   frames_per_buffer=CHUNK,
-                                   stream_callback=callback)
+        self.stream = self._open_stream(format=self.pa.get_format_from_width(self.wf.getsampwidth()),
+                                        # channels=self.wf.getnchannels(),
+                                        channels=1,  # fixed to 1 for single-channel (mono) stimuli
+                                        rate=RATE,
+                                        input=True,
+                                        input_device_index=self.device_index,
+                                        start=start,
+                                        frames_per_buffer=CHUNK,
+                                        stream_callback=callback)
+
+    def _open_persistent(self, sampwidth, rate):
+        """(re)opens the persistent output stream, which plays silence until a stimulus is played"""
+        if self.stream is not None:
+            self.host.close(self.stream)
+        silence = ('\x80' if sampwidth == 1 else '\x00') * sampwidth  # 8 bit wav samples are unsigned
+
+        def callback(in_data, frame_count, time_info, status):
+            with self._playback_lock:
+                data = ''
+                if status & pyaudio.paOutputUnderflow:
+                    self.underflows += 1
+                if self.playing and self.wf is not None:
+                    self._mark_onset(time_info)
+                    data = self.wf.readframes(frame_count)
+                    if len(data) < frame_count * sampwidth:
+                        self.playing = False
+            return data + silence * (frame_count - len(data) // sampwidth), pyaudio.paContinue
+
+        self.stream = self._open_stream(format=self.pa.get_format_from_width(sampwidth),
+                                        channels=1,  # fixed to 1 for single-channel (mono) stimuli
+                                        rate=rate,
+                                        output=True,
+                                        output_device_index=self.device_index,
+                                        start=True,
+                                        stream_callback=callback)
+        self.stream_format = (sampwidth, rate)
 
     def _queue_wav(self, wav_file, start=False, callback=None):
-        self.wf = wave.open(wav_file)
+        if self.preprocessor is not None:
+            wav_file = self.preprocessor.path(wav_file)
+        wf = self.cache.open(wav_file)
+        if not self.persistent:
+            self.wf = wf
+            self.validate()
+            self._get_stream(start=start, callback=callback)
+            return
+
+        if callback is not None:
+            raise InterfaceError('a persistent stream cannot take a stimulus callback')
+        with self._playback_lock:
+            self.playing = False
+            self.wf = wf
         self.validate()
-        self._get_stream(start=start, callback=callback)
+        stream_format = (wf.getsampwidth(), wf.getframerate())
+        if stream_format != self.stream_format:
+            logger.warning("Reopening the output stream of %s for %d bit, %d Hz audio" %
+                           (self.device_name, 8 * stream_format[0], stream_format[1]))
+            self._open_persistent(*stream_format)
+        if start:
+            self._play_wav()
+
+    def _warm_wavs(self, wav_files):
+        """read wav files into the stimulus cache ahead of the trials that play them"""
+        if self.preprocessor is not None:
+            wav_files = [self.preprocessor.path(wav_file) for wav_file in wav_files]
+        self.cache.warm(wav_files)
+
+    def _preprocess_wavs(self, wav_files, cache_dir, rate=None, **kwargs):
+        """converts wav files to mono at the rate of the stream (see preprocess.StimulusPreprocessor for kwargs), so
+        that from then on queueing one of them plays its converted copy
+        """
+        rate = rate or (self.stream_format[1] if self.stream_format else None) or self.rate or \
+            int(self.device_info['defaultSampleRate'])
+        self.preprocessor = preprocess.StimulusPreprocessor(cache_dir, rate, **kwargs)
+        return self.preprocessor.prepare(wav_files)
 
     def _play_wav(self):
+        with self._playback_lock:
+            self.onset_time = None
+            self.onset_latency = None
+            self._play_time = time.time()
+            self._onset_pending = True
+            if self.persistent:
+                self.playing = True
+                return
         self.stream.start_stream()
 
+    def _onset_latency(self):
+        """seconds from the last _play_wav to its first buffer reaching the DAC, or None if it hasn't been output"""
+        return self.onset_latency
+
     def _stop_wav(self):
+        if self.persistent:
+            # leave the stream running; the callback goes back to writing silence
+            with self._playback_lock:
+                self.playing = False
+                if self.wf is not None:
+                    self.wf.rewind()
+            return
         try:
-            self.stream.close()
+            self.host.close(self.stream)
         except AttributeError:
             self.stream = None
         try:
@@ -134,5 +878,53 @@ class PyAudioInterface(base_.BaseInterface):
         except AttributeError:
             self.wf = None
 
-    def _record_input(self):
-        pass
+    def _start_recording(self, directory=None, levels_file=None, **kwargs):
+        """starts recording continuously from the device into an AudioRecorder, which gets the keyword arguments.
+        With a levels_file, the level of the audio is measured and published there
+        """
+        if self.recorder is not None:
+            return self.recorder
+        rate = self.rate or int(self.device_info['defaultSampleRate'])
+        if levels_file is not None:
+            kwargs['meter'] = LevelMeter(sampwidth=2, publish_to=levels_file)
+        recorder = AudioRecorder(directory, rate=rate, sampwidth=2, **kwargs)
+        recorder.start()
+        try:
+            self.record_stream = self._open_stream(format=self.pa.get_format_from_width(2),
+                                                   channels=1,
+                                                   rate=rate,
+                                                   input=True,
+                                                   input_device_index=self.device_index,
+                                                   frames_per_buffer=recorder.frames_per_buffer,
+                                                   start=True,
+                                                   stream_callback=recorder.callback)
+        except IOError as e:
+            recorder.stop()
+            raise InterfaceError('could not record from pyaudio device %s: %s' % (self.device_name, e))
+        self.recorder = recorder
+        return recorder
+
+    def _stop_recording(self):
+        if self.recorder is None:
+            return
+        try:
+            self.host.close(self.record_stream)
+        except AttributeError:
+            pass
+        self.record_stream = None
+        self.recorder.stop()
+        self.recorder = None
+
+    def _levels(self, seconds=60.0):
+        """summary of the level of the last seconds of input, or None if it isn't being measured"""
+        if self.recorder is None or self.recorder.meter is None:
+            return None
+        return self.recorder.meter.summary(seconds)
+
+    def _record_clip(self, start, end, filename=None):
+        """returns the recorded frames between two times or, given a filename, saves them there without waiting"""
+        if self.recorder is None:
+            raise InterfaceError('pyaudio device %s is not recording' % self.device_name)
+        if filename is None:
+            return self.recorder.clip(start, end)
+        return self.recorder.save_clip(start, end, filename)
@@ -0,0 +1,130 @@
+"""Stands in for pyaudio.PyAudio with output devices that play to nowhere, so that PyAudioInterface can be run and
+measured without a sound card. Streams run their callback from a thread at the pace a device would ask for buffers, and
+report PortAudio style time_info and underflow flags.
+
+    host = AudioHost(backend=lambda: NullPyAudio(output_latency=0.01))
+    interface = PyAudioInterface(device_name='null', host=host)
+"""
+import time
+import threading
+import logging
+import pyaudio
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEVICES = [{'index': 0,
+                    'name': 'null',
+                    'maxOutputChannels': 2,
+                    'maxInputChannels': 0,
+                    'defaultSampleRate': 48000.0,
+                    },
+                   ]
+
+
+class NullStream(object):
+    """A callback output stream on a NullPyAudio device
+
+    The callback is asked for frames_per_buffer frames every buffer period. Each buffer reaches the (imaginary) DAC
+    output_latency seconds after the callback is asked for it. If the callback thread falls more than a buffer behind,
+    the next call is flagged with paOutputUnderflow and the schedule restarts from the current time.
+    """
+
+    def __init__(self, rate, stream_callback, output_latency=0.01, frames_per_buffer=1024, start=True, format=None,
+                 channels=1, **kwargs):
+        self.rate = rate
+        self.callback = stream_callback
+        self.output_latency = output_latency
+        self.frames_per_buffer = frames_per_buffer if frames_per_buffer else 1024
+        self.sampwidth = pyaudio.get_sample_size(format) if format is not None else 2
+        self.channels = channels
+        self.frames_written = 0
+        self.underflows = 0
+        self.closed = False
+        self._active = False
+        self._thread = None
+        self._started = time.time()
+        if start:
+            self.start_stream()
+
+    def _run(self):
+        period = float(self.frames_per_buffer) / self.rate
+        deadline = time.time()
+        while self._active:
+            now = time.time()
+            status = 0
+            if now > deadline + period:
+                status = pyaudio.paOutputUnderflow
+                self.underflows += 1
+                deadline = now
+            time_info = {'input_buffer_adc_time': 0.0,
+                         'current_time': now - self._started,
+                         'output_buffer_dac_time': deadline - self._started + self.output_latency,
+                         }
+            data, flag = self.callback(None, self.frames_per_buffer, time_info, status)
+            self.frames_written += len(data) // (self.sampwidth * self.channels)
+            if flag != pyaudio.paContinue:
+                break
+            deadline += period
+            time.sleep(max(deadline - time.time(), 0))
+        self._active = False
+
+    def start_stream(self):
+        if self._active:
+            return
+        self._active = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop_stream(self):
+        self._active = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def is_active(self):
+        return self._active
+
+    def is_stopped(self):
+        return not self._active
+
+    def get_output_latency(self):
+        return self.output_latency
+
+    def close(self):
+        self.stop_stream()
+        self.closed = True
+
+
+class NullPyAudio(object):
+    """Has the methods of pyaudio.PyAudio that PyAudioInterface uses, over devices that play to nowhere
+
+    Keyword arguments:
+    devices -- list of device info dictionaries, as returned by get_device_info_by_index
+    output_latency -- time, in seconds, from a buffer being asked for to it reaching the DAC
+    """
+
+    def __init__(self, devices=None, output_latency=0.01):
+        self.devices = devices if devices is not None else DEFAULT_DEVICES
+        self.output_latency = output_latency
+        self.streams = []
+
+    def get_device_count(self):
+        return len(self.devices)
+
+    def get_device_info_by_index(self, index):
+        return self.devices[index]
+
+    def get_format_from_width(self, width):
+        return pyaudio.get_format_from_width(width)
+
+    def open(self, rate, input=False, output=False, stream_callback=None, **kwargs):
+        if input or stream_callback is None:
+            raise NotImplementedError('NullPyAudio only has callback output streams')
+        stream = NullStream(rate, stream_callback, output_latency=self.output_latency, **kwargs)
+        self.streams.append(stream)
+        return stream
+
+    def terminate(self):
+        for stream in self.streams:
+            stream.close()
+        self.streams = []
@@ -1,6 +1,9 @@
-from pyoperant import hwio, components, panels, utils
+import logging
+from pyoperant import hwio, components, panels, utils, InterfaceError
 from pyoperant.interfaces import pyaudio_, arduino_
 
+logger = logging.getLogger(__name__)
+
 _ROUSE_MAP = {
     1: ('/dev/teensy01', 2, 0, 2, 8),  # box_id:(subdevice,in_dev,in_chan,out_dev,out_chan)
     2: ('/dev/teensy02', 2, 4, 2, 16),
@@ -47,7 +50,18 @@ class RousePanel(panels.BasePanel):
                                                    )
                                 )
 
+        # write every output with a single message when resetting the panel
+        self.output_frame = hwio.BooleanOutputGroup(self.outputs)
+
         self.speaker = hwio.AudioOutput(interface=self.interfaces['pyaudio'])
+        # the microphone is on its own USB card, which udev names by USB port (see AudioHost.find_card). A box without
+        # one can still run, just without recording
+        try:
+            self.interfaces['microphone'] = pyaudio_.PyAudioInterface(device_name='sound%02i' % self.id,
+                                                                      io_type='input', by_card=True)
+            self.microphone = hwio.AudioInput(interface=self.interfaces['microphone'])
+        except InterfaceError as e:
+            logger.warning('No microphone for box %s: %s' % (self.id, e))
 
         # assemble inputs into components
         self.trialSens = components.PeckPort(ir=self.inputs[0], led=self.outputs[0])  #
@@ -60,10 +74,8 @@ class RousePanel(panels.BasePanel):
         self.punish = self.house_light.punish
 
     def reset(self):
-        for output in self.outputs:
-            output.write(False)
-        self.house_light.on()
-        self.water.off()
+        # everything off. The house light is inverted, so this also turns it on
+        self.output_frame.write(False)
 
     def test(self):
         print('reset')
@@ -52,9 +52,9 @@ class VogelPanel(panels.BasePanel):
         self.punish = self.house_light.punish
 
     def reset(self):
-        for output in self.outputs:
-            output.write(False)
-        self.house_light.on()
+        # everything off but the house light, written a bank of channels at a time. The group is built here because
+        # subclasses add outputs after this __init__
+        hwio.BooleanOutputGroup(self.outputs).write([output is self.house_light.light for output in self.outputs])
         self.hopper.down()
 
     def test(self):
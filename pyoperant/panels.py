@@ -1,4 +1,12 @@
 ## Panel classes
+import time
+import datetime
+from pyoperant import hwio, utils
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 
 class BasePanel(object):
@@ -43,5 +51,54 @@ class BasePanel(object):
         self.inputs = []
         self.outputs = []
 
+        # time, in seconds, between samples in wait_any() when the ports' edges aren't pushed by their interfaces
+        self.poll_interval = 0.005
+
     def reset(self):
         raise NotImplementedError
+
+    def wait_any(self, ports, timeout=None):
+        """Wait for the first of several ports to become active.
+
+        The ports are first read together, with one request per interface
+        that supports batched reads. If every port's input has its edges
+        pushed by its interface, the wait is then for the first rising edge,
+        without touching the hardware. Otherwise the ports are read together
+        every poll_interval seconds.
+
+        ports -- list of components with an 'IR' input, such as PeckPort
+        timeout -- the time, in seconds, to wait. Defaults to no timeout
+
+        Returns (port, timestamp) for the first port found active, or
+        (None, None) if the wait times out.
+        """
+        sensors = hwio.BooleanInputGroup([port.IR for port in ports])
+        pushed = all(getattr(sensor, 'pushed', False) for sensor in sensors.inputs)
+        start = time.time()
+        waiter = queue.Queue()
+        if pushed:
+            # listen before the first read so that no edge falls between the two
+            for sensor in sensors.inputs:
+                sensor._add_edge_waiter(waiter, True)
+        try:
+            while True:
+                for port, value in zip(ports, sensors.read()):
+                    if value:
+                        return port, datetime.datetime.now()
+                if pushed:
+                    break
+                if timeout is not None and time.time() - start >= timeout:
+                    return None, None
+                utils.wait(self.poll_interval)
+
+            if timeout is not None:
+                timeout = max(timeout - (time.time() - start), 0)
+            item = hwio._wait_for(waiter, timeout)
+            if item is None:
+                return None, None
+            sensor, (timestamp, value) = item
+            return ports[sensors.inputs.index(sensor)], timestamp
+        finally:
+            if pushed:
+                for sensor in sensors.inputs:
+                    sensor._remove_edge_waiter(waiter)
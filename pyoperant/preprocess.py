@@ -0,0 +1,185 @@
+"""Prepares stimuli for playback ahead of time, so that nothing is converted while a stimulus plays
+
+Each stimulus is downmixed to mono, resampled to the rate of the output device, optionally scaled to a target RMS level
+and optionally given cosine ramps at its onset and offset, then saved as a 16 bit wav file. Processed files are kept in
+a cache directory under a name made from the SHA-1 of the source file and the processing options, so a stimulus is
+only processed again when it or the options change, and boxes can share a cache.
+
+    preprocessor = StimulusPreprocessor('/path/to/cache', rate=48000, rms=0.05, ramp=0.005)
+    processed = preprocessor.prepare(['a.wav', 'b.wav'])  # {'a.wav': '/path/to/cache/3f/3f2a....wav', ...}
+
+It can also be run on its own, e.g. when a stimulus set is installed:
+
+    python -m pyoperant.preprocess --cache /path/to/cache --rate 48000 --rms 0.05 stims/*.wav
+"""
+import os
+import wave
+import json
+import logging
+import hashlib
+import argparse
+import fractions
+import multiprocessing
+from contextlib import closing
+
+import numpy as np
+import scipy.signal
+
+from pyoperant import utils
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1  # change when processing changes, so that old results aren't used
+
+
+def read_wav(wav_file):
+    """ returns the sampling rate of a wav file and its samples as a (frames x channels) array, as fractions of
+    full scale
+    """
+    with closing(wave.open(wav_file, 'rb')) as wf:
+        nchannels, sampwidth, framerate, nframes = wf.getparams()[:4]
+        data = np.frombuffer(wf.readframes(nframes), dtype=np.uint8)
+    if sampwidth == 1:
+        samples = (data.astype(np.float64) - 128) / 2 ** 7  # 8 bit wav samples are unsigned
+    elif sampwidth == 3:
+        data = data.reshape(-1, 3).astype(np.int32)
+        samples = ((data[:, 0] << 8 | data[:, 1] << 16 | data[:, 2] << 24) >> 8) / float(2 ** 23)
+    else:
+        samples = np.frombuffer(data.tobytes(), dtype='<i%d' % sampwidth) / float(2 ** (8 * sampwidth - 1))
+    return framerate, samples.reshape(-1, nchannels)
+
+
+def process(samples, source_rate, rate, rms=None, ramp=0.0):
+    """ downmixes (frames x channels) samples to mono, resamples them from source_rate to rate, scales them to an RMS
+    of rms (as a fraction of full scale) and ramps ramp seconds at each end. Returns a 1d array
+    """
+    mono = samples.mean(axis=1)
+    if source_rate != rate:
+        ratio = fractions.Fraction(int(rate), int(source_rate))
+        mono = scipy.signal.resample_poly(mono, ratio.numerator, ratio.denominator)
+    if rms is not None and len(mono):
+        level = np.sqrt(np.mean(np.square(mono)))
+        if level > 0:
+            gain = rms / level
+            peak = np.max(np.abs(mono)) * gain
+            if peak > 1.0:
+                logger.warning("Scaling to %.3f RMS would clip (peak %.2f), scaled to a peak of 1.0 instead"
+                               % (rms, peak))
+                gain /= peak
+            mono = mono * gain
+    n_ramp = min(int(round(ramp * rate)), len(mono) // 2)
+    if n_ramp > 0:
+        window = 0.5 - 0.5 * np.cos(np.pi * np.arange(n_ramp) / n_ramp)
+        mono = mono.copy()
+        mono[:n_ramp] *= window
+        mono[-n_ramp:] *= window[::-1]
+    return mono
+
+
+def write_wav(wav_file, samples, rate):
+    """ writes 1d samples, as fractions of full scale, to a 16 bit mono wav file """
+    data = np.clip(np.round(samples * 2 ** 15), -2 ** 15, 2 ** 15 - 1).astype('<i2')
+    with closing(wave.open(wav_file, 'wb')) as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(int(rate))
+        wf.writeframes(data.tobytes())
+
+
+def _process_file(job):
+    """ processes one stimulus. Runs in a worker process, so it takes and returns plain values """
+    source, destination, options = job
+    try:
+        source_rate, samples = read_wav(source)
+        processed = process(samples, source_rate, **options)
+        temp_file = '%s.%d.tmp' % (destination, os.getpid())
+        write_wav(temp_file, processed, options['rate'])
+        os.rename(temp_file, destination)  # so that a half written file is never used
+    except (IOError, OSError, EOFError, wave.Error, ValueError) as e:
+        return source, str(e)
+    return source, None
+
+
+class StimulusPreprocessor(object):
+    """ Processes stimuli into a content-addressed cache directory
+
+    Keyword arguments:
+    cache_dir -- directory the processed files are kept in
+    rate -- sampling rate, in Hz, to resample stimuli to
+    rms -- RMS level, as a fraction of full scale, to scale stimuli to (default None, not scaled)
+    ramp -- seconds of cosine ramp at the onset and offset of each stimulus (default 0.0, none)
+    processes -- number of worker processes (default None, one per CPU)
+
+    Methods:
+    key(wav_file) -- the cache key of the file with these options
+    path(wav_file) -- the processed file for wav_file, processing it if it isn't in the cache
+    prepare(wav_files) -- processes the files that aren't in the cache, in parallel, and returns a dictionary
+        of the processed file for each file
+    """
+
+    def __init__(self, cache_dir, rate, rms=None, ramp=0.0, processes=None):
+        self.cache_dir = cache_dir
+        self.options = {'rate': int(rate), 'rms': rms, 'ramp': ramp}
+        self.processes = processes
+        self._paths = {}
+
+    def key(self, wav_file):
+        source_hash = utils.get_stimulus_index(os.path.dirname(os.path.abspath(wav_file))).info(wav_file)['sha1']
+        description = json.dumps([CACHE_VERSION, source_hash, self.options], sort_keys=True)
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def _cache_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.wav')
+
+    def path(self, wav_file):
+        if wav_file not in self._paths:
+            self.prepare([wav_file])
+        return self._paths[wav_file]
+
+    def prepare(self, wav_files):
+        jobs = []
+        for wav_file in set(wav_files):
+            destination = self._cache_path(self.key(wav_file))
+            if not os.path.exists(destination):
+                if not os.path.isdir(os.path.dirname(destination)):
+                    os.makedirs(os.path.dirname(destination))
+                jobs.append((wav_file, destination, self.options))
+            self._paths[wav_file] = destination
+
+        if jobs:
+            logger.info("Preprocessing %d stimuli into %s" % (len(jobs), self.cache_dir))
+            if len(jobs) == 1 or self.processes == 1:
+                results = [_process_file(job) for job in jobs]
+            else:
+                pool = multiprocessing.Pool(self.processes)
+                try:
+                    results = pool.map(_process_file, jobs)
+                finally:
+                    pool.close()
+                    pool.join()
+            for source, error in results:
+                if error is not None:
+                    del self._paths[source]
+                    raise IOError('could not preprocess %s: %s' % (source, error))
+        return dict((wav_file, self._paths[wav_file]) for wav_file in wav_files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Preprocess stimuli into a cache directory for playback')
+    parser.add_argument('wav_files', nargs='+', help='stimuli to preprocess')
+    parser.add_argument('--cache', required=True, help='cache directory')
+    parser.add_argument('--rate', type=int, required=True, help='sampling rate of the output device, in Hz')
+    parser.add_argument('--rms', type=float, default=None, help='RMS level as a fraction of full scale')
+    parser.add_argument('--ramp', type=float, default=0.0, help='seconds of ramp at the onset and offset')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    preprocessor = StimulusPreprocessor(args.cache, args.rate, rms=args.rms, ramp=args.ramp,
+                                        processes=args.processes)
+    for source, destination in sorted(preprocessor.prepare(args.wav_files).items()):
+        print("%s %s" % (source, destination))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""Samples what a box process is using (open file descriptors, memory, CPU time and threads) from /proc, on a thread of
+its own, so that the trial loop and the GUI can report it without measuring anything themselves
+
+    monitor = ResourceMonitor(interval=10.0, publish_to='/path/to/subject.resourcesDAT')
+    monitor.start()
+    ...
+    log.debug("resources: %s" % monitor.describe())  # fds 12, rss 48.1 MB, cpu 1.2%, threads 4
+"""
+import os
+import time
+import logging
+import threading
+import collections
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+logger = logging.getLogger(__name__)
+
+try:
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+except (AttributeError, ValueError, OSError):
+    CLOCK_TICKS = 100
+
+
+def sample(pid='self'):
+    """ reads /proc/<pid> once and returns a dictionary of time (time.time()), fds (open file descriptors), rss_mb
+    (resident memory in MB), threads and cpu_seconds (user and system CPU time). Raises IOError or OSError where /proc
+    isn't available
+    """
+    proc = os.path.join('/proc', str(pid))
+    resources = {'time': time.time(),
+                 'fds': len(os.listdir(os.path.join(proc, 'fd'))),
+                 }
+    with open(os.path.join(proc, 'status'), 'r') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                resources['rss_mb'] = int(line.split()[1]) / 1024.0
+            elif line.startswith('Threads:'):
+                resources['threads'] = int(line.split()[1])
+    with open(os.path.join(proc, 'stat'), 'r') as f:
+        # the command name, in parentheses, may contain spaces, so count fields from after it
+        fields = f.read().rpartition(')')[2].split()
+    resources['cpu_seconds'] = (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)  # utime + stime
+    return resources
+
+
+class ResourceMonitor(object):
+    """ Samples the resources of this process every interval seconds on a daemon thread
+
+    Keyword arguments:
+    interval -- seconds between samples (default 10.0)
+    history -- number of samples kept (default 360, an hour at the default interval)
+    publish_to -- if given, a file that the latest sample is written to as JSON after each one, e.g. for the GUI
+
+    Methods:
+    start() -- starts sampling. Returns False if /proc can't be read
+    stop() -- stops sampling
+    latest() -- the latest sample (see sample()), with cpu_percent over the interval before it, or None
+    history() -- the samples kept, oldest first
+    describe() -- the latest sample as a line for the log
+    """
+
+    def __init__(self, interval=10.0, history=360, publish_to=None):
+        self.interval = interval
+        self.publish_to = publish_to
+        self.samples = collections.deque(maxlen=history)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        resources = sample()
+        if self.samples:
+            last = self.samples[-1]
+            elapsed = resources['time'] - last['time']
+            if elapsed > 0:
+                resources['cpu_percent'] = 100.0 * (resources['cpu_seconds'] - last['cpu_seconds']) / elapsed
+        self.samples.append(resources)  # deque appends are atomic, so readers don't need a lock
+        if self.publish_to is not None:
+            self.publish()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self._sample()
+            except (IOError, OSError) as e:
+                logger.warning("Could not sample resources: %s" % e)
+
+    def start(self):
+        if self._thread is not None:
+            return True
+        try:
+            self._sample()
+        except (IOError, OSError) as e:
+            logger.warning("Not monitoring resources, /proc can't be read: %s" % e)
+            return False
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='ResourceMonitor')
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def latest(self):
+        try:
+            return dict(self.samples[-1])
+        except IndexError:
+            return None
+
+    def history(self):
+        return list(self.samples)
+
+    def describe(self):
+        resources = self.latest()
+        if resources is None:
+            return 'not sampled'
+        return 'fds %d, rss %.1f MB, cpu %.1f%%, threads %d' % (resources['fds'], resources['rss_mb'],
+                                                              resources.get('cpu_percent', 0.0),
+                                                              resources['threads'])
+
+    def publish(self):
+        temp_file = self.publish_to + '.tmp'
+        try:
+            with open(temp_file, 'w') as f:
+                json.dump(self.latest(), f)
+            os.rename(temp_file, self.publish_to)  # so that the GUI never reads half a file
+        except (IOError, OSError) as e:
+            logger.warning("Could not publish resources to %s: %s" % (self.publish_to, e))
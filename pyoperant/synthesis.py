@@ -0,0 +1,178 @@
+"""Builds tempo stimuli from an element sound and a pattern of inter-onset intervals, instead of reading them from
+thousands of pre-rendered wav files
+
+A tempo stimulus is described by a spec:
+
+    {"element": "b1i1.wav",   # the sound repeated at each onset, relative to stim_path
+     "tempo": 150.0,          # onsets per minute, i.e. a mean inter-onset interval of 60 / tempo seconds
+     "n_elements": 8,         # number of onsets (default 8)
+     "pattern": [1, 1.2, 0.8] # inter-onset intervals relative to the mean, repeated as needed (default isochronous)
+     }
+
+or, in place of "pattern", "jitter" (e.g. 0.2) and "seed", for an anisochronous pattern whose intervals are drawn
+uniformly from 1 +/- jitter and then scaled so that the sequence lasts as long as the isochronous one.
+
+    synthesizer = TempoSynthesizer('/path/to/stim', {'b1i1_1500reg': {'element': 'b1i1.wav', 'tempo': 150.0}})
+    stim = synthesizer.stimulus('b1i1_1500reg')  # AuditoryStimulus annotated with tempo and pattern
+"""
+import os
+import glob
+import hashlib
+import logging
+import threading
+import collections
+
+import numpy as np
+
+from pyoperant import utils, preprocess
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+logger = logging.getLogger(__name__)
+
+RENDER_VERSION = 1  # change when rendering changes, so that old renders aren't used
+
+
+def intervals(spec):
+    """ returns the inter-onset intervals, relative to the mean, of a spec as a 1d array of n_elements - 1 values """
+    n_intervals = max(int(spec.get('n_elements', 8)) - 1, 0)
+    if 'jitter' in spec:
+        random_state = np.random.RandomState(spec.get('seed'))
+        relative = 1.0 + spec['jitter'] * random_state.uniform(-1.0, 1.0, n_intervals)
+        if n_intervals:
+            relative *= n_intervals / relative.sum()
+        return relative
+    pattern = np.asarray(spec.get('pattern', [1.0]), dtype=np.float64)
+    return np.resize(pattern, n_intervals)
+
+
+def onsets(spec):
+    """ returns the onset times, in seconds from the start of the stimulus, of a spec """
+    ioi = 60.0 / spec['tempo']
+    return np.concatenate([[0.0], np.cumsum(intervals(spec) * ioi)])
+
+
+def render(element, onset_times, rate):
+    """ adds a 1d element into silence at each of onset_times (in seconds) and returns the result """
+    starts = np.round(np.asarray(onset_times) * rate).astype(np.int64)
+    samples = np.zeros(starts[-1] + len(element) if len(starts) else 0)
+    for start in starts:
+        samples[start:start + len(element)] += element
+    return samples
+
+
+def describe(spec):
+    """ returns the pattern of a spec as it is saved with a trial: 'reg' for an isochronous sequence, otherwise its
+    relative inter-onset intervals
+    """
+    relative = intervals(spec)
+    if np.allclose(relative, 1.0):
+        return 'reg'
+    return ' '.join('%.3f' % value for value in relative)
+
+
+class TempoSynthesizer(object):
+    """ A source of tempo stimuli, by name, rendered from specs into a bounded cache directory
+
+    Keyword arguments:
+    stim_path -- directory that element files are relative to
+    specs -- dictionary of the spec of each stimulus name
+    cache_dir -- directory the rendered files are kept in (default stim_path/rendered)
+    box -- name of the box the stimuli are for. Its renders are kept in a subdirectory of cache_dir named after it, so
+        that boxes sharing stim_path never delete files another box is playing (default None, cache_dir itself)
+    max_renders -- number of rendered files kept, including those left by earlier sessions; the least recently used
+        are deleted (default 256)
+
+    Methods:
+    stimulus(name) -- an AuditoryStimulus for the stimulus, rendering it if it isn't in the cache. Its name is the
+        stimulus name, its file_origin the rendered file, and it is annotated with tempo and pattern
+    path(name) -- the rendered file of the stimulus
+    """
+
+    def __init__(self, stim_path, specs, cache_dir=None, box=None, max_renders=256):
+        self.stim_path = stim_path
+        self.specs = specs
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(stim_path, 'rendered')
+        if box is not None:
+            self.cache_dir = os.path.join(self.cache_dir, str(box))
+        self.max_renders = max_renders
+        self._elements = {}  # (path, mtime): (rate, samples)
+        self._renders = collections.OrderedDict()  # key: path, least recently used first
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:  # made by another box in the meantime
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        # renders left by earlier sessions count towards the bound, oldest first
+        for path in sorted(glob.glob(os.path.join(self.cache_dir, '*.wav')), key=os.path.getmtime):
+            self._renders[os.path.splitext(os.path.basename(path))[0]] = path
+        self._trim()
+
+    def __contains__(self, name):
+        return name in self.specs
+
+    def _element(self, spec):
+        element_file = os.path.join(self.stim_path, spec['element'])
+        cache_key = (element_file, os.path.getmtime(element_file))
+        if cache_key not in self._elements:
+            rate, samples = preprocess.read_wav(element_file)
+            self._elements[cache_key] = (rate, samples.mean(axis=1))
+        return self._elements[cache_key]
+
+    def _key(self, spec):
+        element_file = os.path.join(self.stim_path, spec['element'])
+        stim_index = utils.get_stimulus_index(os.path.dirname(os.path.abspath(element_file)))
+        element_hash = stim_index.info(element_file)['sha1']
+        description = json.dumps([RENDER_VERSION, element_hash, spec], sort_keys=True)
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def _trim(self):
+        while len(self._renders) > self.max_renders:
+            key, path = self._renders.popitem(last=False)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def path(self, name):
+        spec = self.specs[name]
+        key = self._key(spec)
+        with self._lock:
+            path = self._renders.pop(key, None)
+            if path is None or not os.path.exists(path):
+                path = os.path.join(self.cache_dir, key + '.wav')
+                rate, element = self._element(spec)
+                samples = render(element, onsets(spec), rate)
+                peak = np.max(np.abs(samples)) if len(samples) else 0.0
+                if peak > 1.0:
+                    logger.warning("Elements of %s overlap and clip (peak %.2f), scaled to a peak of 1.0"
+                                   % (name, peak))
+                    samples /= peak
+                temp_file = '%s.%d.tmp' % (path, os.getpid())  # boxes sharing the cache render side by side
+                preprocess.write_wav(temp_file, samples, rate)
+                os.rename(temp_file, path)  # so that a half written file is never played
+                logger.debug("Rendered %s to %s" % (name, path))
+            self._renders[key] = path
+            self._trim()
+        return path
+
+    def stimulus(self, name):
+        spec = self.specs[name]
+        path = self.path(name)
+        rate = self._element(spec)[0]
+        nframes = int(round(onsets(spec)[-1] * rate)) + len(self._element(spec)[1])
+        return utils.AuditoryStimulus(event_time=0.0,
+                                      duration=float(nframes) / rate,
+                                      name=name,
+                                      label='wav',
+                                      description='',
+                                      file_origin=path,
+                                      tempo=spec['tempo'],
+                                      pattern=describe(spec),
+                                      element=spec['element'],
+                                      )
@@ -0,0 +1,199 @@
+"""Waits and intervals timed on the monotonic clock, so that NTP stepping the wall clock doesn't stretch or cut them
+
+On Linux, waits sleep until an absolute deadline with clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME), which doesn't
+accumulate the drift of repeated relative sleeps. Elsewhere they fall back to time.sleep. Waits that need to be more
+precise than a sleep, such as stimulus onsets and intertrial intervals, ask to spin on the clock for the last
+spin_margin seconds, which calibrate() sets from how late this machine's sleeps wake up. Spinning keeps a core busy, so
+it isn't the default.
+
+    deadline = monotonic() + 0.5
+    ...
+    wait_until(deadline, spin=True)  # returns within tens of microseconds of the deadline
+
+A TimeBase gives the events of one trial a single clock: seconds since the trial started, on the monotonic clock, with
+datetime() to put a time back on the wall clock for the records.
+"""
+import os
+import sys
+import time
+import ctypes
+import ctypes.util
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+CLOCK_MONOTONIC = 1
+TIMER_ABSTIME = 1
+EINTR = 4
+
+MAX_SPIN_MARGIN = 0.005  # seconds; never spin longer than this, whatever the calibration says
+spin_margin = None  # seconds before a deadline to stop sleeping and spin; set by calibrate() on the first wait
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _load_clock():
+    """ returns libc's clock_gettime and clock_nanosleep, or None if they aren't available """
+    if not sys.platform.startswith('linux'):
+        return None
+    for name in ('c', 'rt'):
+        path = ctypes.util.find_library(name)
+        if path is None:
+            continue
+        try:
+            lib = ctypes.CDLL(path, use_errno=True)
+            clock_gettime = lib.clock_gettime
+            clock_nanosleep = lib.clock_nanosleep
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        clock_nanosleep.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(_timespec), ctypes.POINTER(_timespec)]
+        return clock_gettime, clock_nanosleep
+    return None
+
+
+_clock = _load_clock()
+
+
+def _clock_monotonic():
+    """ returns seconds on a clock that only moves forward, at a steady rate, from an arbitrary start """
+    ts = _timespec()
+    if _clock[0](CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+elif _clock is not None:
+    monotonic = _clock_monotonic
+else:
+    logger.warning("No monotonic clock available, timing falls back to the wall clock")
+    monotonic = time.time
+
+
+def sleep_until(deadline):
+    """ sleeps until monotonic() reaches deadline, or a little after """
+    if _clock is not None and monotonic is not time.time:
+        ts = _timespec(int(deadline), int((deadline - int(deadline)) * 1e9))
+        while _clock[1](CLOCK_MONOTONIC, TIMER_ABSTIME, ctypes.byref(ts), None) == EINTR:
+            pass  # a signal woke us early; its handler (e.g. KeyboardInterrupt) has had its chance to run
+    else:
+        remaining = deadline - monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+
+def calibrate(samples=50, interval=0.001):
+    """ sets spin_margin from how late sleeps of interval seconds wake up: a little more than the 95th percentile,
+    limited to MAX_SPIN_MARGIN. Returns it
+    """
+    global spin_margin
+    lateness = []
+    for i in range(samples):
+        deadline = monotonic() + interval
+        sleep_until(deadline)
+        lateness.append(monotonic() - deadline)
+    lateness.sort()
+    spin_margin = min(1.5 * lateness[int(0.95 * (len(lateness) - 1))] + 0.0001, MAX_SPIN_MARGIN)
+    logger.debug("Sleeps wake up to %.3f ms late (median %.3f ms); spinning for the last %.3f ms of waits"
+                 % (1000 * lateness[-1], 1000 * lateness[len(lateness) // 2], 1000 * spin_margin))
+    return spin_margin
+
+
+def spin_until(deadline, waitfunc=None):
+    """ spins on the clock until monotonic() reaches deadline, calling waitfunc (if given) each time around """
+    if waitfunc is None:
+        while monotonic() < deadline:
+            pass
+    else:
+        while monotonic() < deadline:
+            waitfunc()
+
+
+def wait_until(deadline, waitfunc=None, spin=False):
+    """ waits until monotonic() reaches deadline by sleeping. With spin=True, sleeps until spin_margin before it and
+    then spins on the clock, calling waitfunc (if given) each time around
+    """
+    if not spin:
+        sleep_until(deadline)
+        return
+    if spin_margin is None:
+        calibrate()
+    if deadline - monotonic() > spin_margin:
+        sleep_until(deadline - spin_margin)
+    spin_until(deadline, waitfunc)
+
+
+def wait(secs, waitfunc=None, spin=False):
+    """ waits for secs seconds (see wait_until) and returns the deadline it waited for, so that a caller can time its
+    next wait from it rather than from whenever this one returned
+    """
+    deadline = monotonic() + secs
+    wait_until(deadline, waitfunc, spin)
+    return deadline
+
+
+class TimeBase(object):
+    """ A clock for the events of one trial, in seconds since it started, on the monotonic clock
+
+    Keyword arguments:
+    start -- datetime the trial started, if it was before now (default None, now)
+
+    Methods:
+    elapsed() -- seconds since the start
+    deadline(t) -- monotonic() time of t seconds after the start
+    wait_until(t, waitfunc=None, spin=False) -- waits until t seconds after the start
+    datetime(t=None) -- wall clock datetime of t seconds after the start (default now)
+    offset(when=None) -- seconds after the start of a wall clock datetime, such as an edge's timestamp (default now)
+    """
+
+    def __init__(self, start=None):
+        now = monotonic()
+        self.start_datetime = datetime.datetime.now()
+        self.start = now
+        if start is not None:
+            self.start -= (self.start_datetime - start).total_seconds()
+            self.start_datetime = start
+
+    def elapsed(self):
+        return monotonic() - self.start
+
+    def deadline(self, t):
+        return self.start + t
+
+    def wait_until(self, t, waitfunc=None, spin=False):
+        wait_until(self.deadline(t), waitfunc, spin)
+
+    def datetime(self, t=None):
+        if t is None:
+            t = self.elapsed()
+        return self.start_datetime + datetime.timedelta(seconds=t)
+
+    def offset(self, when=None):
+        if when is None:
+            return self.elapsed()
+        return (when - self.start_datetime).total_seconds()
+
+
+def jitter(waiter, secs=0.01, repetitions=200):
+    """ returns statistics, in milliseconds, of how late waiter(secs) returns: a dictionary of mean, p50, p99, max and
+    std
+    """
+    lateness = []
+    for i in range(repetitions):
+        start = monotonic()
+        waiter(secs)
+        lateness.append(1000 * (monotonic() - start - secs))
+    lateness.sort()
+    mean = sum(lateness) / len(lateness)
+    return {'mean': mean,
+            'p50': lateness[len(lateness) // 2],
+            'p99': lateness[min(int(0.99 * len(lateness)), len(lateness) - 1)],
+            'max': lateness[-1],
+            'std': (sum((value - mean) ** 2 for value in lateness) / len(lateness)) ** 0.5,
+            }
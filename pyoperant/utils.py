@@ -1,3 +1,4 @@
+import io
 import wave
 import sys
 import struct
@@ -10,12 +11,16 @@ import shlex
 import os
 import string
 import random
+import bisect
+import hashlib
+import collections
 import datetime as dt
 import numpy as np
 import scipy as sp
 import scipy.special
 from contextlib import closing
 from argparse import ArgumentParser
+from pyoperant import timing
 
 # for allowing the logging module to send emails through gmail
 # import logging
@@ -26,6 +31,7 @@ try:
 except ImportError:
     import json
 
+logger = logging.getLogger(__name__)
 
 # class TlsSMTPHandler(logging.handlers.SMTPHandler):
 #     def emit(self, record):
@@ -124,8 +130,98 @@ class AuditoryStimulus(Stimulus):
             self.label = 'auditory_stimulus'
 
 
+class StateMachine(object):
+    """ A state machine, checked and compiled into a table once and then run as often as needed
+
+    >>> machine = StateMachine(start_in='start', start=run_start, next=run_next)
+    >>> machine.run()
+    in 'run_start'
+    in 'run_next'
+
+    Keyword arguments:
+    start_in -- state that run() starts in (default 'pre')
+    error_state -- not used; kept so that run_state_machine's arguments can be passed on as they are
+    error_callback -- called with any exception a state raises, before it is raised again (default None)
+    trace -- if True, count the times each state is run and time them on the monotonic clock (default False)
+    the remaining keyword arguments -- the state of each name: a callable that takes no arguments and returns the
+        name of the next state, or None to stop. Any callable will do, so a state can be an object that keeps what
+        it needs between runs rather than a closure built for each one
+
+    Methods:
+    run(start_in=None) -- runs states from start_in (default, the machine's) until one returns None
+    stats() -- dictionary of the count, total, mean and max seconds of each state that has run, when tracing
+    reset_stats() -- forgets the counts and times
+    describe() -- the stats as a line for the log, states taking the most time first
+    """
+
+    def __init__(self, start_in='pre', error_state=None, error_callback=None, trace=False, **state_functions):
+        # make sure the start state has a function to run
+        assert start_in in state_functions, "no state '%s' to start in" % start_in
+        # make sure all of the arguments passed in are callable
+        for name, func in state_functions.items():
+            assert callable(func), "state '%s' isn't callable" % name
+        self.start_in = start_in
+        self.error_state = error_state
+        self.error_callback = error_callback
+        self.trace = trace
+        self.states = state_functions
+        if trace:
+            self.reset_stats()
+        else:
+            self.counts = self.durations = self.maxima = {}
+
+    def reset_stats(self):
+        self.counts = dict.fromkeys(self.states, 0)
+        self.durations = dict.fromkeys(self.states, 0.0)
+        self.maxima = dict.fromkeys(self.states, 0.0)
+
+    def run(self, start_in=None):
+        states = self.states
+        state = self.start_in if start_in is None else start_in
+        try:
+            if not self.trace:
+                while state is not None:
+                    state = states[state]()
+                return
+            # time each state, reading the clock once per state: the end of one is the start of the next. A state
+            # that runs a machine of its own includes that machine's time in its own
+            clock = timing.monotonic
+            counts, durations, maxima = self.counts, self.durations, self.maxima
+            start = clock()
+            while state is not None:
+                next_state = states[state]()
+                end = clock()
+                elapsed = end - start
+                counts[state] += 1
+                durations[state] += elapsed
+                if elapsed > maxima[state]:
+                    maxima[state] = elapsed
+                state, start = next_state, end
+        except Exception as e:
+            if self.error_callback:
+                self.error_callback(e)
+            raise
+
+    def stats(self):
+        return dict((name, {'count': count,
+                            'total': self.durations[name],
+                            'mean': self.durations[name] / count,
+                            'max': self.maxima[name],
+                            })
+                    for name, count in self.counts.items() if count)
+
+    def describe(self):
+        stats = self.stats()
+        if not stats:
+            return 'not traced' if not self.trace else 'no states run'
+        return ', '.join('%s %dx %.3fs (mean %.3fs, max %.3fs)' % (name, stats[name]['count'], stats[name]['total'],
+                                                                 stats[name]['mean'], stats[name]['max'])
+                         for name in sorted(stats, key=lambda name: -stats[name]['total']))
+
+
 def run_state_machine(start_in='pre', error_state=None, error_callback=None, **state_functions):
-    """runs a state machine defined by the keyword arguments
+    """runs a state machine defined by the keyword arguments. Compiles a StateMachine each time it is called, so a
+    machine that is run over and over should be compiled once and its run() called instead
 
     >>> def run_start():
     >>>    print "in 'run_start'"
@@ -140,24 +236,7 @@ def run_state_machine(start_in='pre', error_state=None, error_callback=None, **s
     in 'run_next'
     None
     """
-    # make sure the start state has a function to run
-    assert (start_in in state_functions.keys())
-    # make sure all of the arguments passed in are callable
-    for func in state_functions.values():
-        assert hasattr(func, '__call__')
-
-    state = start_in
-    while state is not None:
-        try:
-            state = state_functions[state]()
-        except Exception as e:
-
-            if error_callback:
-                error_callback(e)
-                raise
-            else:
-                raise
-            # state = error_state  # 3/12/19 (AR) not sure what the point of this statement is
+    StateMachine(start_in, error_state, error_callback, **state_functions).run()
 
 
 class Trial(Event):
@@ -289,28 +368,259 @@ def is_day(city='Boston', lat='42.41', lon='-71.13'):
     which of course in German means a whale's vagina. (Burgundy, 2004)
     """
 
-    import ephem
-    if city:
-        # print 'city'
-        try:
-            obs = ephem.city(city.capitalize())
-        except KeyError:
-            raise NoCityMatchError
-        except AttributeError:
-            obs = ephem.city(city.get('city').capitalize())  # 3/12/19 (AR) Does this work? There's no 'get' function
-            # for a str
-    elif lat and lon:
-        # print 'coords'
+    return get_solar_table(city, lat, lon).is_day()
+
+
+SOLAR_TABLE_DIR = os.path.join(os.path.expanduser('~'), '.pyoperant')  # where solar tables are shared between boxes
+SOLAR_TABLE_DAYS = 366  # days of sunrises and sunsets in a solar table
+
+
+class SolarTable(object):
+    """ Sunrises and sunsets at a location for the coming year, computed with ephem once and saved in directory, so
+    that is_day is a lookup and every box process on the machine shares one table
+
+    Keyword arguments:
+    city -- name of a city ephem knows (default None, use lat and lon)
+    lat, lon -- latitude and longitude of the location, as strings
+    directory -- directory the table is saved in (default SOLAR_TABLE_DIR)
+
+    Methods:
+    is_day(now=None) -- True if datetime now (default now) is between a sunrise and a sunset
+    next_transition(now=None) -- the datetime of the first sunrise or sunset after now
+    transitions(start, end) -- (datetime, is_sunrise) of the sunrises and sunsets between start and end
+    """
+    VERSION = 1
+
+    def __init__(self, city=None, lat='42.41', lon='-71.13', directory=None):
+        self.city = city
+        self.lat = str(lat)
+        self.lon = str(lon)
+        location = 'city_%s' % city.lower() if city else 'lat%s_lon%s' % (self.lat, self.lon)
+        self.table_file = os.path.join(directory if directory is not None else SOLAR_TABLE_DIR,
+                                       'solar_%s.json' % location.replace(' ', '_'))
+        self.times = []  # datetimes of the sunrises and sunsets, in order
+        self.sunrise = []  # whether each is a sunrise
+        self._lock = threading.Lock()
+
+    def _observer(self):
+        import ephem
+        if self.city:
+            try:
+                return ephem.city(self.city.capitalize())
+            except KeyError:
+                raise NoCityMatchError
         obs = ephem.Observer()
-        obs.lat = str(lat)
-        obs.long = str(lon)
-    else:
-        # print 'else'
-        obs = ephem.city('Boston')
+        obs.lat = self.lat
+        obs.long = self.lon
+        return obs
+
+    def _covers(self, now):
+        # keep a week in hand, so that next_transition always has the next few days
+        return len(self.times) > 0 and self.times[0] <= now and now + dt.timedelta(days=8) <= self.times[-1]
+
+    def _compute(self, now):
+        import ephem
+        obs = self._observer()
+        obs.date = ephem.Date(now - dt.timedelta(days=2) - (dt.datetime.now() - dt.datetime.utcnow()))
+        end = ephem.Date(obs.date + SOLAR_TABLE_DAYS + 2)
+        sun = ephem.Sun()
+        times, sunrise = [], []
+        while obs.date < end:
+            next_rising = obs.next_rising(sun)
+            next_setting = obs.next_setting(sun)
+            event = min(next_rising, next_setting)
+            times.append(ephem.localtime(event).replace(microsecond=0))
+            sunrise.append(next_rising < next_setting)
+            obs.date = ephem.Date(event + ephem.minute)
+        return times, sunrise
+
+    def _load(self):
+        try:
+            with open(self.table_file, 'rb') as f:
+                table = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        if table.get('version') != self.VERSION:
+            return False
+        self.times = [dt.datetime.strptime(t, '%Y-%m-%dT%H:%M:%S') for t, is_sunrise in table['events']]
+        self.sunrise = [bool(is_sunrise) for t, is_sunrise in table['events']]
+        return True
+
+    def _save(self):
+        temp_file = '%s.%d.tmp' % (self.table_file, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(self.table_file)):
+                os.makedirs(os.path.dirname(self.table_file))
+            with open(temp_file, 'wb') as f:
+                json.dump({'version': self.VERSION,
+                           'events': [[t.strftime('%Y-%m-%dT%H:%M:%S'), int(is_sunrise)]
+                                      for t, is_sunrise in zip(self.times, self.sunrise)]}, f)
+            os.rename(temp_file, self.table_file)  # so that another box never reads half a table
+        except (IOError, OSError) as e:
+            logger.warning("Could not save solar table %s: %s" % (self.table_file, e))
+
+    def _ensure(self, now):
+        if self._covers(now):
+            return
+        with self._lock:
+            if self._covers(now):
+                return
+            # another box may already have computed this year's table
+            if self._load() and self._covers(now):
+                return
+            logger.info("Computing sunrises and sunsets for %s" % self.table_file)
+            self.times, self.sunrise = self._compute(now)
+            self._save()
+
+    def is_day(self, now=None):
+        if now is None:
+            now = dt.datetime.now()
+        self._ensure(now)
+        i = bisect.bisect_right(self.times, now) - 1
+        return self.sunrise[i]
+
+    def next_transition(self, now=None):
+        if now is None:
+            now = dt.datetime.now()
+        self._ensure(now)
+        return self.times[bisect.bisect_right(self.times, now)]
+
+    def transitions(self, start, end):
+        self._ensure(start)
+        first = bisect.bisect_right(self.times, start)
+        last = bisect.bisect_right(self.times, end)
+        return list(zip(self.times[first:last], self.sunrise[first:last]))
+
+
+_solar_tables = {}
+
+
+def get_solar_table(city=None, lat='42.41', lon='-71.13'):
+    """ returns the SolarTable of a location, shared by everything in the process that uses it. Takes the same
+    arguments as is_day, including a dictionary of them as city
+    """
+    if isinstance(city, dict):
+        city, lat, lon = city.get('city'), city.get('lat', lat), city.get('lon', lon)
+    if not city and not (lat and lon):
+        city = 'Boston'
+    key = (city.lower(), None, None) if city else (None, str(lat), str(lon))
+    if key not in _solar_tables:
+        _solar_tables[key] = SolarTable(city, lat, lon)
+    return _solar_tables[key]
+
+
+class Schedule(object):
+    """ A light or session schedule, parsed once, that answers whether it is active at a time and when that next changes
+
+    Keyword arguments:
+    epochs -- 'sun' to follow local sunrise and sunset, or a list of ('HH:MM','HH:MM') start and end times, as in
+        light_schedule and session_schedule. An epoch that ends before it starts runs past midnight, and '24:00' is
+        the end of the day
+    days -- days the schedule runs on, as in session_days: 'daily', 'weekday', or a list of weekday numbers
+        (Monday = 0) and/or full or three-letter day names (default 'daily')
+    fmt -- format of the times in epochs (default '%H:%M')
+    sun -- keyword arguments for is_day (city, or lat and lon), for 'sun' schedules
+
+    Methods:
+    is_active(now=None) -- True if the schedule is active at datetime now (default now)
+    next_transition(now=None) -- the datetime after now at which is_active next changes, or None if it doesn't within
+        the next week
+    """
+
+    def __init__(self, epochs, days='daily', fmt="%H:%M", **sun):
+        self.sun = epochs == 'sun'
+        self.solar_table = get_solar_table(sun) if self.sun else None
+        self.days = self._compile_days(days)
+        self.starts = []  # seconds into the day that active periods start, sorted, not overlapping
+        self.ends = []  # seconds into the day that they end (exclusive)
+        if not self.sun:
+            periods = []
+            for epoch in epochs:
+                assert len(epoch) == 2
+                start, end = [self._seconds(t, fmt) for t in epoch]
+                if start <= end:
+                    periods.append((start, end))
+                else:
+                    periods += [(start, 86400), (0, end)]
+            for start, end in sorted(periods):
+                if self.starts and start <= self.ends[-1]:
+                    self.ends[-1] = max(self.ends[-1], end)
+                elif start < end:
+                    self.starts.append(start)
+                    self.ends.append(end)
+
+    @staticmethod
+    def _seconds(t, fmt):
+        if t == '24:00':
+            return 86400
+        t = dt.datetime.strptime(t, fmt)
+        return t.hour * 3600 + t.minute * 60 + t.second
+
+    @staticmethod
+    def _compile_days(days):
+        if days == 'daily':
+            return (True,) * 7
+        if days == 'weekday':
+            return (True,) * 5 + (False,) * 2
+        names = [dt.date(2018, 1, day + 1) for day in range(7)]  # 1/1/2018 was a Monday
+        return tuple(any(day == weekday or day == names[weekday].strftime("%A").lower() or
+                         day == names[weekday].strftime("%a").lower() for day in days)
+                     for weekday in range(7))
+
+    def is_active(self, now=None):
+        if now is None:
+            now = dt.datetime.now()
+        if not self.days[now.weekday()]:
+            return False
+        if self.sun:
+            return self.solar_table.is_day(now)
+        seconds = now.hour * 3600 + now.minute * 60 + now.second + now.microsecond / 1e6
+        i = bisect.bisect_right(self.starts, seconds) - 1
+        return i >= 0 and seconds < self.ends[i]
+
+    def next_transition(self, now=None):
+        if now is None:
+            now = dt.datetime.now()
+        state = self.is_active(now)
+        # is_active only changes at the start or end of a period (or at a sunrise or sunset), or at midnight, so within
+        # a week (and a day) of now
+        midnight = dt.datetime.combine(now.date(), dt.time())
+        days = [midnight + dt.timedelta(days=day) for day in range(9)]
+        if self.sun:
+            boundaries = sorted(days + [t for t, is_sunrise in self.solar_table.transitions(now, days[-1])])
+        else:
+            boundaries = [day + dt.timedelta(seconds=seconds) for day in days[:-1]
+                          for seconds in sorted(set([0] + self.starts + self.ends))]
+        for t in boundaries:
+            if t > now and self.is_active(t) != state:
+                return t
+        return None
 
-    next_sunrise = ephem.localtime(obs.next_rising(ephem.Sun()))
-    next_sunset = ephem.localtime(obs.next_setting(ephem.Sun()))
-    return next_sunset < next_sunrise
+
+_schedules = {}
+
+
+def get_schedule(epochs, days='daily', fmt="%H:%M", **sun):
+    """ returns the Schedule of epochs and days (see Schedule), parsed the first time it is asked for and then kept """
+    key = (epochs if epochs == 'sun' else tuple(tuple(epoch) for epoch in epochs),
+           days if days in ('daily', 'weekday') else tuple(days), fmt, tuple(sorted(sun.items())))
+    if key not in _schedules:
+        _schedules[key] = Schedule(epochs, days=days, fmt=fmt, **sun)
+    return _schedules[key]
+
+
+def wait_for_transition(schedules, max_wait=3600.0):
+    """ waits until the first of schedules next changes, or at most max_wait seconds, so that changes to the clock are
+    caught up with
+    """
+    now = dt.datetime.now()
+    secs = max_wait
+    for schedule in schedules:
+        transition = schedule.next_transition(now)
+        if transition is not None:
+            secs = min(secs, (transition - now).total_seconds())
+    logger.debug('waiting %.1f s for the schedule to change' % secs)
+    wait(max(secs, 0.0))
 
 
 def check_time(schedule, fmt="%H:%M", **kwargs):
@@ -322,22 +632,11 @@ def check_time(schedule, fmt="%H:%M", **kwargs):
     schedule='sun' will change lights according to local sunrise and sunset
 
     schedule=[('07:00','17:00')] will have lights on between 7am and 5pm
-    schedule=[('06:00','12:00'),('18:00','24:00')] will have lights on between
+    schedule=[('06:00','12:00'),('18:00','24:00')] will have lights on between 6am and noon, and after 6pm
 
+    Each schedule is parsed into a Schedule once (see get_schedule).
     """
-
-    if schedule == 'sun':
-        if is_day(kwargs):
-            return True
-    else:
-        for epoch in schedule:
-            assert len(epoch) is 2
-            now = dt.datetime.time(dt.datetime.now())
-            start = dt.datetime.time(dt.datetime.strptime(epoch[0], fmt))
-            end = dt.datetime.time(dt.datetime.strptime(epoch[1], fmt))
-            if time_in_range(start, end, now):
-                return True
-    return False
+    return get_schedule(schedule, fmt=fmt, **kwargs).is_active()
 
 
 def check_day(schedule):
@@ -362,40 +661,31 @@ def check_day(schedule):
     return False
 
 
-def wait(secs=1.0, final_countdown=0.0, waitfunc=None):
-    """Smartly wait for a given time period.
+def wait(secs=1.0, final_countdown=0.0, waitfunc=None, precise=False):
+    """Smartly wait for a given time period, on the monotonic clock (see timing.py).
 
     secs -- total time to wait in seconds
-    final_countdown -- time at end of secs to wait and constantly poll the clock
-    waitfunc -- optional function to run in a loop during hogCPUperiod
+    final_countdown -- time at end of secs to wait and constantly poll the clock (default 0.0, none)
+    waitfunc -- optional function to run in a loop during the final countdown
+    precise -- if True and there's no final_countdown, poll the clock for the last timing.spin_margin seconds,
+        as calibrated for this machine (default False, only sleep)
 
-    If secs=1.0 and final_countdown=0.2 then for 0.8s python's time.sleep function will be used,
-    which is not especially precise, but allows the cpu to perform housekeeping. In
-    the final hogCPUsecs the more precise method of constantly polling the clock
-    is used for greater precision.
+    For most of the wait the thread sleeps until a deadline, which allows the cpu to perform housekeeping. In the final
+    countdown the more precise method of constantly polling the clock is used for greater precision.
     """
-    # initial relaxed period, using sleep (better for system resources etc)
-    if secs > final_countdown:
-        time.sleep(secs - final_countdown)
-        secs = final_countdown  # only this much is now left
-
-    # It's the Final Countdown!!
-    # hog the cpu, checking time
-    t0 = time.time()
-    while (time.time() - t0) < secs:
-        # let's see if any events were collected in meantime
-        try:
-            waitfunc()
-        except:
-            pass
+    deadline = timing.monotonic() + secs
+    if final_countdown > 0:
+        timing.sleep_until(deadline - final_countdown)
+        timing.spin_until(deadline, waitfunc)
+    else:
+        timing.wait_until(deadline, waitfunc, spin=precise)
 
 
 def auditory_stim_from_wav(wav):
     with closing(wave.open(wav, 'rb')) as wf:
         (nchannels, sampwidth, framerate, nframes, comptype, compname) = wf.getparams()
 
-        duration = float(nframes) / sampwidth
-        duration = duration * 2.0 / framerate
+        duration = float(nframes) / framerate
         stim = AuditoryStimulus(time=0.0,
                                 duration=duration,
                                 name=wav,
@@ -413,7 +703,175 @@ def auditory_stim_from_wav(wav):
     return stim
 
 
-def concat_wav(input_file_list, output_filename='concat.wav'):
+def _wav_levels(frames, sampwidth):
+    """ returns the peak and RMS of wav frames, as fractions of full scale """
+    data = np.frombuffer(frames, dtype=np.uint8)
+    if sampwidth == 1:
+        samples = (data.astype(np.float64) - 128) / 2 ** 7  # 8 bit wav samples are unsigned
+    elif sampwidth == 3:
+        data = data.reshape(-1, 3).astype(np.int32)
+        samples = ((data[:, 0] << 8 | data[:, 1] << 16 | data[:, 2] << 24) >> 8) / float(2 ** 23)
+    else:
+        samples = np.frombuffer(frames, dtype='<i%d' % sampwidth) / float(2 ** (8 * sampwidth - 1))
+    if len(samples) == 0:
+        return 0.0, 0.0
+    return float(np.max(np.abs(samples))), float(np.sqrt(np.mean(samples ** 2)))
+
+
+class StimulusIndex(object):
+    """ Metadata of the wav files in a stimulus directory, kept in a json file next to them
+
+    For each wav file the index holds its sample rate, channels, sample width, number of frames, duration, SHA-1 of the
+    file and peak and RMS level (as fractions of full scale). Files are only read when they are new or their
+    modification time or size has changed, so an experiment can make AuditoryStimulus objects without opening wav
+    files during trials.
+
+    Keyword arguments:
+    stim_path -- directory of the stimuli. Paths in the index are relative to it
+    index_name -- name of the index file in stim_path
+
+    Methods:
+    update(wav_files) -- indexes the given files, or every wav file in stim_path, reading those that changed
+    info(wav_file) -- returns the dictionary of metadata of the file, reading the file if it changed
+    stimulus(wav_file) -- returns an AuditoryStimulus for the file
+    save() -- writes the index file, if anything changed
+    """
+
+    VERSION = 1
+
+    def __init__(self, stim_path, index_name='stim_index.json'):
+        self.stim_path = os.path.abspath(stim_path)
+        self.index_file = os.path.join(self.stim_path, index_name)
+        self.records = {}
+        self._changed = False
+        self._lock = threading.Lock()
+        try:
+            with open(self.index_file, 'rb') as f:
+                index = json.load(f)
+            if index.get('version') == self.VERSION:
+                self.records = index['stims']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def _key(self, wav_file):
+        return os.path.relpath(os.path.abspath(wav_file), self.stim_path)
+
+    def _index(self, wav_file, stat):
+        with open(wav_file, 'rb') as f:
+            contents = f.read()
+        with closing(wave.open(io.BytesIO(contents), 'rb')) as wf:
+            (nchannels, sampwidth, framerate, nframes, comptype, compname) = wf.getparams()
+            peak, rms = _wav_levels(wf.readframes(nframes), sampwidth)
+        logger.debug("Indexed stimulus %s" % wav_file)
+        return {'mtime': stat.st_mtime,
+                'size': stat.st_size,
+                'nchannels': nchannels,
+                'sampwidth': sampwidth,
+                'framerate': framerate,
+                'nframes': nframes,
+                'comptype': comptype,
+                'compname': compname,
+                'duration': float(nframes) / framerate,
+                'sha1': hashlib.sha1(contents).hexdigest(),
+                'peak': peak,
+                'rms': rms,
+                }
+
+    def info(self, wav_file):
+        key = self._key(wav_file)
+        stat = os.stat(wav_file)
+        record = self.records.get(key)
+        if record is None or record['mtime'] != stat.st_mtime or record['size'] != stat.st_size:
+            record = self._index(wav_file, stat)
+            with self._lock:
+                self.records[key] = record
+                self._changed = True
+        return record
+
+    def update(self, wav_files=None):
+        if wav_files is None:
+            wav_files = [os.path.join(directory, filename)
+                         for directory, subdirectories, filenames in os.walk(self.stim_path)
+                         for filename in filenames if filename.lower().endswith('.wav')]
+            present = set(self._key(wav_file) for wav_file in wav_files)
+            with self._lock:
+                for key in set(self.records) - present:
+                    del self.records[key]
+                    self._changed = True
+        for wav_file in wav_files:
+            try:
+                self.info(wav_file)
+            except (IOError, OSError, EOFError, wave.Error) as e:
+                logger.warning("Could not index stimulus %s: %s" % (wav_file, e))
+        self.save()
+
+    def save(self):
+        with self._lock:
+            if not self._changed:
+                return
+            temp_file = '%s.%d.tmp' % (self.index_file, os.getpid())  # boxes sharing stim_path save side by side
+            try:
+                with open(temp_file, 'wb') as f:
+                    json.dump({'version': self.VERSION, 'stims': self.records}, f, sort_keys=True, indent=1)
+                os.rename(temp_file, self.index_file)  # so that a reader never sees half an index
+                self._changed = False
+            except (IOError, OSError) as e:
+                logger.warning("Could not save stimulus index %s: %s" % (self.index_file, e))
+
+    def stimulus(self, wav_file):
+        record = self.info(wav_file)
+        return AuditoryStimulus(event_time=0.0,
+                                duration=record['duration'],
+                                name=wav_file,
+                                label='wav',
+                                description='',
+                                file_origin=wav_file,
+                                annotations=dict((field, record[field]) for field in
+                                                 ('nchannels', 'sampwidth', 'framerate', 'nframes', 'comptype',
+                                                  'compname', 'sha1', 'peak', 'rms')),
+                                )
+
+
+_stimulus_indexes = {}
+
+
+def get_stimulus_index(stim_path):
+    """ returns the StimulusIndex of stim_path, shared by everything in the process that uses that directory """
+    stim_path = os.path.abspath(stim_path)
+    if stim_path not in _stimulus_indexes:
+        _stimulus_indexes[stim_path] = StimulusIndex(stim_path)
+    return _stimulus_indexes[stim_path]
+
+
+CONCAT_CACHE_SIZE = 128  # number of concatenated sequences, and of decoded parts, that concat_wav keeps
+_concat_parts = collections.OrderedDict()  # (path, mtime): (params, frames), least recently used first
+_concat_sequences = collections.OrderedDict()  # (paths, isi frames): (params, frames, part epochs)
+_concat_written = {}  # output path: (sequence key, mtime) of the sequence last written there
+
+
+def _cache_put(cache, key, value):
+    cache[key] = value
+    while len(cache) > CONCAT_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def _read_wav_frames(filename):
+    """ returns the params of a wav file and its frames as a (frames x bytes per frame) uint8 array, decoding each
+    file only once while it is unchanged on disk
+    """
+    key = (os.path.abspath(filename), os.path.getmtime(filename))
+    if key in _concat_parts:
+        part = _concat_parts.pop(key)
+    else:
+        with closing(wave.open(filename, 'rb')) as wav_part:
+            params = wav_part.getparams()
+            frames = np.frombuffer(wav_part.readframes(wav_part.getnframes()), dtype=np.uint8)
+        part = (params, frames.reshape(-1, params[0] * params[1]))
+    _cache_put(_concat_parts, key, part)
+    return part
+
+
+def concat_wav(input_file_list, output_filename='concat.wav', isi_resolution=None, write=True):
     """ concat a set of wav files into a single wav file and return the output filename
 
     takes in a tuple list of files and duration of pause after the file
@@ -424,62 +882,71 @@ def concat_wav(input_file_list, output_filename='concat.wav'):
         ('c.wav', 0.0),
         ]
 
-    returns a list of AuditoryStimulus objects
+    returns an AuditoryStimulus for the whole sequence and a list of AuditoryStimulus objects, one for each file
 
-    TODO: add checks for sampling rate, number of channels, etc.
+    The sequence is built in memory and remembered, keyed by the files and the pauses in frames. If isi_resolution is
+    given, pauses are rounded to a multiple of it (in seconds) so that sequences repeat more often. The sequence is
+    only written to output_filename if write is True, and not if it was the last sequence written there.
+    All files must have the same number of channels, sample width and sampling rate.
     """
 
-    cursor = 0
-    epochs = []  # list of file epochs
-    audio_data = ''
-    with closing(wave.open(output_filename, 'wb')) as output:
-        for input_filename, isi in input_file_list:
-
-            # read in the wav file
-            with closing(wave.open(input_filename, 'rb')) as wav_part:
-                try:
-                    params = wav_part.getparams()
-                    output.setparams(params)
-                    fs = output.getframerate()
-                except:  # TODO: what was I trying to except here? be more specific
-                    params = []
-                    fs = 1
-                    pass
-
-                audio_frames = wav_part.readframes(wav_part.getnframes())
-
-            # append the audio data
-            audio_data += audio_frames
-
-            part_start = cursor
-            part_dur = len(audio_frames) / params[1]
-
-            epochs.append(AuditoryStimulus(time=float(part_start) / fs,
-                                           duration=float(part_dur) / fs,
-                                           name=input_filename,
-                                           file_origin=input_filename,
-                                           annotations=params,
-                                           label='motif'
-                                           ))
-            cursor += part_dur  # move cursor length of the duration
-
-            # add isi
-            if isi > 0.0:
-                isi_frames = ''.join([struct.pack('h', fr) for fr in [0] * int(fs * isi)])
-                audio_data += isi_frames
-                cursor += len(isi_frames) / params[1]
-
-        # concat all of the audio together and write to file
-        output.writeframes(audio_data)
+    parts = [(_read_wav_frames(input_filename), input_filename, isi) for input_filename, isi in input_file_list]
+    params = parts[0][0][0]
+    fs = params[2]
+    for (part_params, frames), input_filename, isi in parts:
+        if part_params[:3] != params[:3]:
+            raise ValueError('%s does not have the channels, sample width and rate of %s' % (input_filename,
+                                                                                           parts[0][1]))
+
+    isi_frames = []
+    for part, input_filename, isi in parts:
+        if isi_resolution:
+            isi = isi_resolution * round(isi / isi_resolution)
+        isi_frames.append(int(fs * isi) if isi > 0.0 else 0)
+    key = (tuple(os.path.abspath(input_filename) for part, input_filename, isi in parts), tuple(isi_frames))
+
+    if key in _concat_sequences:
+        sequence = _concat_sequences.pop(key)
+    else:
+        silence = 128 if params[1] == 1 else 0  # 8 bit wav samples are unsigned
+        blocks = []
+        part_epochs = []
+        cursor = 0
+        for ((part_params, frames), input_filename, isi), n_isi in zip(parts, isi_frames):
+            blocks.append(frames)
+            part_epochs.append((input_filename, cursor, len(frames)))
+            cursor += len(frames)  # move cursor length of the duration
+            if n_isi:
+                blocks.append(np.full((n_isi, frames.shape[1]), silence, dtype=np.uint8))
+                cursor += n_isi
+        sequence = (tuple(params[:3]) + (cursor,) + tuple(params[4:]), np.concatenate(blocks).tobytes(), part_epochs)
+    _cache_put(_concat_sequences, key, sequence)
+    params, audio_data, part_epochs = sequence
+
+    if write:
+        written = _concat_written.get(output_filename)
+        if not os.path.exists(output_filename) or written != (key, os.path.getmtime(output_filename)):
+            with closing(wave.open(output_filename, 'wb')) as output:
+                output.setparams(params)
+                output.writeframes(audio_data)
+            _concat_written[output_filename] = (key, os.path.getmtime(output_filename))
+
+    epochs = [AuditoryStimulus(event_time=float(part_start) / fs,
+                               duration=float(part_dur) / fs,
+                               name=input_filename,
+                               file_origin=input_filename,
+                               annotations=params,
+                               label='motif'
+                               ) for input_filename, part_start, part_dur in part_epochs]
 
     description = 'concatenated on-the-fly'
-    concat_wav = AuditoryStimulus(time=0.0,
-                                  duration=epochs[-1].time + epochs[-1].duration,
+    concat_wav = AuditoryStimulus(event_time=0.0,
+                                  duration=float(params[3]) / fs,
                                   name=output_filename,
                                   label='wav',
                                   description=description,
                                   file_origin=output_filename,
-                                  annotations=output.getparams(),
+                                  annotations=params,
                                   )
 
     return concat_wav, epochs
@@ -489,8 +956,13 @@ def get_num_open_fds():
     """
     return the number of open file descriptors for current process
 
-    .. warning: will only work on UNIX-like os-es.
+    .. warning: will only work on UNIX-like os-es. Counts /proc/self/fd where there is one, and otherwise forks lsof,
+    which takes far longer (to follow it over time, see resources.ResourceMonitor).
     """
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        pass
 
     pid = os.getpid()
     procs = subprocess.check_output(
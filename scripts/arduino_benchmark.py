@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""Measures ArduinoInterface against the Teensy emulator in pyoperant.interfaces.arduino_emulator
+
+For each protocol mode this reports:
+    reads/s and CPU while calling _read_bool back to back
+    latency and CPU of _write_bool calls
+    time from an input edge to _poll returning, and CPU while polling
+
+The emulator runs in its own process so that the CPU figures are those of the interface alone, i.e. what one box costs
+the host.
+
+    python scripts/arduino_benchmark.py --latency 0.0005 --jitter 0.0005 --modes legacy,framed+stream
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+from pyoperant.interfaces.arduino_ import ArduinoInterface
+
+MODES = {'legacy': dict(),
+         'stream': dict(stream=True),
+         'framed': dict(framed=True),
+         'framed+stream': dict(framed=True, stream=True),
+         }
+INPUT = 3
+OUTPUT = 5
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def start_emulator(args):
+    command = [sys.executable, '-m', 'pyoperant.interfaces.arduino_emulator',
+               '--latency', str(args.latency), '--jitter', str(args.jitter),
+               '--edge', '%d:%f:%f' % (INPUT, args.edge_period, args.edge_width)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    device_name, started = process.stdout.readline().split()
+    return process, device_name, float(started)
+
+
+def measure_reads(interface, count):
+    cpu, start = cpu_time(), time.time()
+    for i in range(count):
+        interface._read_bool(INPUT)
+    elapsed = time.time() - start
+    return dict(reads_per_s=count / elapsed, read_cpu=100 * (cpu_time() - cpu) / elapsed)
+
+
+def measure_writes(interface, count):
+    latencies = []
+    cpu, start = cpu_time(), time.time()
+    for i in range(count):
+        before = time.time()
+        interface._write_bool(OUTPUT, i % 2 == 0)
+        latencies.append(time.time() - before)
+    elapsed = time.time() - start
+    return dict(write_p50_ms=1000 * percentile(latencies, 0.5), write_p99_ms=1000 * percentile(latencies, 0.99),
+                write_cpu=100 * (cpu_time() - cpu) / elapsed)
+
+
+def measure_polls(interface, count, started, period):
+    latencies = []
+    cpu, start = cpu_time(), time.time()
+    for i in range(count):
+        interface._poll(INPUT, timeout=2 * period)
+        detected = time.time()
+        # Rising edges are scheduled every period seconds from the start of the emulator
+        edge = started + period * int((detected - started) / period)
+        latencies.append(detected - edge)
+    elapsed = time.time() - start
+    return dict(poll_p50_ms=1000 * percentile(latencies, 0.5), poll_p99_ms=1000 * percentile(latencies, 0.99),
+                poll_cpu=100 * (cpu_time() - cpu) / elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ArduinoInterface against the Teensy emulator')
+    parser.add_argument('--modes', default=','.join(sorted(MODES)), help='comma separated modes to measure, from %s'
+                                                                         % ', '.join(sorted(MODES)))
+    parser.add_argument('--latency', type=float, default=0.0005, help='one way serial latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra serial latency in seconds, from 0 to jitter')
+    parser.add_argument('--reads', type=int, default=2000, help='number of reads to time')
+    parser.add_argument('--writes', type=int, default=2000, help='number of writes to time')
+    parser.add_argument('--polls', type=int, default=20, help='number of edges to poll for')
+    parser.add_argument('--edge-period', type=float, default=0.25, help='seconds between input edges')
+    parser.add_argument('--edge-width', type=float, default=0.05, help='seconds that the input stays on')
+    args = parser.parse_args()
+
+    columns = ['reads_per_s', 'read_cpu', 'write_p50_ms', 'write_p99_ms', 'write_cpu', 'poll_p50_ms', 'poll_p99_ms',
+               'poll_cpu']
+    print("%-14s" % 'mode' + ''.join("%14s" % column for column in columns))
+    for mode in args.modes.split(','):
+        process, device_name, started = start_emulator(args)
+        try:
+            interface = ArduinoInterface(device_name, **MODES[mode])
+            interface._config_read(INPUT)
+            interface._config_write(OUTPUT)
+            results = dict()
+            results.update(measure_reads(interface, args.reads))
+            results.update(measure_writes(interface, args.writes))
+            results.update(measure_polls(interface, args.polls, started, args.edge_period))
+            interface.close()
+        finally:
+            process.terminate()
+            process.wait()
+        print("%-14s" % mode + ''.join("%14.1f" % results[column] for column in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""Measures how long PyAudioInterface takes to get a stimulus out of the speaker
+
+For each stream mode this plays a short tone many times and reports:
+    how long _queue_wav takes
+    time from queueing to the first buffer reaching the DAC
+    time from _play_wav to the first buffer reaching the DAC (the onset latency logged with each trial)
+    buffers that PortAudio flagged as underflows
+
+By default the device is pyaudio_emulator.NullPyAudio, which shows the cost of the interface itself. Pass --backend
+pyaudio and a --device name to measure a sound card.
+
+    python scripts/audio_benchmark.py --repetitions 200 --modes per-stimulus,persistent
+"""
+import os
+import math
+import time
+import wave
+import shutil
+import struct
+import argparse
+import tempfile
+
+from pyoperant.interfaces import pyaudio_
+from pyoperant.interfaces.pyaudio_emulator import NullPyAudio
+
+MODES = {'per-stimulus': dict(),
+         'persistent': dict(persistent=True),
+         }
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def write_tone(wav_file, duration, rate, frequency=2000.0):
+    n_frames = int(duration * rate)
+    samples = [int(16000 * math.sin(2 * math.pi * frequency * i / rate)) for i in range(n_frames)]
+    wf = wave.open(wav_file, 'wb')
+    wf.setnchannels(1)
+    wf.setsampwidth(2)
+    wf.setframerate(rate)
+    wf.writeframes(struct.pack('<%dh' % n_frames, *samples))
+    wf.close()
+
+
+def measure(interface, wav_file, repetitions, duration):
+    queue_times = []
+    queue_to_onset = []
+    play_to_onset = []
+    missed = 0
+    for i in range(repetitions):
+        queued = time.time()
+        interface._queue_wav(wav_file)
+        queue_times.append(time.time() - queued)
+        interface._play_wav()
+        deadline = time.time() + duration + 1.0
+        while interface.onset_time is None and time.time() < deadline:
+            time.sleep(0.001)
+        if interface.onset_time is None:
+            missed += 1
+        else:
+            queue_to_onset.append(interface.onset_time - queued)
+            play_to_onset.append(interface.onset_latency)
+        time.sleep(max(duration - (time.time() - queued), 0))
+        interface._stop_wav()
+    results = dict(queue_p50_ms=1000 * percentile(queue_times, 0.5),
+                   queue_p99_ms=1000 * percentile(queue_times, 0.99),
+                   underflows=interface.underflows,
+                   missed=missed)
+    if play_to_onset:
+        results.update(queue_onset_p50_ms=1000 * percentile(queue_to_onset, 0.5),
+                       queue_onset_p99_ms=1000 * percentile(queue_to_onset, 0.99),
+                       play_onset_p50_ms=1000 * percentile(play_to_onset, 0.5),
+                       play_onset_p99_ms=1000 * percentile(play_to_onset, 0.99))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark stimulus onset latency of PyAudioInterface')
+    parser.add_argument('--modes', default=','.join(sorted(MODES)), help='comma separated modes to measure, from %s'
+                                                                         % ', '.join(sorted(MODES)))
+    parser.add_argument('--backend', choices=['null', 'pyaudio'], default='null',
+                        help='play to a NullPyAudio device or to a real one through pyaudio')
+    parser.add_argument('--device', default='null', help='name of the output device')
+    parser.add_argument('--output-latency', type=float, default=0.01,
+                        help='output latency in seconds of the null device')
+    parser.add_argument('--rate', type=int, default=48000, help='sample rate of the test stimulus')
+    parser.add_argument('--duration', type=float, default=0.1, help='duration in seconds of the test stimulus')
+    parser.add_argument('--repetitions', type=int, default=50, help='number of times to play the stimulus')
+    args = parser.parse_args()
+
+    if args.backend == 'null':
+        host = pyaudio_.AudioHost(backend=lambda: NullPyAudio(output_latency=args.output_latency))
+    else:
+        host = pyaudio_.audio_host
+
+    columns = ['queue_p50_ms', 'queue_p99_ms', 'queue_onset_p50_ms', 'queue_onset_p99_ms', 'play_onset_p50_ms',
+               'play_onset_p99_ms', 'underflows', 'missed']
+    print("%-14s" % 'mode' + ''.join("%20s" % column for column in columns))
+    directory = tempfile.mkdtemp()
+    try:
+        wav_file = os.path.join(directory, 'tone.wav')
+        write_tone(wav_file, args.duration, args.rate)
+        for mode in args.modes.split(','):
+            interface = pyaudio_.PyAudioInterface(device_name=args.device, host=host, cache=pyaudio_.StimulusCache(),
+                                                  **MODES[mode])
+            try:
+                results = measure(interface, wav_file, args.repetitions, args.duration)
+            finally:
+                interface.close()
+            print("%-14s" % mode + ''.join("%20.2f" % results.get(column, float('nan')) for column in columns))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
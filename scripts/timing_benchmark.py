@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Measures how late waits return, for the old utils.wait and for pyoperant.timing
+
+For each interval this waits many times with each method and reports, in milliseconds, how late the wait returned
+(mean, median, 99th percentile, worst, standard deviation), and the drift after a run of back to back waits, as a blink
+or a series of trials would do them.
+
+    python scripts/timing_benchmark.py --intervals 0.001,0.01,0.1 --repetitions 200
+"""
+import time
+import argparse
+
+from pyoperant import timing
+
+
+def legacy_wait(secs, final_countdown=0.0, waitfunc=None):
+    """utils.wait as it was: sleep, then spin on the wall clock calling waitfunc inside a bare except"""
+    if secs > final_countdown:
+        time.sleep(secs - final_countdown)
+        secs = final_countdown
+    t0 = time.time()
+    while (time.time() - t0) < secs:
+        try:
+            waitfunc()
+        except:
+            pass
+
+
+def drift(waiter, secs, repetitions):
+    """ms that repetitions back to back waits of secs overran in total"""
+    start = timing.monotonic()
+    for i in range(repetitions):
+        waiter(secs)
+    return 1000 * (timing.monotonic() - start - secs * repetitions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the jitter of waits')
+    parser.add_argument('--intervals', default='0.001,0.01,0.1', help='comma separated wait lengths in seconds')
+    parser.add_argument('--repetitions', type=int, default=200, help='number of waits of each length')
+    args = parser.parse_args()
+
+    methods = [('utils.wait (old)', legacy_wait),
+               ('timing.wait', timing.wait),
+               ('timing.wait spin', lambda secs: timing.wait(secs, spin=True)),
+               ]
+    timing.calibrate()
+    print("spin margin %.3f ms" % (1000 * timing.spin_margin))
+    columns = ['mean', 'p50', 'p99', 'max', 'std']
+    print("%-18s%10s" % ('method', 'interval') + ''.join("%10s" % column for column in columns) + "%12s" % 'drift')
+    for interval in [float(value) for value in args.intervals.split(',')]:
+        for name, waiter in methods:
+            stats = timing.jitter(waiter, interval, args.repetitions)
+            print("%-18s%10.3f" % (name, interval) + ''.join("%10.3f" % stats[column] for column in columns) +
+                  "%12.3f" % drift(waiter, interval, args.repetitions))
+
+
+if __name__ == '__main__':
+    main()
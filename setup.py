@@ -23,6 +23,9 @@ setup(
         'scripts/behave',
         'scripts/pyoperantctl',
         'scripts/allsummary.py',
+        'scripts/arduino_benchmark.py',
+        'scripts/audio_benchmark.py',
+        'scripts/timing_benchmark.py',
     ],
     license="BSD",
     classifiers=[
@@ -1,8 +1,43 @@
-
 int baudRate = 19200; // 9600 seems common though it can probably be increased significantly if needed.
 char ioBytes[2];
 int ioPort = 0;
 
+const int maxPins = 64; // Number of pins that can be represented in a channel bitmask
+uint64_t configuredPins = 0; // Bit n is set once pin n has been configured as an input or output
+uint64_t pinMask = 0;
+byte maskBytes[9];
+uint64_t subscribedPins = 0; // Bit n is set while edge events are being sent for pin n
+uint64_t lastValues = 0; // Last value sent for each subscribed pin
+byte eventBytes[7];
+byte extraBytes[16]; // Bytes that follow the port and action for actions 9, 10 and 11
+uint64_t frameMask = 0;
+uint64_t frameValues = 0;
+uint64_t pulsingPins = 0; // Bit n is set while pin n is on for a timed pulse
+uint64_t blinkingPins = 0; // Bit n is set while pin n is blinking
+uint64_t restoreValues = 0; // Value to leave each blinking pin at when the blink ends
+unsigned long timerStart[maxPins]; // millis() when the pulse or blink started
+unsigned long timerLength[maxPins]; // Length of the pulse or blink in ms
+unsigned long halfPeriod[maxPins]; // Time between toggles of a blinking pin in ms
+unsigned long lastToggle[maxPins]; // millis() of the last toggle of a blinking pin
+unsigned long now = 0;
+int pinValue = 0;
+
+const byte frameSync = 0xA5; // First byte of every frame. It is never a valid port so it can't start a two byte message
+const byte legacyVersion = 1; // Protocol versions that can be asked for with action 12
+const byte framedVersion = 2;
+const int maxFrame = 32; // Longest length byte accepted in a frame
+const int eventAction = 13;
+const int nakAction = 14;
+const byte badChecksum = 1; // Reasons sent with a NAK
+const byte badLength = 2;
+const byte badAction = 3;
+bool framed = false; // Events are sent as frames and bytes outside frames are dropped once the host asks for frames
+bool frameRequest = false; // The request being handled came as a frame, so its reply goes out as one
+byte frameIn[maxFrame + 2];
+byte frameOut[maxFrame + 3];
+byte frameSeq = 0; // Sequence number of the framed request being handled
+byte frameAction = 0;
+
 void setup()
 {
   // start serial port at the specified baud rate
@@ -10,14 +45,162 @@ void setup()
   while (!Serial) {
     ; // wait for serial port to connect. Needed for Leonardo only
   }
+  Serial.setTimeout(50); // Don't stall for long on a message that was cut short
   Serial.println("Initialized!");
 }
 
-void loop()
+byte crc8(const byte *data, int length)
+{
+  // CRC-8 with polynomial 0x07, as used by the host to check frames
+  byte crc = 0;
+  for (int i = 0; i < length; i++) {
+    crc ^= data[i];
+    for (int bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x80) ? (byte) ((crc << 1) ^ 0x07) : (byte) (crc << 1);
+    }
+  }
+  return crc;
+}
+
+void writeFrame(byte seq, byte action, const byte *payload, int length)
+{
+  // Frames are the sync byte, a length byte counting the sequence number, action and payload, the sequence number, the
+  // action, the payload and a CRC-8 of everything from the length byte to the end of the payload
+  frameOut[0] = frameSync;
+  frameOut[1] = (byte) (length + 2);
+  frameOut[2] = seq;
+  frameOut[3] = action;
+  for (int i = 0; i < length; i++) {
+    frameOut[i + 4] = payload[i];
+  }
+  frameOut[length + 4] = crc8(frameOut + 1, length + 3);
+  Serial.write(frameOut, length + 5);
+}
+
+void reply(char header, const byte *data, int length)
+{
+  // A framed reply carries the sequence number and action of the request. A reply to a two byte message is the header
+  // byte, if there is one, followed by the data
+  if (frameRequest) {
+    writeFrame(frameSeq, frameAction, data, length);
+  } else {
+    if (header) {
+      Serial.write(header);
+    }
+    Serial.write(data, length);
+  }
+}
+
+void ack()
+{
+  // Framed requests that have nothing to reply with are acknowledged with an empty reply
+  if (frameRequest) {
+    writeFrame(frameSeq, frameAction, NULL, 0);
+  }
+}
+
+void nak(byte reason)
+{
+  writeFrame(frameSeq, nakAction, &reason, 1);
+}
+
+void writeMask(char header, uint64_t mask)
+{
+  // Replies that carry a bitmask are 8 bytes, least significant byte first
+  for (int i = 0; i < 8; i++) {
+    maskBytes[i] = (byte) ((mask >> (8 * i)) & 0xFF);
+  }
+  reply(header, maskBytes, 8);
+}
+
+void writeEvent(int pin, int value)
+{
+  // Edge events are 'E', the pin, the new value and the time of the change in microseconds, least significant byte
+  // first. In framed mode the 'E' is dropped and the rest is sent as a frame with sequence number 0
+  unsigned long now = micros();
+  eventBytes[0] = 'E';
+  eventBytes[1] = (byte) pin;
+  eventBytes[2] = (byte) value;
+  for (int i = 0; i < 4; i++) {
+    eventBytes[i + 3] = (byte) ((now >> (8 * i)) & 0xFF);
+  }
+  if (framed) {
+    writeFrame(0, eventAction, eventBytes + 1, 6);
+  } else {
+    Serial.write(eventBytes, 7);
+  }
+}
+
+void checkEdges()
+{
+  // Send an event for every subscribed pin whose value changed since the last check
+  for (int pin = 0; pin < maxPins; pin++) {
+    if ((subscribedPins >> pin) & 1) {
+      pinValue = digitalRead(pin);
+      if (pinValue != (int) ((lastValues >> pin) & 1)) {
+        lastValues ^= ((uint64_t) 1) << pin;
+        writeEvent(pin, pinValue);
+      }
+    }
+  }
+}
+
+unsigned long readLong(const byte *data)
+{
+  // Unsigned 4 byte value, least significant byte first
+  unsigned long value = 0;
+  for (int i = 0; i < 4; i++) {
+    value |= ((unsigned long) data[i]) << (8 * i);
+  }
+  return value;
+}
+
+int extraLength(int action)
+{
+  // Number of bytes that follow the port and action of a request
+  switch (action) {
+    case 9:
+      return 16;
+    case 10:
+      return 4;
+    case 11:
+      return 8;
+    default:
+      return 0;
+  }
+}
+
+void cancelTimers(uint64_t pins)
+{
+  // Writing to a pin cancels any pulse or blink that is running on it
+  pulsingPins &= ~pins;
+  blinkingPins &= ~pins;
+}
+
+void checkTimers()
+{
+  // End pulses and blinks that are over, and toggle blinking pins that are due
+  now = millis();
+  for (int pin = 0; pin < maxPins; pin++) {
+    if ((pulsingPins >> pin) & 1) {
+      if (now - timerStart[pin] >= timerLength[pin]) {
+        digitalWrite(pin, LOW);
+        pulsingPins &= ~(((uint64_t) 1) << pin);
+      }
+    } else if ((blinkingPins >> pin) & 1) {
+      if (now - timerStart[pin] >= timerLength[pin]) {
+        digitalWrite(pin, ((restoreValues >> pin) & 1) ? HIGH : LOW);
+        blinkingPins &= ~(((uint64_t) 1) << pin);
+      } else if (now - lastToggle[pin] >= halfPeriod[pin]) {
+        digitalWrite(pin, !digitalRead(pin));
+        lastToggle[pin] += halfPeriod[pin];
+      }
+    }
+  }
+}
+
+void handleRequest(int action, int port, const byte *extra)
 {
-  // All serial communications should be two bytes long
-  // The first byte specifies the port to act on
-  // The second byte specifies the action to take
   // The actions are:
   // 0: Read the specified input
   // 1: Write the specified output to HIGH
@@ -25,8 +208,175 @@ void loop()
   // 3: Set the specified pin to OUTPUT
   // 4: Set the specified pin to INPUT
   // 5: Set the specified pin to INPUT_PULLUP
-  // if we get a valid serial message, read the request:
-  if (Serial.available() >= 2) {
+  // 6: Read every configured pin at once (the port byte is ignored). The reply is 'M' followed by an 8 byte
+  //    bitmask, least significant byte first, where bit n is the value of pin n.
+  // 7: Subscribe to edge events from the specified pin. An event with the current value is sent straight away.
+  // 8: Unsubscribe from edge events from the specified pin
+  // 9: Write several outputs at once (the port byte is ignored). The message continues with an 8 byte bitmask of the
+  //    pins to write and an 8 byte bitmask of their values, both least significant byte first.
+  // 10: Pulse the specified output. The message continues with the pulse length in ms as 4 bytes, least significant
+  //     byte first. The output is set HIGH straight away and LOW once the pulse is over.
+  // 11: Blink the specified output. The message continues with the period and then the length of the blink in ms,
+  //     each as 4 bytes, least significant byte first. The output toggles every half period and goes back to its
+  //     previous value once the blink is over.
+  // 12: Switch protocol. The port byte is the protocol version to use: 1 for two byte messages, 2 for frames. The
+  //     reply is the version that is used from then on. Frames are always answered with frames, but events are only
+  //     sent as frames in framed mode.
+  // Writing to an output (actions 1, 2 and 9) cancels any pulse or blink running on it.
+  switch (action) {
+    case 0: // Read an input
+      pinValue = digitalRead(port);
+      maskBytes[0] = (byte) pinValue;
+      reply(0, maskBytes, 1);
+      break;
+    case 1: // Write an output to HIGH
+      cancelTimers(((uint64_t) 1) << port);
+      digitalWrite(port, HIGH);
+      ack();
+      break;
+    case 2: // Write an output to LOW
+      cancelTimers(((uint64_t) 1) << port);
+      digitalWrite(port, LOW);
+      ack();
+      break;
+    case 3: // Set a pin to OUTPUT
+      pinMode(port, OUTPUT);
+      digitalWrite(port, LOW);
+      configuredPins |= ((uint64_t) 1) << port;
+      ack();
+      break;
+    case 4: // Set a pin to INPUT
+      pinMode(port, INPUT);
+      configuredPins |= ((uint64_t) 1) << port;
+      ack();
+      break;
+    case 5: // Set a pin to INPUT_PULLUP
+      pinMode(port, INPUT_PULLUP);
+      configuredPins |= ((uint64_t) 1) << port;
+      ack();
+      break;
+    case 6: // Read all configured pins
+      pinMask = 0;
+      for (int pin = 0; pin < maxPins; pin++) {
+        if (((configuredPins >> pin) & 1) && digitalRead(pin) == HIGH) {
+          pinMask |= ((uint64_t) 1) << pin;
+        }
+      }
+      writeMask('M', pinMask);
+      break;
+    case 7: // Subscribe to edge events
+      subscribedPins |= ((uint64_t) 1) << port;
+      pinValue = digitalRead(port);
+      if (pinValue == HIGH) {
+        lastValues |= ((uint64_t) 1) << port;
+      } else {
+        lastValues &= ~(((uint64_t) 1) << port);
+      }
+      writeEvent(port, pinValue);
+      ack();
+      break;
+    case 8: // Unsubscribe from edge events
+      subscribedPins &= ~(((uint64_t) 1) << port);
+      ack();
+      break;
+    case 9: // Write a frame of outputs
+      frameMask = 0;
+      frameValues = 0;
+      for (int i = 0; i < 8; i++) {
+        frameMask |= ((uint64_t) extra[i]) << (8 * i);
+        frameValues |= ((uint64_t) extra[i + 8]) << (8 * i);
+      }
+      cancelTimers(frameMask);
+      // Both masks are decoded before any pin is written so the writes happen back to back
+      for (int pin = 0; pin < maxPins; pin++) {
+        if ((frameMask >> pin) & 1) {
+          digitalWrite(pin, ((frameValues >> pin) & 1) ? HIGH : LOW);
+        }
+      }
+      ack();
+      break;
+    case 10: // Pulse an output
+      cancelTimers(((uint64_t) 1) << port);
+      timerStart[port] = millis();
+      timerLength[port] = readLong(extra);
+      digitalWrite(port, HIGH);
+      pulsingPins |= ((uint64_t) 1) << port;
+      ack();
+      break;
+    case 11: // Blink an output
+      cancelTimers(((uint64_t) 1) << port);
+      if (digitalRead(port) == HIGH) {
+        restoreValues |= ((uint64_t) 1) << port;
+      } else {
+        restoreValues &= ~(((uint64_t) 1) << port);
+      }
+      halfPeriod[port] = max(readLong(extra) / 2, (unsigned long) 1);
+      timerLength[port] = readLong(extra + 4);
+      timerStart[port] = millis();
+      lastToggle[port] = timerStart[port];
+      digitalWrite(port, !digitalRead(port));
+      blinkingPins |= ((uint64_t) 1) << port;
+      ack();
+      break;
+    case 12: // Switch protocol
+      // The reply goes out in the protocol the request came in
+      if (port == legacyVersion || port == framedVersion) {
+        maskBytes[0] = (byte) port;
+        reply(0, maskBytes, 1);
+        framed = (port == framedVersion);
+      } else {
+        maskBytes[0] = framed ? framedVersion : legacyVersion;
+        reply(0, maskBytes, 1);
+      }
+      break;
+    default:
+      if (frameRequest) {
+        nak(badAction);
+      }
+      break;
+  }
+}
+
+void readFrame()
+{
+  // Read and check a frame once its sync byte has arrived. Anything that doesn't check out is dropped and the search
+  // for the next sync byte starts from the byte after this one
+  Serial.read();
+  if (Serial.readBytes((char *) frameIn, 1) != 1 || frameIn[0] < 3 || frameIn[0] > maxFrame) {
+    return;
+  }
+  int length = frameIn[0];
+  if (Serial.readBytes((char *) frameIn + 1, length + 1) != length + 1) {
+    return;
+  }
+  frameSeq = frameIn[1];
+  frameAction = frameIn[2];
+  if (crc8(frameIn, length + 1) != frameIn[length + 1]) {
+    // Only a host that has asked for frames is listening for NAKs
+    if (framed) {
+      nak(badChecksum);
+    }
+  } else if (length - 3 != extraLength(frameAction)) {
+    nak(badLength);
+  } else {
+    frameRequest = true;
+    handleRequest(frameAction, frameIn[3], frameIn + 4);
+    frameRequest = false;
+  }
+}
+
+void loop()
+{
+  // Requests come either as frames or as two byte messages. Frames start with the sync byte and are described in
+  // writeFrame. Two byte messages are the port to act on and then the action to take, followed by the extra bytes of
+  // the actions that have them. Once the device is in framed mode, bytes outside a frame are dropped.
+  if (Serial.available() > 0 && Serial.peek() == frameSync) {
+    readFrame();
+  } else if (framed) {
+    if (Serial.available() > 0) {
+      Serial.read();
+    }
+  } else if (Serial.available() >= 2) {
     // get incoming two bytes:
     Serial.readBytes(ioBytes, 2);
     //Serial.println("I received: ");
@@ -34,28 +384,15 @@ void loop()
     //Serial.println(ioBytes[1], DEC);
     // Extract the specified port
     ioPort = (int) ioBytes[0];
-    // Switch case on the specified action
-    switch ((int) ioBytes[1]) {
-      case 0: // Read an input
-        Serial.write(digitalRead(ioPort));
-        break;
-      case 1: // Write an output to HIGH
-        digitalWrite(ioPort, HIGH);       
-        break;
-      case 2: // Write an output to LOW
-        digitalWrite(ioPort, LOW);        
-        break;
-      case 3: // Set a pin to OUTPUT
-        pinMode(ioPort, OUTPUT);
-        digitalWrite(ioPort, LOW);
-        break;
-      case 4: // Set a pin to INPUT
-        pinMode(ioPort, INPUT);
-        break;
-      case 5: // Set a pin to INPUT_PULLUP
-        pinMode(ioPort, INPUT_PULLUP);
-        break;
+    if (Serial.readBytes((char *) extraBytes, extraLength(ioBytes[1])) == extraLength(ioBytes[1])) {
+      handleRequest((int) ioBytes[1], ioPort, extraBytes);
     }
   }
+  if (pulsingPins | blinkingPins) {
+    checkTimers();
+  }
+  if (subscribedPins) {
+    checkEdges();
+  }
   //delay(10); // Should probably move to a non-delay based spacing.
 }
@@ -0,0 +1,80 @@
+"""A stand-in for the comedi python bindings, with the calls ComediInterface makes, for testing it without a card
+
+Each device keeps the raw level of its channels, 1 (high) unless set, as comedi reads an input that nothing pulls low.
+Tests drive inputs with set_raw(), read outputs with raw(), count calls with calls and make reads fail with
+fail_reads.
+
+    import sys
+    from tests import fake_comedi
+    sys.modules['comedi'] = fake_comedi
+"""
+import threading
+
+COMEDI_INPUT = 0
+COMEDI_OUTPUT = 1
+
+
+class FakeDevice(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.levels = dict()  # (subdevice, channel): raw level
+        self.directions = dict()  # (subdevice, channel): COMEDI_INPUT or COMEDI_OUTPUT
+        self.calls = dict(dio_read=0, dio_write=0, bitfield_read=0, bitfield_write=0)
+        self.fail_reads = False
+        self.lock = threading.Lock()
+
+    def set_raw(self, subdevice, channel, level):
+        with self.lock:
+            self.levels[(subdevice, channel)] = int(level)
+
+    def raw(self, subdevice, channel):
+        with self.lock:
+            return self.levels.get((subdevice, channel), 1)
+
+
+devices = dict()
+
+
+def comedi_open(name):
+    return devices.setdefault(name, FakeDevice(name))
+
+
+def comedi_close(device):
+    return 0
+
+
+def comedi_dio_config(device, subdevice, channel, direction):
+    device.directions[(subdevice, channel)] = direction
+    return 1
+
+
+def comedi_dio_read(device, subdevice, channel):
+    device.calls['dio_read'] += 1
+    if device.fail_reads:
+        return (0, 0)
+    return (1, device.raw(subdevice, channel))
+
+
+def comedi_dio_write(device, subdevice, channel, value):
+    device.calls['dio_write'] += 1
+    device.set_raw(subdevice, channel, value)
+    return 1
+
+
+def comedi_dio_bitfield2(device, subdevice, write_mask, bits, base_channel):
+    if write_mask:
+        device.calls['bitfield_write'] += 1
+    else:
+        device.calls['bitfield_read'] += 1
+        if device.fail_reads:
+            return (-1, 0)
+    with device.lock:
+        for offset in range(32):
+            if (write_mask >> offset) & 1:
+                device.levels[(subdevice, base_channel + offset)] = (bits >> offset) & 1
+        read = 0
+        for offset in range(32):
+            if device.levels.get((subdevice, base_channel + offset), 1):
+                read |= 1 << offset
+    return (1, read)
@@ -0,0 +1,203 @@
+"""Tests of ArduinoInterface against the Teensy emulator in pyoperant.interfaces.arduino_emulator
+
+    python -m unittest discover -s tests -t .
+"""
+import time
+import datetime
+import threading
+import unittest
+
+from pyoperant.interfaces.arduino_ import ArduinoInterface, ArduinoException
+from pyoperant.interfaces.arduino_emulator import TeensyEmulator
+
+PIN = 3
+
+
+class ArduinoTestCase(unittest.TestCase):
+    """Starts an emulator and an interface with PIN configured as an input"""
+
+    emulator_kwargs = {}
+    interface_kwargs = {}
+
+    def setUp(self):
+        self.emulator = TeensyEmulator(**self.emulator_kwargs)
+        self.emulator.start()
+        self.interface = ArduinoInterface(self.emulator.device_name, inputs=[(PIN,)], **self.interface_kwargs)
+
+    def tearDown(self):
+        self.interface.close()
+        self.emulator.stop()
+
+    def assert_edge(self, delay=0.1, timeout=2.0):
+        self.emulator.schedule_input(PIN, True, delay=delay)
+        start = time.time()
+        timestamp = self.interface._poll(PIN, timeout=timeout)
+        self.assertIsInstance(timestamp, datetime.datetime)
+        self.assertGreaterEqual(time.time() - start, delay * 0.5)
+        return timestamp
+
+
+class TestPolling(ArduinoTestCase):
+
+    def test_rising_edge(self):
+        self.assert_edge()
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertIsNone(self.interface._poll(PIN, timeout=0.2))
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+    def test_held_input_returns_once(self):
+        self.assert_edge(delay=0.0)
+        self.assertIsNone(self.interface._poll(PIN, timeout=0.2))
+
+
+class TestStream(ArduinoTestCase):
+
+    interface_kwargs = {'stream': True}
+
+    def test_rising_edge(self):
+        timestamp = self.assert_edge()
+        # device times are mapped onto the host clock
+        self.assertLess(abs((datetime.datetime.now() - timestamp).total_seconds()), 0.5)
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertIsNone(self.interface._poll(PIN, timeout=0.2))
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+    def test_already_active(self):
+        self.emulator.set_input(PIN, True)
+        time.sleep(0.1)
+        self.assertIsNotNone(self.interface._poll(PIN, timeout=0.5))
+        # held, so the same press isn't reported again
+        self.assertIsNone(self.interface._poll(PIN, timeout=0.2))
+
+    def test_release_between_polls(self):
+        self.assert_edge(delay=0.0)
+        self.emulator.set_input(PIN, False)
+        time.sleep(0.1)
+        self.assert_edge()
+
+    def test_listeners_without_polls_queue_nothing(self):
+        # subscribing reports the channel's value, which isn't waited for in unframed mode; let it arrive first
+        deadline = time.time() + 1.0
+        while self.interface._state[PIN]["value"] is None and time.time() < deadline:
+            time.sleep(0.01)
+        edges = []
+        self.assertTrue(self.interface._subscribe_edges(lambda value, timestamp: edges.append(value), PIN))
+        for i in range(10):
+            self.emulator.set_input(PIN, i % 2 == 0)
+            time.sleep(0.02)
+        time.sleep(0.1)
+        self.assertEqual(edges, [i % 2 == 0 for i in range(10)])
+        self.assertEqual(self.interface._state[PIN]["events"].qsize(), 0)
+        self.assertFalse(self.interface._state[PIN]["value"])
+
+    def test_reader_stopping_wakes_poll(self):
+        self.emulator.schedule_input(PIN, True, delay=0.5)
+        self.interface._wake_waiters()
+        # a wake-up left over from before the poll is discarded, so the poll still sees the edge
+        self.assertIsNotNone(self.interface._poll(PIN, timeout=2.0))
+
+
+class TestFramedStream(TestStream):
+
+    interface_kwargs = {'stream': True, 'framed': True}
+
+    def test_framed(self):
+        self.assertTrue(self.interface.framed)
+        self.assertEqual(self.interface._read_many([PIN]), [False])
+
+
+class TestCorruptedFrames(ArduinoTestCase):
+
+    emulator_kwargs = {'corruption': 0.05}
+    interface_kwargs = {'stream': True, 'framed': True}
+
+    def test_reads_survive_corruption(self):
+        for i in range(50):
+            self.assertFalse(self.interface._read_bool(PIN))
+
+    def test_edge(self):
+        self.emulator.schedule_pulses(PIN, period=0.2, width=0.1)
+        self.assertIsNotNone(self.interface._poll(PIN, timeout=5.0))
+
+
+class TestReaderThread(ArduinoTestCase):
+
+    emulator_kwargs = {'latency': 0.2}
+    interface_kwargs = {'framed': True}
+
+    def test_reader_dying_wakes_requests(self):
+        errors = []
+
+        def request():
+            try:
+                self.interface._request(0, PIN)
+            except ArduinoException as e:
+                errors.append(e)
+
+        def crash():
+            raise RuntimeError("reader thread crashed")
+
+        waiter = threading.Thread(target=request)
+        waiter.daemon = True
+        waiter.start()
+        time.sleep(0.05)  # the request is in flight and its reply is still on the link
+        self.interface._expire_requests = crash
+        waiter.join(2.0)
+        self.assertFalse(waiter.is_alive(), "request still waiting on a reader thread that has died")
+        self.assertEqual(len(errors), 1)
+        # the next request starts a new reader
+        del self.interface._expire_requests
+        self.assertFalse(self.interface._read_bool(PIN))
+
+
+class TestReconnect(ArduinoTestCase):
+
+    interface_kwargs = {'stream': True, 'framed': True}
+
+    def test_reconnect(self):
+        self.assert_edge()
+        self.emulator.set_input(PIN, False)
+        old_reader = self.interface._reader
+        self.interface.reconnect_panel()
+        self.assertFalse(old_reader.is_alive())
+        self.assertTrue(self.interface.framed)
+        self.assertFalse(self.interface._read_bool(PIN))
+        self.assert_edge()
+
+    def test_reconnect_while_polling(self):
+        errors = []
+
+        def poll():
+            try:
+                self.interface._poll(PIN, timeout=2.0)
+            except ArduinoException as e:
+                errors.append(e)
+
+        poller = threading.Thread(target=poll)
+        poller.daemon = True
+        poller.start()
+        time.sleep(0.1)
+        self.interface.reconnect_panel()  # the poll is woken by its reader stopping
+        poller.join(2.0)
+        self.assertFalse(poller.is_alive())
+        self.assertEqual(len(errors), 1)
+        self.assert_edge()
+
+
+class TestLegacyFirmware(ArduinoTestCase):
+
+    emulator_kwargs = {'legacy_only': True}
+    interface_kwargs = {'stream': True, 'framed': True}
+
+    def test_falls_back_to_two_byte_messages(self):
+        self.assertFalse(self.interface.framed)
+        self.assertFalse(self.interface._read_bool(PIN))
+        self.assert_edge()
+
+
+if __name__ == '__main__':
+    unittest.main()
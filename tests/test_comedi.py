@@ -0,0 +1,167 @@
+"""Tests of ComediInterface against the fake comedi module in tests/fake_comedi.py
+
+    python -m unittest discover -s tests -t .
+"""
+import sys
+import time
+import datetime
+import threading
+import unittest
+
+from tests import fake_comedi
+
+sys.modules['comedi'] = fake_comedi
+
+from pyoperant import InterfaceError
+from pyoperant.interfaces.comedi_ import ComediInterface
+
+SUBDEVICE = 2
+
+
+class ComediTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fake_comedi.devices.clear()
+        self.interface = ComediInterface('/dev/comedi0', poll_interval=0.001)
+        self.device = fake_comedi.devices['/dev/comedi0']
+
+    def tearDown(self):
+        self.interface.close()
+
+    def press(self, channel, delay=0.0):
+        """pull an input low, which comedi_ reads as active, after delay seconds"""
+        if delay:
+            timer = threading.Timer(delay, self.device.set_raw, [SUBDEVICE, channel, 0])
+            timer.daemon = True
+            timer.start()
+        else:
+            self.device.set_raw(SUBDEVICE, channel, 0)
+
+
+class TestPoll(ComediTestCase):
+
+    def setUp(self):
+        super(TestPoll, self).setUp()
+        for channel in (4, 52):
+            self.interface._config_read(SUBDEVICE, channel)
+
+    def test_already_active(self):
+        self.press(4)
+        start = time.time()
+        self.assertIsInstance(self.interface._poll(SUBDEVICE, 4, timeout=1.0), datetime.datetime)
+        self.assertLess(time.time() - start, 0.1)
+        self.assertEqual(self.device.calls['bitfield_read'], 0)  # answered without starting the poller
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertIsNone(self.interface._poll(SUBDEVICE, 4, timeout=0.2))
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertEqual(self.interface._waiters, {})
+
+    def test_rising_edge(self):
+        self.press(52, delay=0.1)  # in the second bank of channels
+        start = time.time()
+        self.assertIsInstance(self.interface._poll(SUBDEVICE, 52, timeout=1.0), datetime.datetime)
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+    def test_edge_on_other_channel(self):
+        self.press(52, delay=0.05)
+        self.assertIsNone(self.interface._poll(SUBDEVICE, 4, timeout=0.2))
+
+    def test_waiters_share_an_edge(self):
+        results = []
+        waiters = [threading.Thread(target=lambda: results.append(self.interface._poll(SUBDEVICE, 4, timeout=1.0)))
+                   for i in range(2)]
+        for waiter in waiters:
+            waiter.start()
+        self.press(4, delay=0.1)
+        for waiter in waiters:
+            waiter.join()
+        self.assertEqual(len(results), 2)
+        self.assertTrue(all(isinstance(result, datetime.datetime) for result in results))
+
+    def test_poller_sleeps_when_nothing_waits(self):
+        self.press(4, delay=0.05)
+        self.interface._poll(SUBDEVICE, 4, timeout=1.0)
+        time.sleep(0.05)
+        reads = self.device.calls['bitfield_read']
+        time.sleep(0.1)
+        self.assertEqual(self.device.calls['bitfield_read'], reads)
+
+    def test_read_error_wakes_waiters(self):
+        errors = []
+
+        def poll():
+            try:
+                self.interface._poll(SUBDEVICE, 4, timeout=2.0)
+            except InterfaceError as e:
+                errors.append(e)
+
+        waiters = [threading.Thread(target=poll) for i in range(2)]
+        for waiter in waiters:
+            waiter.start()
+        time.sleep(0.05)
+        self.device.fail_reads = True
+        for waiter in waiters:
+            waiter.join(1.0)
+        self.assertFalse(any(waiter.is_alive() for waiter in waiters))
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(self.interface._waiters, {})
+
+
+class TestBitfields(ComediTestCase):
+
+    def setUp(self):
+        super(TestBitfields, self).setUp()
+        self.outputs = range(28, 36)  # across the boundary between the first two banks
+        for channel in self.outputs:
+            self.interface._config_write(SUBDEVICE, channel)
+
+    def test_read_many_inverts(self):
+        for channel in (3, 40):
+            self.interface._config_read(SUBDEVICE, channel)
+        self.press(40)
+        self.assertEqual(self.interface._read_many(SUBDEVICE, [3, 40]), [False, True])
+        self.assertEqual(self.device.calls['bitfield_read'], 2)  # one read per bank
+
+    def test_read_many_one_read_per_bank(self):
+        self.press(5)
+        self.press(7)
+        self.assertEqual(self.interface._read_many(SUBDEVICE, [5, 6, 7, 8]), [True, False, True, False])
+        self.assertEqual(self.device.calls['bitfield_read'], 1)
+
+    def test_write_many_packs_and_inverts(self):
+        values = [True, False, True, False, False, True, True, False]
+        self.assertEqual(self.interface._write_many(SUBDEVICE, self.outputs, values), values)
+        self.assertEqual(self.device.calls['bitfield_write'], 2)  # one write per bank
+        self.assertEqual([self.device.raw(SUBDEVICE, channel) for channel in self.outputs],
+                         [0 if value else 1 for value in values])
+
+    def test_write_many_skips_outputs_at_their_value(self):
+        self.interface._write_many(SUBDEVICE, self.outputs, [False] * 8)
+        writes = self.device.calls['bitfield_write']
+        self.interface._write_many(SUBDEVICE, self.outputs, [False] * 8)
+        self.assertEqual(self.device.calls['bitfield_write'], writes)
+        # only the bank with a change is written
+        self.interface._write_many(SUBDEVICE, self.outputs, [False] * 7 + [True])
+        self.assertEqual(self.device.calls['bitfield_write'], writes + 1)
+        self.assertEqual(self.device.raw(SUBDEVICE, 35), 0)
+
+    def test_write_bool_updates_shadow(self):
+        self.interface._write_many(SUBDEVICE, self.outputs, [False] * 8)
+        self.interface._write_bool(SUBDEVICE, 28, True)
+        self.assertEqual(self.device.raw(SUBDEVICE, 28), 0)
+        writes = self.device.calls['bitfield_write']
+        self.interface._write_many(SUBDEVICE, self.outputs, [True] + [False] * 7)
+        self.assertEqual(self.device.calls['bitfield_write'], writes)
+
+    def test_configuring_forgets_shadow(self):
+        self.interface._write_many(SUBDEVICE, self.outputs, [False] * 8)
+        self.device.set_raw(SUBDEVICE, 28, 0)  # changed behind the interface's back
+        self.interface._config_write(SUBDEVICE, 28)
+        self.interface._write_many(SUBDEVICE, self.outputs, [False] * 8)
+        self.assertEqual(self.device.raw(SUBDEVICE, 28), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+"""Tests of the edge and debounce engine of hwio.BooleanInput, and of device timed pulses of hwio.BooleanOutput
+
+    python -m unittest discover -s tests -t .
+"""
+import time
+import datetime
+import unittest
+
+from pyoperant import hwio
+
+
+class PushingInterface(object):
+    """An interface whose input pushes its edges to the inputs subscribed to it"""
+
+    def __init__(self):
+        self.value = False
+        self.listeners = []
+
+    def _read_bool(self, **kwargs):
+        return self.value
+
+    def _subscribe_edges(self, callback, **kwargs):
+        self.listeners.append(callback)
+        return True
+
+    def push(self, value, timestamp=None):
+        self.value = value
+        for listener in self.listeners:
+            listener(value, timestamp)
+
+
+class TestDebounce(unittest.TestCase):
+
+    debounce = 0.05
+
+    def setUp(self):
+        self.interface = PushingInterface()
+        self.input = hwio.BooleanInput(interface=self.interface, debounce=self.debounce)
+        self.input.read()  # the first value isn't an edge
+        self.start = datetime.datetime.now()
+
+    def values(self):
+        return [value for timestamp, value in self.input.edges_since(self.start)]
+
+    def test_edges(self):
+        self.interface.push(True)
+        time.sleep(2 * self.debounce)
+        self.interface.push(False)
+        self.assertEqual(self.values(), [True, False])
+        self.assertFalse(self.input.value)
+
+    def test_bounce_is_dropped(self):
+        self.interface.push(True)
+        self.interface.push(False)
+        self.interface.push(True)
+        time.sleep(2 * self.debounce)
+        self.assertEqual(self.values(), [True])
+        self.assertTrue(self.input.value)
+
+    def test_release_within_window_is_kept(self):
+        self.interface.push(True)
+        released = datetime.datetime.now()
+        self.interface.push(False, released)
+        self.assertTrue(self.input.value)  # held back until the window is over
+        time.sleep(2 * self.debounce)
+        self.assertFalse(self.input.value)
+        self.assertEqual(self.values(), [True, False])
+        self.assertEqual(self.input.edges[-1][0], released)
+        # so the next press isn't lost
+        self.interface.push(True)
+        self.assertEqual(self.values(), [True, False, True])
+
+    def test_settled_edge_wakes_waiter(self):
+        self.interface.push(True)
+        self.interface.push(False)
+        edge = self.input.wait_edge(timeout=1.0, value=False)
+        self.assertIsNotNone(edge)
+        self.assertFalse(edge[1])
+
+    def test_change_after_window_settles_pending(self):
+        polled = hwio.BooleanInput(interface=self.interface, debounce=self.debounce)
+        polled.read()
+        start = datetime.datetime.now()
+        polled.feed(True, start)
+        polled.feed(False, start + datetime.timedelta(seconds=self.debounce / 2))
+        # read again once the window is over
+        polled.feed(False, start + datetime.timedelta(seconds=2 * self.debounce))
+        self.assertFalse(polled.value)
+        self.assertEqual([value for timestamp, value in polled.edges_since(self.start)], [True, False])
+        time.sleep(2 * self.debounce)  # the settle timer finds nothing left to do
+        self.assertEqual(len(polled.edges), 2)
+
+
+class TestNoDebounce(unittest.TestCase):
+
+    def test_every_change_is_an_edge(self):
+        interface = PushingInterface()
+        input_ = hwio.BooleanInput(interface=interface)
+        input_.read()
+        start = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        for value in (True, False, True, False):
+            interface.push(value)
+        self.assertEqual([value for timestamp, value in input_.edges_since(start)], [True, False, True, False])
+
+
+class PulsingInterface(object):
+    """An interface whose outputs time their own pulses"""
+
+    def __init__(self):
+        self.pulses = []
+
+    def _write_bool(self, value, **kwargs):
+        return value
+
+    def _pulse_bool(self, duration, **kwargs):
+        self.pulses.append(duration)
+
+
+class TestDevicePulse(unittest.TestCase):
+
+    def setUp(self):
+        self.output = hwio.BooleanOutput(interface=PulsingInterface())
+
+    def test_on_during_pulse(self):
+        self.output.pulse(0.2, wait=False)
+        self.assertTrue(self.output.last_value)
+        time.sleep(0.3)
+        self.assertFalse(self.output.last_value)
+
+    def test_off_after_waiting(self):
+        self.output.pulse(0.05)
+        self.assertFalse(self.output.last_value)
+
+    def test_write_during_pulse_is_kept(self):
+        self.output.pulse(0.1, wait=False)
+        self.output.write(True)
+        time.sleep(0.2)
+        self.assertTrue(self.output.last_value)
+
+
+if __name__ == '__main__':
+    unittest.main()
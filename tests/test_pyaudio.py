@@ -0,0 +1,224 @@
+"""Tests of the stimulus cache and the persistent output stream of PyAudioInterface, on the null devices of
+pyoperant.interfaces.pyaudio_emulator, and of the chunk files AudioRecorder keeps. These need pyaudio itself for its
+constants, and are skipped without it.
+
+    python -m unittest discover -s tests -t .
+"""
+import os
+import time
+import wave
+import struct
+import shutil
+import tempfile
+import unittest
+
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None
+
+if pyaudio is not None:
+    from pyoperant import InterfaceError
+    from pyoperant.interfaces.pyaudio_ import StimulusCache, AudioHost, PyAudioInterface, AudioRecorder
+    from pyoperant.interfaces.pyaudio_emulator import NullPyAudio
+
+
+def write_wav(path, nframes, rate=48000, sampwidth=2, value=1000):
+    wf = wave.open(path, 'wb')
+    wf.setnchannels(1)
+    wf.setsampwidth(sampwidth)
+    wf.setframerate(rate)
+    if sampwidth == 2:
+        wf.writeframes(struct.pack('<%dh' % nframes, *([value] * nframes)))
+    else:
+        wf.writeframes(chr(128 + value % 128) * nframes)
+    wf.close()
+    return path
+
+
+class WavTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def wav(self, name, nframes=4800, **kwargs):
+        return write_wav(os.path.join(self.directory, name), nframes, **kwargs)
+
+
+@unittest.skipIf(pyaudio is None, "pyaudio is not installed")
+class TestStimulusCache(WavTestCase):
+
+    def test_hits_and_misses(self):
+        cache = StimulusCache()
+        wav_file = self.wav('a.wav')
+        first = cache.open(wav_file)
+        second = cache.open(wav_file)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(first.readframes(4800), second.readframes(4800))
+        self.assertEqual(cache.size, 4800 * 2)
+
+    def test_evicts_least_recently_used(self):
+        cache = StimulusCache(max_bytes=2 * 4800 * 2)
+        a, b, c = [self.wav(name) for name in ('a.wav', 'b.wav', 'c.wav')]
+        cache.open(a)
+        cache.open(b)
+        cache.open(a)  # b is now the least recently used
+        cache.open(c)
+        self.assertEqual(cache.size, 2 * 4800 * 2)
+        cache.open(a)
+        self.assertEqual(cache.misses, 3)
+        cache.open(b)
+        self.assertEqual(cache.misses, 4)
+
+    def test_keeps_a_file_larger_than_the_cache(self):
+        cache = StimulusCache(max_bytes=1000)
+        cache.open(self.wav('a.wav'))
+        cache.open(self.wav('b.wav'))
+        self.assertEqual(cache.size, 4800 * 2)
+        self.assertEqual(len(cache._entries), 1)
+
+    def test_rereads_changed_file(self):
+        cache = StimulusCache()
+        wav_file = self.wav('a.wav')
+        cache.open(wav_file)
+        write_wav(wav_file, 100)
+        os.utime(wav_file, (time.time() + 10, time.time() + 10))
+        self.assertEqual(cache.open(wav_file).getnframes(), 100)
+        self.assertEqual(cache.misses, 2)
+
+
+class CountingPyAudio(NullPyAudio if pyaudio is not None else object):
+    """NullPyAudio that counts the streams opened on it and fails to open the first fail_opens of them"""
+
+    opens = 0
+    fail_opens = 0
+    instances = 0
+
+    def __init__(self, *args, **kwargs):
+        super(CountingPyAudio, self).__init__(*args, **kwargs)
+        CountingPyAudio.instances += 1
+
+    def open(self, *args, **kwargs):
+        CountingPyAudio.opens += 1
+        if CountingPyAudio.fail_opens > 0:
+            CountingPyAudio.fail_opens -= 1
+            raise IOError(-9996, 'Invalid output device (no default output device)')
+        return super(CountingPyAudio, self).open(*args, **kwargs)
+
+
+@unittest.skipIf(pyaudio is None, "pyaudio is not installed")
+class TestPersistentStream(WavTestCase):
+
+    def setUp(self):
+        super(TestPersistentStream, self).setUp()
+        CountingPyAudio.opens = CountingPyAudio.fail_opens = CountingPyAudio.instances = 0
+        self.host = AudioHost(backend=CountingPyAudio)
+        self.interface = PyAudioInterface(device_name='null', host=self.host, cache=StimulusCache(),
+                                          persistent=True)
+
+    def tearDown(self):
+        self.interface.close()
+        self.host.refresh()
+        super(TestPersistentStream, self).tearDown()
+
+    def play(self, wav_file, timeout=2.0):
+        self.interface._queue_wav(wav_file)
+        self.interface._play_wav()
+        deadline = time.time() + timeout
+        while self.interface.playing and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(self.interface.playing)
+
+    def test_opened_once(self):
+        self.assertEqual(CountingPyAudio.opens, 1)
+        self.assertTrue(self.interface.stream.is_active())
+        for i in range(3):
+            self.play(self.wav('a.wav', 2400))
+        self.assertEqual(CountingPyAudio.opens, 1)
+        self.assertTrue(self.interface.stream.is_active())  # writing silence again
+
+    def test_onset_latency(self):
+        self.play(self.wav('a.wav', 2400))
+        self.assertIsNotNone(self.interface._onset_latency())
+        self.assertGreater(self.interface._onset_latency(), 0.0)
+        self.assertLess(self.interface._onset_latency(), 0.2)
+
+    def test_stop_goes_back_to_silence(self):
+        self.interface._queue_wav(self.wav('long.wav', 48000 * 5))
+        self.interface._play_wav()
+        time.sleep(0.05)
+        self.interface._stop_wav()
+        self.assertFalse(self.interface.playing)
+        self.assertEqual(self.interface.wf.tell(), 0)
+        self.assertEqual(CountingPyAudio.opens, 1)
+
+    def test_other_format_reopens(self):
+        self.play(self.wav('a.wav', 2205, rate=44100))
+        self.assertEqual(self.interface.stream_format, (2, 44100))
+        self.assertEqual(CountingPyAudio.opens, 2)
+
+    def test_rejects_stimulus_callback(self):
+        self.assertRaises(InterfaceError, self.interface._queue_wav, self.wav('a.wav'),
+                          callback=lambda *args: ('', pyaudio.paContinue))
+
+    def test_reopen_retries_after_refresh(self):
+        instances = CountingPyAudio.instances
+        CountingPyAudio.fail_opens = 1
+        self.play(self.wav('a.wav', 2205, rate=44100))  # the reopen fails once, then the host is refreshed
+        self.assertEqual(CountingPyAudio.instances, instances + 1)
+        self.assertEqual(CountingPyAudio.opens, 3)
+        self.assertEqual(self.interface.stream_format, (2, 44100))
+
+    def test_reopen_gives_up_after_one_retry(self):
+        CountingPyAudio.fail_opens = 2
+        self.assertRaises(IOError, self.interface._queue_wav, self.wav('a.wav', 2205, rate=44100))
+
+    def test_refresh_keeps_open_streams(self):
+        instances = CountingPyAudio.instances
+        self.host.refresh()  # e.g. a card was replugged on another box
+        self.assertEqual(CountingPyAudio.instances, instances)
+        self.assertTrue(self.interface.stream.is_active())
+        self.play(self.wav('a.wav', 2400))
+        self.assertEqual(CountingPyAudio.opens, 1)
+
+    def test_restarts_once_streams_are_closed(self):
+        instances = CountingPyAudio.instances
+        self.host.refresh()
+        self.interface.close()
+        self.host.pa
+        self.assertEqual(CountingPyAudio.instances, instances + 1)
+
+
+@unittest.skipIf(pyaudio is None, "pyaudio is not installed")
+class TestRecorderChunks(WavTestCase):
+
+    def record(self, n_blocks, **kwargs):
+        """captures n_blocks of 100 frames at 1 kHz, each of which fills a chunk file"""
+        recorder = AudioRecorder(self.directory, rate=1000, frames_per_buffer=100, chunk_seconds=0.1, **kwargs)
+        recorder.start()
+        for i in range(n_blocks):
+            recorder.callback(struct.pack('<100h', *([i] * 100)), 100, {}, 0)
+            time.sleep(0.002)  # chunk files are named by their capture time
+        recorder.stop()
+        return recorder
+
+    def chunk_files(self):
+        return sorted(name for name in os.listdir(self.directory) if name.startswith('recording_'))
+
+    def test_deletes_expired_chunks(self):
+        recorder = self.record(5, max_chunks=2)
+        self.assertEqual(self.chunk_files(), sorted(os.path.basename(chunk[2]) for chunk in recorder.chunks))
+        self.assertEqual(len(self.chunk_files()), 2)
+        self.assertEqual(recorder._frames(300, 500), struct.pack('<200h', *([3] * 100 + [4] * 100)))
+
+    def test_keeps_expired_chunks(self):
+        recorder = self.record(5, max_chunks=2, keep_chunks=True)
+        self.assertEqual(len(recorder.chunks), 2)
+        self.assertEqual(len(self.chunk_files()), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()